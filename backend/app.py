@@ -6,7 +6,9 @@ from flask import Flask
 from flask_cors import CORS
 from flask_restful import Api
 
-from helpers import initialize_trie_users
+from helpers import save_trie_snapshot
+from library.python.Database import Database
+from library.python.Metrics import init_app as init_metrics
 from resources.Categories import Categories
 from resources.Document import Document
 from resources.Documents import Documents
@@ -15,7 +17,7 @@ from resources.UserDocument import UserDocument
 from resources.UserDocuments import UserDocuments
 from resources.Users import Users
 from routes import search_bp, download_bp, delete_bp, add_dummy_documents_bp
-from routes import upload_file_bp
+from routes import upload_file_bp, SEARCH_HEADERS, DOWNLOAD_HEADERS, trieSnapshot
 
 load_dotenv()  # take environment variables from .env.
 
@@ -40,9 +42,7 @@ app = Flask(__name__)
 
 setup_logging()
 
-trieUsersMap = initialize_trie_users()
-
-CORS(app)
+CORS(app, expose_headers=SEARCH_HEADERS + DOWNLOAD_HEADERS)
 
 api = Api(app)
 api.add_resource(Categories, '/categories')
@@ -57,6 +57,27 @@ app.register_blueprint(upload_file_bp)
 app.register_blueprint(download_bp)
 app.register_blueprint(delete_bp)
 app.register_blueprint(add_dummy_documents_bp)
+# Request latencies and structured request log lines, and /metrics, while METRICS_ENABLED is set
+init_metrics(app)
+
+
+@app.after_request
+def flush_database(response):
+    # Persist writes held back by the write-behind cache before the response is sent. A flush
+    # rejected by a concurrent writer dropped the request's changes, so it raises and the request fails
+    Database().flush()
+    return response
+
+
+@app.teardown_appcontext
+def flush_database_on_teardown(exception=None):
+    # Requests that failed before their response still flush what they wrote
+    try:
+        Database().flush()
+    except Exception as e:
+        logger.error(f"Error flushing database: {e}")
+    # Users rebuilt because their snapshot entry was stale are written back once
+    save_trie_snapshot(trieSnapshot)
 
 
 @app.route('/')
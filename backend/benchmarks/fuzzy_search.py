@@ -0,0 +1,81 @@
+"""
+Compares fuzzy trie search latency with exact prefix search
+
+    python benchmarks/fuzzy_search.py [--path db.json] [--documents 20000]
+
+Queries are 4 to 8 character prefixes of existing titles with one random
+typo, the kind of input the autocomplete box sees.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from library.python.Document import Document  # noqa: E402
+from library.python.RadixTrieNode import RadixTrieNode  # noqa: E402
+from library.python.SnapshotCodec import decode_snapshot  # noqa: E402
+from library.python.TrieNode import TrieNode  # noqa: E402
+
+
+def generate_documents(path, size, seed=7):
+    with open(path, 'rb') as handle:
+        data = decode_snapshot(handle.read())
+    words = [word for doc in data.get('documents', {}).values() for word in doc['title'].split()]
+    generator = random.Random(seed)
+    return [Document(f'doc-{number}', ' '.join(generator.choice(words) for _ in range(generator.randint(2, 6))),
+                     '', '.txt') for number in range(size)]
+
+
+def with_typo(text, generator):
+    position = generator.randrange(len(text))
+    kind = generator.choice(('replace', 'delete', 'insert', 'swap'))
+    letter = generator.choice('abcdefghijklmnopqrstuvwxyz')
+    if kind == 'replace':
+        return text[:position] + letter + text[position + 1:]
+    if kind == 'delete':
+        return text[:position] + text[position + 1:]
+    if kind == 'insert':
+        return text[:position] + letter + text[position:]
+    position = min(position, len(text) - 2)
+    return text[:position] + text[position + 1] + text[position] + text[position + 2:]
+
+
+def median_ms(function, queries):
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        function(query)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default='./db.json', help="the JSON database file to take words from")
+    parser.add_argument('--documents', type=int, default=20000, help="the number of titles in the trie")
+    parser.add_argument('--limit', type=int, default=20, help="the number of results per query")
+    args = parser.parse_args()
+
+    documents = generate_documents(args.path, args.documents)
+    generator = random.Random(11)
+    prefixes = [document.title.lower()[:generator.randint(4, 8)] for document in generator.sample(documents, 200)]
+    typos = [with_typo(prefix, generator) for prefix in prefixes]
+
+    print(f"{len(documents)} titles, limit {args.limit}, median ms per query")
+    print(f"{'trie':<16}{'exact':>8}{'fuzzy 1':>10}{'fuzzy 2':>10}")
+    for trie_class in (TrieNode, RadixTrieNode):
+        trie = trie_class(True)
+        for document in documents:
+            trie.insert(document)
+        exact = median_ms(lambda query: trie.search_page(query, args.limit), prefixes)
+        fuzzy_1 = median_ms(lambda query: trie.fuzzy_search_page(query, 1, args.limit), typos)
+        fuzzy_2 = median_ms(lambda query: trie.fuzzy_search_page(query, 2, args.limit), typos)
+        print(f"{trie_class.__name__:<16}{exact:>8.2f}{fuzzy_1:>10.2f}{fuzzy_2:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
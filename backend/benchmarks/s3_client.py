@@ -0,0 +1,60 @@
+"""
+Compares a new S3 client per call with the shared client
+
+    python benchmarks/s3_client.py [--calls 200] [--bucket BUCKET]
+
+Each call is the HeadObject a download makes. A client per call is what
+the routes used to do; the shared client is ``shared_s3_client``. The
+per-operation counters of LatencyCounters time each call.
+
+Without ``--bucket`` the responses are stubbed, so only the setup of the
+client is measured: resolving the credentials and the endpoint and loading
+the service model. Against a real bucket the TLS handshake of every new
+connection adds to it.
+"""
+import argparse
+import os
+import sys
+import time
+
+import boto3
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from library.python.S3Client import LatencyCounters, shared_s3_client  # noqa: E402
+
+
+def head(s3, bucket, latency):
+    latency.track(s3)
+    if bucket:
+        s3.head_object(Bucket=bucket, Key='benchmark')
+        return
+    with Stubber(s3) as stubber:
+        stubber.add_response('head_object', {}, {'Bucket': 'benchmark', 'Key': 'benchmark'})
+        s3.head_object(Bucket='benchmark', Key='benchmark')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=200, help="the number of calls of each variant")
+    parser.add_argument('--bucket', default=None, help="a bucket to send the calls to, stubbed responses otherwise")
+    args = parser.parse_args()
+    if not args.bucket:
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    print(f"{'variant':>16}{'seconds':>9}{'ms/call':>9}{'HeadObject ms':>15}")
+    for variant, client in (('client per call', lambda: boto3.client('s3')), ('shared client', shared_s3_client)):
+        latency = LatencyCounters()
+        started = time.perf_counter()
+        for _ in range(args.calls):
+            head(client(), args.bucket, latency)
+        elapsed = time.perf_counter() - started
+        print(f"{variant:>16}{elapsed:>9.2f}{elapsed / args.calls * 1000:>9.2f}"
+              f"{latency.stats()['HeadObject']['mean_ms']:>15.2f}")
+
+
+if __name__ == '__main__':
+    main()
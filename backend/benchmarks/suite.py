@@ -0,0 +1,308 @@
+"""
+Times the hot paths on synthetic datasets and compares the results with a baseline
+
+    python benchmarks/suite.py [--sizes 1000 10000 100000] [--groups trie cold_start storage hash query]
+                               [--repeat 3] [--output results.json] [--baseline baseline.json] [--tolerance 0.25]
+
+Every dataset is generated by CorpusGenerator from a fixed seed, spread
+over 10 users, so a size is the same corpus on every run and every commit.
+The 100k dataset takes about 4 minutes and 1.5 GB; pass --sizes 1000000 for
+the largest one, on a machine with room for ten times that. The groups are:
+
+    trie        insert, bulk build, prefix search and remove, for TrieNode (up to 100k
+                documents) and RadixTrieNode
+    cold_start  initialize_trie_users over the whole database, without a snapshot
+    storage     a write and a cold read of the database, by UTF8JSONStorage to a file and
+                DynamoDbCachedStorage to an in-memory DynamoDB, so without network; a write
+                changing one document and a read, by JournaledJSONStorage; and a write changing
+                one document, a cold read and a read of unchanged tables, by DynamoDbItemStorage
+    hash        compute_file_hash throughput by file size, independent of --sizes
+    query       the Query lookups of the routes on an IndexedTable, with the query cache off
+
+Each measurement is the best of --repeat runs. --output writes the results
+as JSON, keyed by name, e.g. ``trie.radix.search[10000]``. Save the output
+of a run on the base commit and pass it as --baseline to a run on the
+change: every measurement more than --tolerance worse than the baseline is
+flagged, and the exit status is 1 if any is. Compare runs on the same
+machine only.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tinydb import Query, TinyDB  # noqa: E402
+from tinydb.storages import MemoryStorage  # noqa: E402
+
+import helpers  # noqa: E402
+from library.python.CorpusGenerator import CorpusGenerator  # noqa: E402
+from library.python.DynamoDbCachedStorage import DynamoDbCachedStorage  # noqa: E402
+from library.python.DynamoDbItemStorage import DynamoDbItemStorage  # noqa: E402
+from library.python.InMemoryDynamoDb import InMemoryDynamoDb  # noqa: E402
+from library.python.IndexedTable import IndexedTable  # noqa: E402
+from library.python.JournaledJSONStorage import JournaledJSONStorage  # noqa: E402
+from library.python.RadixTrieNode import RadixTrieNode  # noqa: E402
+from library.python.TrieNode import TrieNode  # noqa: E402
+from library.python.UTF8JSONStorage import UTF8JSONStorage  # noqa: E402
+
+GROUPS = ('trie', 'cold_start', 'storage', 'hash', 'query')
+
+USERS = [{'id': f'user-{number}', 'name': f'User {number}'} for number in range(10)]
+CATEGORIES = ['Draft', 'Final', 'Legal', 'Finance', 'Archive', 'Urgent', 'Review', 'Personal']
+
+# Largest dataset TrieNode is timed on; beyond it the character trie alone takes gigabytes, and the
+# application uses RadixTrieNode unless told otherwise
+CHAR_TRIE_MAX_SIZE = 100000
+
+# Operations timed per measurement of the lookups and tries, drawn from the dataset
+SAMPLE_SIZE = 1000
+
+HASH_FILE_SIZES = {'4KiB': 4 * 1024, '1MiB': 1024 * 1024, '32MiB': 32 * 1024 * 1024}
+
+
+def generate_dataset(size):
+    # The content only needs to be long enough for every document to have its own hash
+    generator = CorpusGenerator(seed=7, content_size=16, now=datetime(2024, 1, 1))
+    return [document for document, _ in generator.documents(USERS, size, CATEGORIES)]
+
+
+def best_seconds(function, repeat, setup=None):
+    # The fastest of the runs, with the garbage collector off as timeit does, is the least noisy;
+    # setup() runs untimed before every run and its result is passed on
+    timings = []
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            function(argument) if setup else function()
+            timings.append(time.perf_counter() - started)
+        finally:
+            gc.enable()
+    return min(timings)
+
+
+def create_database(documents):
+    db = TinyDB(storage=MemoryStorage)
+    db.table_class = IndexedTable
+    db.table('users').insert_multiple(USERS)
+    db.table('documents').insert_multiple(documents)
+    return db
+
+
+def bench_trie(documents, repeat, results, size):
+    trie_documents = [helpers.to_trie_document(document) for document in documents]
+    generator = random.Random(11)
+    sample = generator.sample(trie_documents, min(SAMPLE_SIZE, len(trie_documents)))
+    prefixes = [document.title[:generator.randint(1, 3)] for document in sample]
+
+    for name, trie_class in (('char', TrieNode), ('radix', RadixTrieNode)):
+        if trie_class is TrieNode and size > CHAR_TRIE_MAX_SIZE:
+            continue
+
+        def insert():
+            trie = trie_class(True)
+            for document in trie_documents:
+                trie.insert(document)
+
+        def search(trie):
+            for prefix in prefixes:
+                trie.search(prefix, limit=20)
+
+        def remove(trie):
+            for document in sample:
+                trie.remove(document)
+
+        def build():
+            return trie_class.build(trie_documents)
+
+        results[f'trie.{name}.insert[{size}]'] = best_seconds(insert, repeat) / len(trie_documents), 'us/op'
+        results[f'trie.{name}.build[{size}]'] = best_seconds(build, repeat), 'ms'
+        results[f'trie.{name}.search[{size}]'] = best_seconds(search, repeat, build) / len(prefixes), 'us/op'
+        results[f'trie.{name}.remove[{size}]'] = best_seconds(remove, repeat, build) / len(sample), 'us/op'
+
+
+def bench_cold_start(documents, repeat, results, size):
+    db = create_database(documents)
+    environ = {key: value for key, value in os.environ.items() if key != 'TRIE_SNAPSHOT_PATH'}
+    with patch('helpers.db', new=db), patch.dict(os.environ, environ, clear=True), \
+            contextlib.redirect_stdout(io.StringIO()):
+        results[f'cold_start.initialize_trie_users[{size}]'] = best_seconds(helpers.initialize_trie_users,
+                                                                              repeat), 'ms'
+
+
+def bench_storage(documents, repeat, results, size):
+    data = create_database(documents).storage.read()
+    with tempfile.TemporaryDirectory() as folder:
+        storage = UTF8JSONStorage(os.path.join(folder, 'db.json'))
+        results[f'storage.json.write[{size}]'] = best_seconds(lambda: storage.write(data), repeat), 'ms'
+        results[f'storage.json.read[{size}]'] = best_seconds(storage.read, repeat), 'ms'
+
+    with tempfile.TemporaryDirectory() as folder:
+        storage = JournaledJSONStorage(os.path.join(folder, 'db.json'), compact_threshold=float('inf'))
+        storage.write(data)
+        doc_id = next(iter(data['documents']))
+
+        def change_one():
+            # What TinyDB writes after an update: everything it read, with one document changed
+            changed = storage.read()
+            changed['documents'][doc_id]['title'] += ' (edited)'
+            return changed
+
+        results[f'storage.journal.write_one[{size}]'] = best_seconds(storage.write, repeat, change_one), 'ms'
+        results[f'storage.journal.read[{size}]'] = best_seconds(storage.read, repeat), 'ms'
+        storage.close()
+
+    dynamodb = InMemoryDynamoDb()
+    storage = DynamoDbCachedStorage('benchmark', dynamodb=dynamodb)
+    results[f'storage.dynamodb.write[{size}]'] = best_seconds(lambda: storage.write(data), repeat), 'ms'
+    # A new storage has no parsed copy to reuse, as in a fresh container
+    results[f'storage.dynamodb.read[{size}]'] = best_seconds(
+        lambda: DynamoDbCachedStorage('benchmark', dynamodb=dynamodb).read(), repeat), 'ms'
+
+    dynamodb.create_table(TableName='benchmark-items', KeySchema=[
+        {'AttributeName': 'table_name', 'KeyType': 'HASH'}, {'AttributeName': 'doc_id', 'KeyType': 'RANGE'}])
+    storage = DynamoDbItemStorage('benchmark-items', dynamodb=dynamodb)
+    storage.write(data)
+    doc_id = next(iter(data['documents']))
+
+    def change_one():
+        changed = storage.read()
+        changed['documents'][doc_id]['title'] += ' (edited)'
+        return changed
+
+    results[f'storage.dynamodb_items.write_one[{size}]'] = best_seconds(storage.write, repeat, change_one), 'ms'
+    results[f'storage.dynamodb_items.read[{size}]'] = best_seconds(
+        lambda: DynamoDbItemStorage('benchmark-items', dynamodb=dynamodb).read(), repeat), 'ms'
+    # What every TinyDB operation pays when no other instance changed anything
+    results[f'storage.dynamodb_items.read_unchanged[{size}]'] = best_seconds(storage.read, repeat), 'ms'
+
+
+def bench_hash(repeat, results):
+    block = random.Random(13).randbytes(1024 * 1024)
+    for name, file_size in HASH_FILE_SIZES.items():
+        content = (block * (file_size // len(block) + 1))[:file_size]
+        count = max(1, 32 * 1024 * 1024 // file_size)
+        seconds = best_seconds(lambda: [helpers.compute_file_hash(io.BytesIO(content)) for _ in range(count)],
+                                 repeat)
+        results[f'hash.compute_file_hash[{name}]'] = file_size * count / seconds / (1024 * 1024), 'MiB/s'
+
+
+def bench_query(documents, repeat, results, size):
+    table = IndexedTable(create_database(documents).storage, 'documents', cache_size=0)
+    sample = random.Random(17).sample(documents, min(SAMPLE_SIZE, len(documents)))
+    Document = Query()
+    lookups = {
+        'get_by_id': ([document['id'] for document in sample], lambda value: table.get(Document.id == value)),
+        'search_by_user': ([user['id'] for user in USERS] * 10, lambda value: table.search(Document.userId == value)),
+        'search_by_hash': ([document['hashValue'] for document in sample],
+                           lambda value: table.search(Document.hashValue == value)),
+        # One lookup of all the sampled ids at once, as the bulk routes do
+        'search_any_id': ([[document['id'] for document in sample]], lambda value: table.search_any('id', value)),
+        # Not indexed, so a scan of the table; the delete filters use it
+        'search_by_category': (CATEGORIES, lambda value: table.search(Document.categories.any([value]))),
+    }
+    table.get(Document.id == sample[0]['id'])  # builds the indexes
+    for name, (values, lookup) in lookups.items():
+        seconds = best_seconds(lambda: [lookup(value) for value in values], repeat)
+        results[f'query.{name}[{size}]'] = seconds / len(values), 'us/op'
+
+
+def run(sizes, groups, repeat):
+    results = {}
+    if 'hash' in groups:
+        print("hash", file=sys.stderr)
+        bench_hash(repeat, results)
+    for size in sizes:
+        documents = generate_dataset(size)
+        for group in groups:
+            if group != 'hash':
+                print(f"{group} [{size}]", file=sys.stderr)
+                globals()[f'bench_{group}'](documents, repeat, results, size)
+    # Seconds are reported in the unit named
+    scales = {'us/op': 1e6, 'ms': 1e3, 'MiB/s': 1}
+    return {name: {'value': round(value * scales[unit], 3), 'unit': unit,
+                   'better': 'higher' if unit == 'MiB/s' else 'lower'}
+            for name, (value, unit) in results.items()}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the (name, baseline, current, slowdown) of every measurement in both, and the regressions among them
+    """
+    rows, regressions = [], []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['value'], result['value']
+        # How much worse the current value is, as a fraction: 0.5 is 50% slower or lower throughput
+        slowdown = (after / before if result['better'] == 'lower' else before / after) - 1 if before and after else 0
+        rows.append((name, before, after, slowdown))
+        if slowdown > tolerance:
+            regressions.append(name)
+    return rows, regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="the numbers of documents of the datasets")
+    parser.add_argument('--groups', nargs='+', choices=GROUPS, default=list(GROUPS), help="the benchmarks to run")
+    parser.add_argument('--repeat', type=int, default=3, help="the runs of every measurement")
+    parser.add_argument('--output', help="the file to write the results to, as JSON")
+    parser.add_argument('--baseline', help="the results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="how much worse than the baseline a measurement may be, as a fraction")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.groups, args.repeat)
+    report = {'meta': {'commit': git_commit(), 'python': platform.python_version(), 'machine': platform.platform(),
+                       'date': datetime.now().isoformat(timespec='seconds'), 'sizes': args.sizes,
+                       'repeat': args.repeat},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+    if not args.baseline:
+        print(f"{'benchmark':<46}{'value':>14}  unit")
+        for name, result in results.items():
+            print(f"{name:<46}{result['value']:>14.3f}  {result['unit']}")
+        return
+
+    with open(args.baseline) as handle:
+        baseline = json.load(handle)
+    rows, regressions = compare(results, baseline['results'], args.tolerance)
+    print(f"baseline: commit {baseline['meta'].get('commit')} of {baseline['meta'].get('date')}")
+    print(f"{'benchmark':<46}{'baseline':>14}{'current':>14}{'change':>9}")
+    for name, before, after, slowdown in rows:
+        flag = '  REGRESSION' if name in regressions else ''
+        print(f"{name:<46}{before:>14.3f}{after:>14.3f}{slowdown:>+9.1%}{flag}")
+    if regressions:
+        print(f"{len(regressions)} measurements are more than {args.tolerance:.0%} worse than the baseline")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
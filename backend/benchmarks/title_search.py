@@ -0,0 +1,74 @@
+"""
+Times word-level title searches against a large per-user TitleSearchIndex
+
+    python benchmarks/title_search.py [--path db.json] [--documents 100000]
+
+Titles are built from the words of the titles in the database, so word
+frequencies resemble the real data.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from library.python.Document import Document  # noqa: E402
+from library.python.SnapshotCodec import decode_snapshot  # noqa: E402
+from library.python.TitleSearchIndex import TitleSearchIndex, tokenize  # noqa: E402
+
+
+def generate_documents(path, size, seed=7):
+    with open(path, 'rb') as handle:
+        data = decode_snapshot(handle.read())
+    words = [word for doc in data.get('documents', {}).values() for word in tokenize(doc['title'])]
+    generator = random.Random(seed)
+    for number in range(size):
+        title = ' '.join(generator.choice(words) for _ in range(generator.randint(2, 6)))
+        upload_date = f"2024-{generator.randint(1, 12):02d}-{generator.randint(1, 28):02d}T10:00:00"
+        yield Document(f'doc-{number}', title, '', '.txt', upload_date)
+
+
+def time_queries(index, queries, limit=20):
+    timings = []
+    totals = []
+    for query in queries:
+        started = time.perf_counter()
+        _, total, _ = index.search_page(query, limit)
+        timings.append((time.perf_counter() - started) * 1000)
+        totals.append(total)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)], sum(totals) / len(totals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default='./db.json', help="the JSON database file to take words from")
+    parser.add_argument('--documents', type=int, default=100000, help="the number of documents in the index")
+    args = parser.parse_args()
+
+    index = TitleSearchIndex()
+    started = time.perf_counter()
+    documents = list(generate_documents(args.path, args.documents))
+    for document in documents:
+        index.insert(document)
+    print(f"indexed {len(index)} documents in {time.perf_counter() - started:.1f} s")
+
+    generator = random.Random(11)
+    samples = [tokenize(document.title) for document in generator.sample(documents, 200)]
+    cases = {
+        'one word': [words[0] for words in samples],
+        'one prefix (3)': [words[0][:3] for words in samples],
+        'two words': [' '.join(words[:2]) for words in samples],
+        'word + prefix (2)': [f"{words[0]} {words[1][:2]}" for words in samples],
+        'two prefixes (1)': [f"{words[0][:1]} {words[1][:1]}" for words in samples],
+    }
+    print(f"{'query':<20}{'p50 ms':>9}{'p95 ms':>9}{'avg hits':>10}")
+    for name, queries in cases.items():
+        p50, p95, hits = time_queries(index, queries)
+        print(f"{name:<20}{p50:>9.2f}{p95:>9.2f}{hits:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
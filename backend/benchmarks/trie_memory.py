@@ -0,0 +1,81 @@
+"""
+Compares the memory held by TrieNode and RadixTrieNode title tries
+
+    python benchmarks/trie_memory.py [--path db.json] [--titles 5000]
+
+The titles of the documents in the database are used, topped up with
+titles that combine their words until there are --titles of them, so the
+numbers reflect a user with a large library of realistic titles.
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from library.python.Document import Document  # noqa: E402
+from library.python.RadixTrieNode import RadixTrieNode  # noqa: E402
+from library.python.SnapshotCodec import decode_snapshot  # noqa: E402
+from library.python.TrieNode import TrieNode  # noqa: E402
+
+
+def load_documents(path, size, seed=7):
+    with open(path, 'rb') as handle:
+        data = decode_snapshot(handle.read())
+    documents = [Document(doc['id'], doc['title'], doc['hashValue'], doc['fileExt'], doc.get('uploadDate'))
+                 for doc in data.get('documents', {}).values()]
+    words = [word for document in documents for word in document.title.split()]
+    generator = random.Random(seed)
+    while len(documents) < size:
+        title = ' '.join(generator.choice(words) for _ in range(generator.randint(2, 6)))
+        documents.append(Document(f'generated-{len(documents)}', title, '', '.txt'))
+    return documents[:size]
+
+
+def measure(trie_class, documents):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    trie = trie_class(True)
+    for document in documents:
+        trie.insert(document)
+    build_ms = (time.perf_counter() - started) * 1000
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for document in documents[:500]:
+        trie.search(document.title[:2], limit=20)
+    search_us = (time.perf_counter() - started) * 1e6 / min(len(documents), 500)
+    return trie, size, build_ms, search_us
+
+
+def count_nodes(trie):
+    nodes, stack = 0, [trie]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        stack.extend(node.children.values())
+    return nodes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default='./db.json', help="the JSON database file to take titles from")
+    parser.add_argument('--titles', type=int, default=5000, help="the number of titles per trie")
+    args = parser.parse_args()
+
+    documents = load_documents(args.path, args.titles)
+    print(f"{len(documents)} titles, {sum(len(d.title) for d in documents)} characters")
+    print(f"{'trie':<16}{'nodes':>10}{'KiB':>10}{'build ms':>10}{'search us':>11}")
+    for trie_class in (TrieNode, RadixTrieNode):
+        trie, size, build_ms, search_us = measure(trie_class, documents)
+        print(f"{trie_class.__name__:<16}{count_nodes(trie):>10}{size / 1024:>10.0f}{build_ms:>10.1f}{search_us:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Compares building the users' tries at startup with loading them from a TrieSnapshot
+
+    python benchmarks/trie_startup.py [--path db.json] [--documents 10000 100000] [--users 20]
+
+Documents are spread over --users users, with titles made of the words of
+the titles in the database. The snapshot is written to a temporary file.
+Like initialize_trie_users, both are timed with the garbage collector paused.
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import build_trie_user  # noqa: E402
+from library.python.SnapshotCodec import decode_snapshot  # noqa: E402
+from library.python.TrieSnapshot import TrieSnapshot  # noqa: E402
+
+
+def generate_documents(path, size, users, seed=7):
+    with open(path, 'rb') as handle:
+        data = decode_snapshot(handle.read())
+    words = [word for doc in data.get('documents', {}).values() for word in doc['title'].split()]
+    generator = random.Random(seed)
+    documents = {f'user-{number}': [] for number in range(users)}
+    for number in range(size):
+        documents[f'user-{number % users}'].append({
+            'id': f'doc-{number}',
+            'title': ' '.join(generator.choice(words) for _ in range(generator.randint(2, 6))),
+            'hashValue': f'{number:064x}',
+            'fileExt': '.txt',
+            'uploadDate': f"2024-{generator.randint(1, 12):02d}-{generator.randint(1, 28):02d}T10:00:00",
+        })
+    return documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default='./db.json', help="the JSON database file to take words from")
+    parser.add_argument('--documents', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--users', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'documents':>10}{'rebuild s':>11}{'load s':>9}{'save s':>9}{'snapshot KiB':>14}")
+    for size in args.documents:
+        documents = generate_documents(args.path, size, args.users)
+
+        gc.disable()
+        started = time.perf_counter()
+        trie_users = {user_id: build_trie_user(user_id, user_documents)
+                      for user_id, user_documents in documents.items()}
+        rebuild = time.perf_counter() - started
+
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, 'trie-snapshot.json.z')
+            started = time.perf_counter()
+            snapshot = TrieSnapshot(location)
+            for user_id, trie_user in trie_users.items():
+                snapshot.update(trie_user, documents[user_id])
+            snapshot.save()
+            save = time.perf_counter() - started
+
+            # What a cold start does: read, check fingerprints and restore every user
+            started = time.perf_counter()
+            loaded = TrieSnapshot(location)
+            loaded.load()
+            restored = {user_id: loaded.restore(user_id, user_documents)
+                        for user_id, user_documents in documents.items()}
+            load = time.perf_counter() - started
+            gc.enable()
+            assert all(restored.values())
+            size_kib = os.path.getsize(location) / 1024
+
+        print(f"{size:>10}{rebuild:>11.2f}{load:>9.2f}{save:>9.2f}{size_kib:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
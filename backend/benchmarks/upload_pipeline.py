@@ -0,0 +1,123 @@
+"""
+Compares the two-pass upload flow with the single-pass UploadSpool pipeline
+
+    python benchmarks/upload_pipeline.py [--size-mb 1024] [--folder /tmp]
+
+The two-pass flow is what upload_file used to do: let Werkzeug parse the
+form, hash the file with compute_file_hash, seek back and save it. The
+single pass parses the body straight into a LocalUploadSpool and commits
+it. The request body is generated on the fly, so neither the body nor the
+file is held by the benchmark itself. Each run is a separate process, so
+its peak RSS is its own.
+"""
+import argparse
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import compute_file_hash  # noqa: E402
+from library.python.UploadSpool import LocalUploadSpool, parse_multipart_upload  # noqa: E402
+
+BOUNDARY = 'benchmark-boundary'
+
+
+class MultipartBody(io.RawIOBase):
+    """
+    A multipart/form-data body with one file of ``size`` bytes, generated as it is read
+    """
+
+    def __init__(self, size):
+        self.head = (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="title"\r\n\r\nBenchmark\r\n'
+                     f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="benchmark.bin"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        self.tail = f'\r\n--{BOUNDARY}--\r\n'.encode()
+        self.size = size
+        self.length = len(self.head) + size + len(self.tail)
+        self.position = 0
+        self.block = bytes(range(256)) * 4096
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        start = self.position
+        end = min(start + len(buffer), self.length)
+        view = memoryview(buffer)
+        written = 0
+        while start < end:
+            if start < len(self.head):
+                chunk = self.head[start:end]
+            elif start < len(self.head) + self.size:
+                offset = (start - len(self.head)) % len(self.block)
+                chunk = self.block[offset:offset + min(end - start, len(self.head) + self.size - start)]
+            else:
+                chunk = self.tail[start - len(self.head) - self.size:end - len(self.head) - self.size]
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            start += len(chunk)
+        self.position = end
+        return written
+
+
+def two_pass(body, folder):
+    from werkzeug.formparser import parse_form_data
+    environ = {'wsgi.input': io.BufferedReader(body), 'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(body.length),
+               'CONTENT_TYPE': f'multipart/form-data; boundary={BOUNDARY}'}
+    _, _, files = parse_form_data(environ)
+    file = files['file']
+    file_hash = compute_file_hash(file)
+    file.stream.seek(0)
+    file.save(os.path.join(folder, f'{file_hash}.bin'))
+    return file_hash
+
+
+def single_pass(body, folder):
+    _, files = parse_multipart_upload(io.BufferedReader(body), f'multipart/form-data; boundary={BOUNDARY}',
+                                      body.length, lambda content_type: LocalUploadSpool(folder, content_type))
+    spool = files['file'].stream
+    file_hash = spool.hexdigest()
+    spool.commit(f'{file_hash}.bin')
+    return file_hash
+
+
+def run(variant, size, folder):
+    body = MultipartBody(size)
+    started = time.perf_counter()
+    file_hash = {'two-pass': two_pass, 'single-pass': single_pass}[variant](body, folder)
+    elapsed = time.perf_counter() - started
+    peak_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{elapsed} {peak_mib} {file_hash}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=1024, help="the size of the uploaded file")
+    parser.add_argument('--folder', default=None, help="where the files are stored, a temporary folder by default")
+    parser.add_argument('--run', choices=['two-pass', 'single-pass'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    if args.run:
+        run(args.run, size, args.folder)
+        return
+
+    print(f"{'variant':>12}{'seconds':>9}{'MiB/s':>8}{'peak RSS MiB':>14}")
+    hashes = set()
+    for variant in ('two-pass', 'single-pass'):
+        with tempfile.TemporaryDirectory(dir=args.folder) as folder:
+            output = subprocess.run([sys.executable, __file__, '--run', variant, '--size-mb', str(args.size_mb),
+                                     '--folder', folder], check=True, capture_output=True, text=True).stdout
+        elapsed, peak_mib, file_hash = output.split()[-3:]
+        hashes.add(file_hash)
+        print(f"{variant:>12}{float(elapsed):>9.2f}{args.size_mb / float(elapsed):>8.0f}{float(peak_mib):>14.0f}")
+    assert len(hashes) == 1
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Seeds the database with a synthetic corpus for load testing
+
+    python generate_corpus.py --documents 100000 [--user-id ID ...] [--seed 7]
+                              [--content-size 1024] [--batch-size 50000] [--workers 16] [--no-files]
+
+The documents are generated offline from a built-in word list, reproducibly
+for a seed, and spread evenly over the given users, all existing users by
+default. Their files are written to the store the application uses,
+configured by the same environment variables (USE_S3, S3_BUCKET_NAME,
+UPLOAD_FOLDER and the database settings); --no-files only inserts the
+documents, enough for search load tests. The users' tries are built from
+the new documents when they next search.
+
+Each batch is one write of the database. The JSON storage rewrites the
+whole file on every write, so its writes, not the generation, bound the
+size of the corpora it can take in minutes; the DynamoDB item storage only
+writes the new documents.
+"""
+import argparse
+import time
+
+from helpers import create_blob_store, db
+from library.python.CorpusGenerator import CORPUS_BATCH_SIZE, CORPUS_WRITE_WORKERS, CorpusGenerator, seed_documents
+from library.python.Database import Database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, required=True, help="the number of documents to add")
+    parser.add_argument('--user-id', action='append', help="a user to add documents to, all users by default")
+    parser.add_argument('--seed', type=int, default=None, help="the seed of the corpus, random by default")
+    parser.add_argument('--content-size', type=int, default=1024, help="the size in bytes of every file")
+    parser.add_argument('--batch-size', type=int, default=CORPUS_BATCH_SIZE,
+                        help="the documents inserted in one write")
+    parser.add_argument('--workers', type=int, default=CORPUS_WRITE_WORKERS, help="the threads writing files")
+    parser.add_argument('--no-files', action='store_true', help="insert the documents without storing files")
+    args = parser.parse_args()
+
+    users = db.table('users')
+    selected = [user for user in users.all() if not args.user_id or user['id'] in args.user_id]
+    if not selected:
+        parser.error("no such users")
+    categories = db.table('categories').get(doc_id=1)['data']
+    generator = CorpusGenerator(seed=args.seed, content_size=args.content_size)
+    blob_store = create_blob_store()
+    documents = db.table('documents')
+
+    started = time.perf_counter()
+    inserted = seed_documents(generator, blob_store, documents, selected, args.documents, categories, args.batch_size,
+                              args.workers, not args.no_files)
+    print(f"Added {inserted} documents for {len(selected)} users in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        # The inserted documents, even if a batch failed, would otherwise be lost with the write-behind cache at exit
+        Database().flush()
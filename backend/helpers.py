@@ -1,52 +1,319 @@
+import gc
 import hashlib
+import os
+import time
+
+from botocore.exceptions import ClientError
 from tinydb import Query
 
+from library.python.BlobStore import LocalBlobStore, S3BlobStore
 from library.python.Database import Database
 from library.python.Document import Document
+from library.python.Metrics import METRICS
+from library.python.RadixTrieNode import RadixTrieNode
+from library.python.S3Client import shared_s3_client
+from library.python.TitleSearchIndex import TitleSearchIndex
 from library.python.TrieNode import TrieNode
+from library.python.TrieSnapshot import TrieSnapshot
 from library.python.TrieUser import TrieUser
+from library.python.TrieUserCache import TrieUserCache
 
 db = Database().get_db()
 
 
+def trie_class():
+    """
+    Returns the class of the users' title tries
+
+    The compressed RadixTrieNode is used unless TRIE_IMPLEMENTATION=char selects the original TrieNode.
+    """
+    if os.environ.get('TRIE_IMPLEMENTATION', 'radix').lower() == 'char':
+        return TrieNode
+    return RadixTrieNode
+
+
+def to_trie_document(document):
+    """
+    Creates the Document the tries hold from a document as stored in the database
+    """
+    return Document(document['id'], document['title'], document['hashValue'], document['fileExt'],
+                    document.get('uploadDate'))
+
+
+def build_trie_user(user_id, documents):
+    """
+    Builds the TrieNode and word index of a user from their documents
+
+    Parameters:
+    -----------
+    user_id : str
+        the id of the user
+    documents : list
+        the user's documents as stored in the database
+
+    Returns:
+    --------
+    trie_user : TrieUser
+        the user's trie and word index
+    """
+    trie_documents = [to_trie_document(document) for document in documents]
+    with METRICS.time('trie_operation_duration_seconds', operation='build'):
+        return TrieUser(trie_class().build(trie_documents), user_id, TitleSearchIndex.from_documents(trie_documents))
+
+
+def group_documents_by_user(documents):
+    """
+    Groups documents by the id of the user they belong to, keeping their order
+
+    Parameters:
+    -----------
+    documents : list
+        documents as stored in the database
+
+    Returns:
+    --------
+    documents_by_user : dict
+        a dictionary mapping user IDs to the list of their documents
+    """
+    documents_by_user = {}
+    for document in documents:
+        user_documents = documents_by_user.get(document.get('userId'))
+        if user_documents is None:
+            user_documents = documents_by_user[document.get('userId')] = []
+        user_documents.append(document)
+    return documents_by_user
+
+
 def initialize_trie_users():
     """
     Initialize the TrieNodes for all users in the database
+
+    The documents table is read once and grouped by user, and every trie is
+    built in one pass over the user's sorted titles.
+
+    When TRIE_SNAPSHOT_PATH names a file or an s3:// URL, the tries of users
+    whose documents haven't changed are loaded from that snapshot instead of
+    being rebuilt, and the snapshot is rewritten if any user had to be rebuilt.
     :return: A dictionary mapping user IDs to their TrieNodes containing their documents
     """
+    timings = {}
+    started = time.perf_counter()
     try:
-        # Fetch all users from the database
+        # Fetch all users and all documents from the database
         users = db.table('users').all()
+        documents = db.table('documents').all()
     except Exception as e:
         print(f"Error fetching users from the database: {e}")
         return {}
+    timings['fetch'] = time.perf_counter() - started
+
+    # Creating this many long-lived objects would trigger the cyclic garbage
+    # collector over and over, for nothing to collect
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        documents_by_user = group_documents_by_user(documents)
+        timings['group'] = time.perf_counter() - started
 
-    # Initialize an empty dictionary to store the mapping of users to their TrieNodes
-    trie_users_map = {}
+        started = time.perf_counter()
+        snapshot = open_trie_snapshot()
+        if snapshot:
+            timings['load'] = time.perf_counter() - started
 
-    # Iterate over each user
-    for user in users:
-        try:
-            # Create a new TrieNode for the user
-            trie_node = TrieNode(True)
+        # Initialize an empty dictionary to store the mapping of users to their TrieNodes
+        trie_users_map = {}
+        timings['build'] = 0.0
+        if snapshot:
+            timings['restore'] = 0.0
+        rebuilt = 0
 
-            # Fetch all documents belonging to the current user
-            documents = db.table('documents').search(Query().userId == user['id'])
+        # Iterate over each user
+        for user in users:
+            try:
+                user_documents = documents_by_user.get(user['id'], [])
 
-            # Insert each document into the TrieNode
-            for document in documents:
-                trie_node.insert(
-                    Document(document['id'], document['title'], document['hashValue'], document['fileExt']))
+                # Use the snapshot of the user's TrieNode and word index if it is still current
+                trie_user = None
+                if snapshot:
+                    started = time.perf_counter()
+                    trie_user = snapshot.restore(user['id'], user_documents)
+                    timings['restore'] += time.perf_counter() - started
+                if trie_user is None:
+                    started = time.perf_counter()
+                    trie_user = build_trie_user(user['id'], user_documents)
+                    if snapshot:
+                        snapshot.update(trie_user, user_documents)
+                        rebuilt += 1
+                    timings['build'] += time.perf_counter() - started
 
-            # Map the user to their TrieNode
-            trie_users_map[user['id']] = TrieUser(trie_node, user['id'])
-        except Exception as e:
-            print(f"Error processing user {user['id']}: {e}")
+                # Map the user to their TrieNode
+                trie_users_map[user['id']] = trie_user
+            except Exception as e:
+                print(f"Error processing user {user['id']}: {e}")
+    finally:
+        gc.enable()
+
+    if snapshot:
+        removed_users = set(snapshot.users) - {user['id'] for user in users}
+        for user_id in removed_users:
+            del snapshot.users[user_id]
+            snapshot.changed = True
+        print(f"Restored {len(trie_users_map) - rebuilt} user tries from the snapshot, rebuilt {rebuilt}")
+        if snapshot.changed:
+            started = time.perf_counter()
+            save_trie_snapshot(snapshot)
+            timings['save'] = time.perf_counter() - started
+
+    phases = ', '.join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items())
+    print(f"Initialized the tries of {len(trie_users_map)} users and {len(documents)} documents "
+          f"in {sum(timings.values()):.2f}s ({phases})")
 
     # Return the map of users to their TrieNodes
     return trie_users_map
 
 
+def open_trie_snapshot():
+    """
+    Loads the trie snapshot named by TRIE_SNAPSHOT_PATH, a file path or an s3:// URL
+
+    Returns:
+    --------
+    snapshot : TrieSnapshot
+        the loaded snapshot, or None if TRIE_SNAPSHOT_PATH isn't set
+    """
+    if not os.environ.get('TRIE_SNAPSHOT_PATH'):
+        return None
+    snapshot = TrieSnapshot(os.environ['TRIE_SNAPSHOT_PATH'], trie_class())
+    snapshot.load()
+    return snapshot
+
+
+def save_trie_snapshot(snapshot):
+    """
+    Writes a trie snapshot if entries changed since it was loaded, logging failures
+
+    Parameters:
+    -----------
+    snapshot : TrieSnapshot
+        the snapshot to write, or None
+    """
+    if snapshot is None or not snapshot.changed:
+        return
+    try:
+        snapshot.save()
+    except (OSError, ClientError) as e:
+        print(f"Error saving the trie snapshot: {e}")
+
+
+def load_trie_user(user_id, snapshot=None):
+    """
+    Builds the TrieNode and word index of one user from the database
+
+    Parameters:
+    -----------
+    user_id : str
+        the id of the user
+    snapshot : TrieSnapshot
+        a snapshot to restore the user from if their entry is still current,
+        and to update if it isn't
+
+    Returns:
+    --------
+    trie_user : TrieUser
+        the user's trie and word index, or None if there is no such user and no documents of theirs
+    """
+    documents = db.table('documents').search(Query().userId == user_id)
+    if not documents and not db.table('users').contains(Query().id == user_id):
+        return None
+    trie_user = snapshot.restore(user_id, documents) if snapshot else None
+    if trie_user is None:
+        trie_user = build_trie_user(user_id, documents)
+        if snapshot:
+            snapshot.update(trie_user, documents)
+    return trie_user
+
+
+def create_trie_user_cache(snapshot=None):
+    """
+    Creates the cache that builds the users' TrieNodes on first use
+
+    TRIE_CACHE_MAX_USERS and TRIE_CACHE_MAX_DOCUMENTS bound the number of
+    users and documents kept; unset, the cache is unbounded.
+
+    Parameters:
+    -----------
+    snapshot : TrieSnapshot
+        a snapshot to restore users from, see load_trie_user
+
+    Returns:
+    --------
+    cache : TrieUserCache
+        the cache of the users' tries and word indexes
+    """
+    max_users = os.environ.get('TRIE_CACHE_MAX_USERS')
+    max_documents = os.environ.get('TRIE_CACHE_MAX_DOCUMENTS')
+    return TrieUserCache(lambda user_id: load_trie_user(user_id, snapshot),
+                         max_users=int(max_users) if max_users else None,
+                         max_documents=int(max_documents) if max_documents else None)
+
+
+def sync_trie_users(cache, change_log):
+    """
+    Applies the documents other processes changed to the cached TrieNodes
+
+    Only users whose tries are cached are updated; the others are built from
+    the current documents when they are next needed. If the change log can't
+    tell what changed, every cached trie is dropped instead.
+
+    Parameters:
+    -----------
+    cache : TrieUserCache
+        the cache of the users' tries and word indexes
+    change_log : ChangeLog
+        the change log of the documents table
+    """
+    changes = change_log.poll()
+    if changes is None:
+        cache.clear()
+        return
+
+    documents_table = db.table('documents')
+    current = {}
+    for change in changes:
+        trie_user = cache.peek(change['userId'])
+        if trie_user is None:
+            # A trie being built may have read the documents before the change
+            cache.discard(change['userId'])
+            continue
+        if change['id'] not in current:
+            current[change['id']] = documents_table.get(Query().id == change['id'])
+        document = current[change['id']]
+
+        # Replace whatever version of the document the trie holds with the current one
+        cached = trie_user.index.documents.get(change['id'])
+        if cached is not None:
+            trie_user.remove_document(cached)
+        if document is not None and document.get('userId') == trie_user.user_id:
+            trie_user.add_document(to_trie_document(document))
+
+
+def create_blob_store():
+    """
+    Creates the store of the uploaded files: the UPLOAD_FOLDER prefix of the S3_BUCKET_NAME bucket when
+    USE_S3 is set, the local UPLOAD_FOLDER otherwise
+
+    Returns:
+    --------
+    blob_store : BlobStore
+        the store, counting references through the documents table
+    """
+    upload_folder = os.environ.get('UPLOAD_FOLDER', './uploads')
+    if os.environ.get('USE_S3', 'false').lower() == 'true':
+        return S3BlobStore(db.table('documents'), shared_s3_client(), os.environ.get('S3_BUCKET_NAME', 'dms-backend'),
+                           upload_folder)
+    return LocalBlobStore(db.table('documents'), upload_folder)
+
+
 def compute_file_hash(file):
     """
     Compute the SHA-256 hash of a file
@@ -62,9 +329,12 @@ def compute_file_hash(file):
         The SHA-256 hash of the file
     """
     sha256_hash = hashlib.sha256()
+    started, size = time.perf_counter(), 0
 
     # Read and update hash string value in blocks of 4K
     for byte_block in iter(lambda: file.read(4096), b""):
         sha256_hash.update(byte_block)
+        size += len(byte_block)
 
+    METRICS.throughput('hash', size, time.perf_counter() - started)
     return sha256_hash.hexdigest()
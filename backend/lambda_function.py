@@ -6,6 +6,9 @@ from flask_cors import CORS
 from flask_restful import Api
 
 # from helpers import initialize_trie_users
+from helpers import save_trie_snapshot
+from library.python.Database import Database
+from library.python.Metrics import METRICS, init_app as init_metrics
 from resources.Categories import Categories
 from resources.Document import Document
 from resources.Documents import Documents
@@ -13,7 +16,8 @@ from resources.User import User
 from resources.UserDocument import UserDocument
 from resources.UserDocuments import UserDocuments
 from resources.Users import Users
-from routes import search_bp, download_bp, delete_bp, add_dummy_documents_bp, upload_file_bp
+from routes import search_bp, download_bp, delete_bp, add_dummy_documents_bp, upload_file_bp, SEARCH_HEADERS
+from routes import DOWNLOAD_HEADERS, presignedUrls, trieSnapshot, trieUsersCache
 
 # Module-level global variable
 # trieUsersMap = None
@@ -46,7 +50,7 @@ def create_app():
         logging.error("FRONTEND_URL environment variable is not set!")
         raise ValueError("FRONTEND_URL environment variable is not set!")
 
-    CORS(app, resources={r"/*": {"origins": frontend_url}})
+    CORS(app, resources={r"/*": {"origins": frontend_url}}, expose_headers=SEARCH_HEADERS + DOWNLOAD_HEADERS)
 
     api = Api(app)
     api.add_resource(Categories, '/categories')
@@ -61,6 +65,25 @@ def create_app():
     app.register_blueprint(download_bp)
     app.register_blueprint(delete_bp)
     app.register_blueprint(add_dummy_documents_bp)
+    # Request latencies and structured request log lines, and /metrics, while METRICS_ENABLED is set
+    init_metrics(app)
+
+    @app.after_request
+    def flush_database(response):
+        # Persist writes held back by the write-behind cache before the response is sent. A flush
+        # rejected by a concurrent writer dropped the request's changes, so it raises and the request fails
+        Database().flush()
+        return response
+
+    @app.teardown_appcontext
+    def flush_database_on_teardown(exception=None):
+        # Requests that failed before their response still flush what they wrote
+        try:
+            Database().flush()
+        except Exception as e:
+            logging.error(f"Error flushing database: {e}")
+        # Users rebuilt because their snapshot entry was stale are written back once
+        save_trie_snapshot(trieSnapshot)
 
     @app.route('/')
     def hello_world():
@@ -84,28 +107,47 @@ def lambda_handler(event, context):
 
     logging.info("Received event: %s", json.dumps(event))
 
-    try:
-        if 'httpMethod' not in event:
-            # This might be an HTTP API event
-            http_method = event['requestContext']['http']['method']
-            event['httpMethod'] = http_method
-
-            # If path is missing, add it
-            if 'path' not in event:
-                event['path'] = event['requestContext']['http']['path']
-
-            # Handle query string parameters
-            if 'queryStringParameters' not in event or event['queryStringParameters'] is None:
-                event['queryStringParameters'] = {}
-
-            # Handle multi-value query string parameters (if needed)
-            if 'multiValueQueryStringParameters' not in event or event['multiValueQueryStringParameters'] is None:
-                event['multiValueQueryStringParameters'] = {}
-
-        return response(app, event, context)
-    except Exception as e:
-        logging.error(f"Error processing request: {e}", exc_info=True)
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
-        }
+    # A container serves one request at a time and is rarely scraped, so the log lines are what to read here
+    with METRICS.time('lambda_invocation_duration_seconds'):
+        try:
+            if 'httpMethod' not in event:
+                # This might be an HTTP API event
+                http_method = event['requestContext']['http']['method']
+                event['httpMethod'] = http_method
+
+                # If path is missing, add it
+                if 'path' not in event:
+                    event['path'] = event['requestContext']['http']['path']
+
+                # Handle query string parameters
+                if 'queryStringParameters' not in event or event['queryStringParameters'] is None:
+                    event['queryStringParameters'] = {}
+
+                # Handle multi-value query string parameters (if needed)
+                if 'multiValueQueryStringParameters' not in event or event['multiValueQueryStringParameters'] is None:
+                    event['multiValueQueryStringParameters'] = {}
+
+            result = response(app, event, context)
+        except Exception as e:
+            logging.error(f"Error processing request: {e}", exc_info=True)
+            result = {
+                'statusCode': 500,
+                'body': json.dumps({'error': str(e)})
+            }
+
+        # The container may be frozen right after we return, so nothing may stay unflushed. A flush
+        # that fails lost the request's changes: answer 500 rather than let API Gateway turn it into a 502
+        try:
+            Database().flush()
+        except Exception as e:
+            logging.error(f"Error flushing database: {e}", exc_info=True)
+            result = {
+                'statusCode': 500,
+                'body': json.dumps({'error': 'The changes could not be saved'})
+            }
+        cache_stats = Database().cache_stats()
+        if cache_stats:
+            logging.info("Database cache stats: %s", json.dumps(cache_stats))
+        logging.info("Trie cache stats: %s", json.dumps(trieUsersCache.stats()))
+        logging.info("Presigned URL cache stats: %s", json.dumps(presignedUrls.stats()))
+    return result
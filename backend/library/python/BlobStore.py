@@ -0,0 +1,472 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+from tinydb import Query
+
+from library.python.ChunkedUpload import LocalChunkedUpload, S3ChunkedUpload
+from library.python.S3Client import TRANSFER_CONFIG, LatencyCounters
+from library.python.UploadSpool import LocalUploadSpool, S3UploadSpool
+
+# Number of directory levels blobs are sharded into, each named by the next two hex digits of the hash
+SHARD_LEVELS = 2
+
+# Age in seconds below which an unreferenced file is left alone, as its document may still be on its way
+GC_GRACE_PERIOD = 24 * 3600
+
+# Age in seconds below which the blob of a removed document is kept, as an upload of the same content may have
+# just stored it again for a document not inserted yet; collect_garbage sweeps it later if it stays unreferenced
+RELEASE_GRACE_PERIOD = 3600
+
+# The name of a blob: the SHA-256 of its content followed by the file extension
+BLOB_NAME = re.compile(r'^([0-9a-f]{64})(.*)$')
+
+# Files of uploads that were never committed
+TEMPORARY_PREFIXES = ('.upload-', '.chunked-', '.staging/')
+
+# Most keys one S3 DeleteObjects request may delete
+S3_DELETE_BATCH_SIZE = 1000
+
+# Threads deleting local files at once
+LOCAL_DELETE_WORKERS = 8
+
+# Requests looking up the age of the S3 objects of released blobs at once
+S3_HEAD_WORKERS = 16
+
+
+def blob_key(hash_value, file_ext):
+    """
+    Returns the key of a blob relative to the store, e.g. ``ab/cd/abcd…ef.pdf``
+    """
+    shards = [hash_value[2 * level:2 * level + 2] for level in range(SHARD_LEVELS)]
+    return '/'.join(shards + [f"{hash_value}{file_ext}"])
+
+
+class BlobStore:
+    """
+    Content-addressed storage of the uploaded files, shared by the documents with the same content
+
+    A blob is stored once under ``blob_key(hashValue, fileExt)``, sharded by
+    the first digits of the hash so that no directory or S3 prefix grows
+    too large. The documents referencing a blob are those with its hash and
+    extension, looked up through the hashValue index of the documents table,
+    so the reference count is always that of the stored documents. A blob
+    is only deleted once its last document is gone, and once it is older
+    than ``RELEASE_GRACE_PERIOD``: an upload stores its blob before it
+    inserts its document, so a younger blob may be about to be referenced.
+
+    Blobs stored before sharding, directly in the store under their name,
+    are still found, and can be moved into place with ``migrate``.
+
+    Attributes:
+    ----------
+    documents : Table
+        the documents table
+    latency : LatencyCounters
+        the calls the store made to its storage and the time they took
+
+    Methods:
+    --------
+    create_spool(self, content_type=None)
+        Returns an UploadSpool whose commit stores a file in the store
+
+    chunked_upload(self, session)
+        Returns the ChunkedUpload holding the parts of a resumable upload
+
+    locate(self, key)
+        Returns the path or S3 key a blob is stored at
+
+    resolve(self, key)
+        Returns where a blob is, falling back to its location before sharding
+
+    references(self, hash_value, file_ext)
+        Returns the ids of the documents referencing a blob
+
+    release(self, document, grace_period=RELEASE_GRACE_PERIOD, now=None)
+        Deletes the blob of a removed document if no other document references it
+
+    release_many(self, documents, grace_period=RELEASE_GRACE_PERIOD, now=None)
+        Deletes the blobs of removed documents that no other document references
+
+    collect_garbage(self, grace_period=GC_GRACE_PERIOD, now=None, dry_run=False)
+        Deletes the blobs no document references and the leftovers of failed uploads
+
+    migrate(self)
+        Moves the blobs stored before sharding to their sharded keys
+
+    stats(self)
+        Returns the calls the store made to its storage, by operation
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.latency = LatencyCounters()
+
+    @staticmethod
+    def key_of(document):
+        """
+        Returns the key of the blob of a document
+        """
+        return blob_key(document['hashValue'], document['fileExt'])
+
+    def create_spool(self, content_type=None):
+        """
+        Returns an UploadSpool whose commit stores a file in the store, given its key
+        """
+        raise NotImplementedError
+
+    def chunked_upload(self, session):
+        """
+        Returns the ChunkedUpload holding the parts of a resumable upload, given its ChunkedUploads session
+        """
+        raise NotImplementedError
+
+    def locate(self, key):
+        """
+        Returns the path or S3 key a blob is stored at
+        """
+        raise NotImplementedError
+
+    def resolve(self, key):
+        """
+        Returns where a blob is, falling back to its location before sharding
+
+        Parameters:
+        -----------
+        key : str
+            the key of the blob
+
+        Returns:
+        --------
+        location : str
+            the path or S3 key of the blob, or None if it isn't stored
+        """
+        for relative_key in (key, self._legacy_key(key)):
+            if self._exists(relative_key):
+                return self.locate(relative_key)
+        return None
+
+    def references(self, hash_value, file_ext):
+        """
+        Returns the ids of the documents referencing a blob
+
+        Parameters:
+        -----------
+        hash_value : str
+            the SHA-256 of the blob
+        file_ext : str
+            the file extension of the blob
+
+        Returns:
+        --------
+        document_ids : list
+            the ids of the documents with that content
+        """
+        Document = Query()
+        return [document['id'] for document in
+                self.documents.search((Document.hashValue == hash_value) & (Document.fileExt == file_ext))]
+
+    def release(self, document, grace_period=RELEASE_GRACE_PERIOD, now=None):
+        """
+        Deletes the blob of a removed document if no other document references it
+
+        Call after the document has been removed from the documents table.
+
+        Parameters:
+        -----------
+        document : dict
+            the removed document
+        grace_period : float
+            the age in seconds the blob must have to be deleted
+        now : float
+            the current time, time.time() by default
+
+        Returns:
+        --------
+        deleted : bool
+            True if the blob was deleted, False if it is still referenced or too young
+        """
+        return bool(self.release_many([document], grace_period, now))
+
+    def release_many(self, documents, grace_period=RELEASE_GRACE_PERIOD, now=None):
+        """
+        Deletes the blobs of removed documents that no other document references
+
+        The remaining references of all the blobs are looked up at once, and
+        the blobs deleted in batches. A blob younger than ``grace_period``
+        seconds is kept for the garbage collection to sweep: an upload of the
+        same content may have stored it again after the references were
+        looked up, and be about to insert its document.
+
+        Parameters:
+        -----------
+        documents : list
+            the removed documents
+        grace_period : float
+            the age in seconds a blob must have to be deleted
+        now : float
+            the current time, time.time() by default
+
+        Returns:
+        --------
+        deleted : list
+            the keys of the deleted blobs
+        """
+        now = time.time() if now is None else now
+        blobs = {(document['hashValue'], document['fileExt']) for document in documents}
+        referenced = {(document['hashValue'], document['fileExt'])
+                      for document in self.documents.search_any('hashValue', {hash_value for hash_value, _ in blobs})}
+        keys = sorted(blob_key(*blob) for blob in blobs - referenced)
+        # A blob no longer at its sharded key may still be at its pre-sharding one, which uploads never write
+        keys = [key for key, modified in zip(keys, self._modified_many(keys))
+                if modified is None or now - modified >= grace_period]
+        self._remove_many([location for key in keys for location in (key, self._legacy_key(key))])
+        return keys
+
+    def collect_garbage(self, grace_period=GC_GRACE_PERIOD, now=None, dry_run=False):
+        """
+        Deletes the blobs no document references and the leftovers of failed uploads
+
+        Files younger than ``grace_period`` seconds are kept, so an upload
+        stored just before its document is inserted isn't swept. Files whose
+        names aren't blob names are never touched.
+
+        Parameters:
+        -----------
+        grace_period : float
+            the age in seconds a file must have to be deleted
+        now : float
+            the current time, time.time() by default
+        dry_run : bool
+            only return the files that would be deleted
+
+        Returns:
+        --------
+        deleted : list
+            the keys of the deleted files
+        """
+        now = time.time() if now is None else now
+        referenced = {(document['hashValue'], document['fileExt']) for document in self.documents.all()}
+        deleted = []
+        for key, modified in list(self._list()):
+            if now - modified < grace_period:
+                continue
+            if key.startswith(TEMPORARY_PREFIXES):
+                garbage = True
+            else:
+                match = BLOB_NAME.match(key.rsplit('/', 1)[-1])
+                garbage = (match is not None and key in (blob_key(*match.groups()), match.group(0))
+                           and match.groups() not in referenced)
+            if garbage:
+                deleted.append(key)
+        if not dry_run:
+            self._remove_many(deleted)
+        return deleted
+
+    def migrate(self):
+        """
+        Moves the blobs stored before sharding to their sharded keys
+
+        Returns:
+        --------
+        moved : int
+            the number of blobs moved
+        """
+        moved = 0
+        for key, _ in list(self._list()):
+            match = BLOB_NAME.match(key)
+            if match is None or '/' in key:
+                continue
+            self._move(key, blob_key(*match.groups()))
+            moved += 1
+        return moved
+
+    def stats(self):
+        """
+        Returns the calls the store made to its storage, by operation
+
+        Returns:
+        --------
+        stats : dict
+            the calls, errors, total seconds and mean and max milliseconds of each operation
+        """
+        return self.latency.stats()
+
+    @staticmethod
+    def _legacy_key(key):
+        # Before sharding, blobs were stored directly in the store
+        return key.rsplit('/', 1)[-1]
+
+    def _exists(self, key):
+        raise NotImplementedError
+
+    def _remove(self, key):
+        raise NotImplementedError
+
+    def _modified(self, key):
+        # The time a blob was last written, or None if it isn't stored
+        raise NotImplementedError
+
+    def _modified_many(self, keys):
+        return [self._modified(key) for key in keys]
+
+    def _remove_many(self, keys):
+        for key in keys:
+            self._remove(key)
+
+    def _list(self):
+        # Yields the key and modification time of every file in the store
+        raise NotImplementedError
+
+    def _move(self, key, new_key):
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    """
+    A BlobStore in a folder of the local filesystem
+    """
+
+    def __init__(self, documents, folder):
+        super().__init__(documents)
+        self.folder = folder
+
+    def create_spool(self, content_type=None):
+        return LocalUploadSpool(self.folder, content_type)
+
+    def chunked_upload(self, session):
+        return LocalChunkedUpload(self.folder, session['id'], session['partSize'])
+
+    def locate(self, key):
+        return os.path.join(self.folder, key)
+
+    def _exists(self, key):
+        with self.latency.time('exists'):
+            return os.path.isfile(self.locate(key))
+
+    def _modified(self, key):
+        with self.latency.time('modified'):
+            try:
+                return os.path.getmtime(self.locate(key))
+            except FileNotFoundError:
+                return None
+
+    def _remove(self, key):
+        with self.latency.time('remove'):
+            try:
+                os.remove(self.locate(key))
+            except FileNotFoundError:
+                pass
+
+    def _remove_many(self, keys):
+        # Unlinks mostly wait on the filesystem, so they overlap well
+        with ThreadPoolExecutor(max_workers=LOCAL_DELETE_WORKERS) as executor:
+            list(executor.map(self._remove, keys))
+
+    def _list(self):
+        for directory, _, file_names in os.walk(self.folder):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                yield os.path.relpath(path, self.folder).replace(os.sep, '/'), os.path.getmtime(path)
+
+    def _move(self, key, new_key):
+        with self.latency.time('move'):
+            path = self.locate(new_key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.locate(key), path)
+
+
+class S3BlobStore(BlobStore):
+    """
+    A BlobStore under a prefix of an S3 bucket
+
+    Every call made through the client, by the store or by its spools and
+    chunked uploads, is counted by operation in ``latency``. Managed copies
+    use ``transfer_config``.
+
+    Garbage collection also aborts the multipart uploads of failed uploads
+    that were never completed.
+    """
+
+    def __init__(self, documents, s3, bucket, prefix, transfer_config=TRANSFER_CONFIG):
+        super().__init__(documents)
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.transfer_config = transfer_config
+        self.latency.track(s3)
+
+    def create_spool(self, content_type=None):
+        return S3UploadSpool(self.s3, self.bucket, self.prefix, content_type, transfer_config=self.transfer_config)
+
+    def chunked_upload(self, session):
+        return S3ChunkedUpload(self.s3, self.bucket, self.prefix, session['id'], session['partSize'],
+                               session.get('s3UploadId'), session.get('contentType'), self.transfer_config)
+
+    def locate(self, key):
+        return os.path.join(self.prefix, key)
+
+    def collect_garbage(self, grace_period=GC_GRACE_PERIOD, now=None, dry_run=False):
+        now = time.time() if now is None else now
+        deleted = super().collect_garbage(grace_period, now, dry_run)
+        paginator = self.s3.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.locate('.staging/')):
+            for upload in page.get('Uploads', []):
+                if now - upload['Initiated'].timestamp() >= grace_period:
+                    if not dry_run:
+                        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=upload['Key'],
+                                                       UploadId=upload['UploadId'])
+                    deleted.append(upload['Key'][len(self.prefix) + 1:])
+        return deleted
+
+    def _exists(self, key):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self.locate(key))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def _modified(self, key):
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=self.locate(key))['LastModified'].timestamp()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def _modified_many(self, keys):
+        # Each lookup is a round trip, so they overlap
+        with ThreadPoolExecutor(max_workers=S3_HEAD_WORKERS) as executor:
+            return list(executor.map(self._modified, keys))
+
+    def _remove(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.locate(key))
+
+    def _remove_many(self, keys):
+        errors = []
+        for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            batch = keys[start:start + S3_DELETE_BATCH_SIZE]
+            response = self.s3.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self.locate(key)} for key in batch], 'Quiet': True})
+            errors.extend(response.get('Errors', []))
+        if errors:
+            # Every batch was attempted; the files left behind are swept by the garbage collection
+            raise ClientError({'Error': {'Code': errors[0].get('Code'),
+                                         'Message': f"{len(errors)} files could not be deleted, e.g. "
+                                                    f"{errors[0].get('Key')}: {errors[0].get('Message')}"}},
+                              'DeleteObjects')
+
+    def _list(self):
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.locate('')):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix) + 1:], item['LastModified'].timestamp()
+
+    def _move(self, key, new_key):
+        self.s3.copy({'Bucket': self.bucket, 'Key': self.locate(key)}, self.bucket, self.locate(new_key),
+                     Config=self.transfer_config)
+        self.s3.delete_object(Bucket=self.bucket, Key=self.locate(key))
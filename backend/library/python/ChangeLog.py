@@ -0,0 +1,112 @@
+import time
+
+# The table holding the change log; the document id of each entry is its sequence number
+CHANGE_LOG_TABLE = 'changes'
+
+# Tables whose writes are logged, with the fields each entry keeps of a changed document
+LOGGED_FIELDS = {'documents': ('id', 'userId')}
+
+# The number of most recent entries kept
+CHANGE_LOG_SIZE = 1000
+
+
+def record_changes(tables, table_name, documents):
+    """
+    Appends a change log entry to the raw database data, before it is written
+
+    Every write to a logged table adds one entry, under the next sequence
+    number, listing the logged fields of the documents it changed, as they
+    were before and after the write. The entry is stored in the same write
+    as the change itself, so it can't be lost or seen early.
+
+    Parameters:
+    -----------
+    tables : dict
+        the raw database data, table name -> document id -> document
+    table_name : str
+        the name of the table written to
+    documents : list
+        the logged fields of each changed document, or None if the table was emptied
+    """
+    log = tables.setdefault(CHANGE_LOG_TABLE, {})
+    sequence = max(map(int, log), default=0) + 1
+    if documents is None:
+        log[str(sequence)] = {'table': table_name, 'reset': True}
+    else:
+        log[str(sequence)] = {'table': table_name, 'documents': documents}
+    for old in [key for key in log if int(key) <= sequence - CHANGE_LOG_SIZE]:
+        del log[old]
+
+
+class ChangeLog:
+    """
+    Reads the changes other processes made to a logged table
+
+    Each process keeps the sequence number of the last entry it has seen and
+    polls for the entries after it, so it only has to apply the documents
+    that changed instead of reloading everything.
+
+    Attributes:
+    ----------
+    db : TinyDB
+        the database holding the change log
+    table_name : str
+        the logged table whose changes are returned
+    poll_interval : float
+        the number of seconds after a poll during which further polls return nothing
+    sequence : int
+        the sequence number of the last entry seen
+
+    Methods:
+    --------
+    latest(self)
+        Returns the sequence number of the most recent entry
+
+    poll(self)
+        Returns the documents changed since the last poll
+    """
+
+    def __init__(self, db, table_name='documents', poll_interval=1.0):
+        self.db = db
+        self.table_name = table_name
+        self.poll_interval = poll_interval
+        self.sequence = self.latest()
+        self._polled_at = time.monotonic()
+
+    def latest(self):
+        """
+        Returns the sequence number of the most recent entry, 0 if there is none
+        """
+        return max((entry.doc_id for entry in self.db.table(CHANGE_LOG_TABLE).all()), default=0)
+
+    def poll(self):
+        """
+        Returns the documents changed since the last poll
+
+        Returns:
+        --------
+        documents : list
+            the logged fields of the changed documents, oldest change first, or
+            None if the table was emptied or entries were dropped from the log
+            before they were seen, so that anything may have changed
+        """
+        now = time.monotonic()
+        if now - self._polled_at < self.poll_interval:
+            return []
+        self._polled_at = now
+
+        entries = sorted((entry for entry in self.db.table(CHANGE_LOG_TABLE).all() if entry.doc_id > self.sequence),
+                         key=lambda entry: entry.doc_id)
+        if not entries:
+            return []
+        missed = entries[0].doc_id > self.sequence + 1
+        self.sequence = entries[-1].doc_id
+
+        documents = []
+        for entry in entries:
+            if entry['table'] != self.table_name:
+                continue
+            if entry.get('reset'):
+                return None
+            documents.extend(entry['documents'])
+        return None if missed else documents
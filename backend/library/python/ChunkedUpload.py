@@ -0,0 +1,513 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from tinydb import Query
+
+from library.python.Metrics import METRICS
+from library.python.S3Client import TRANSFER_CONFIG
+from library.python.UploadSpool import S3_PART_SIZE, UPLOAD_CHUNK_SIZE
+
+# The table holding the resumable uploads in progress
+UPLOADS_TABLE = 'uploads'
+
+# Bounds of the part size a client may choose: S3 requires 5 MiB for all parts but the last,
+# and a part is held in memory while it is sent to S3
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_PART_SIZE = S3_PART_SIZE
+
+# The most parts an upload may have, S3's limit
+MAX_PARTS = 10000
+
+
+class ChunkedUpload:
+    """
+    The parts of one resumable upload, stored and hashed as they arrive
+
+    Each part is written to its place in the file as it is read from the
+    request and its SHA-256 computed on the way, so a failed part can be
+    sent again on its own. ``finish`` puts the parts together and hashes
+    whatever the running hash of the whole file, kept by ChunkedUploads,
+    has not covered; after it the upload is committed or discarded like an
+    UploadSpool.
+
+    Attributes:
+    ----------
+    upload_id : str
+        the id of the upload
+    part_size : int
+        the size of every part but the last
+    size : int
+        the size of the file, once finished
+    rehashed_bytes : int
+        the number of bytes read back by ``finish`` to complete the hash
+
+    Methods:
+    --------
+    initiate(self)
+        Prepares the storage of the parts, returning what the session needs to keep
+
+    write_part(self, number, stream, running=None)
+        Stores and hashes a part
+
+    finish(self, parts, running=None, hashed_parts=0)
+        Puts the parts together and completes the SHA-256 of the file
+
+    hexdigest(self)
+        Returns the SHA-256 of the file, once finished
+
+    commit(self, name)
+        Stores the file under its final name and returns where it is
+
+    discard(self)
+        Drops the parts or the file
+    """
+
+    def __init__(self, upload_id, part_size):
+        self.upload_id = upload_id
+        self.part_size = part_size
+        self.size = 0
+        self.rehashed_bytes = 0
+        self._sha256 = None
+
+    def initiate(self):
+        """
+        Prepares the storage of the parts, returning the fields the session needs to keep
+        """
+        return {}
+
+    def write_part(self, number, stream, running=None):
+        """
+        Stores and hashes a part
+
+        Parameters:
+        -----------
+        number : int
+            the number of the part, from 1
+        stream : file
+            the content of the part
+        running : hashlib.sha256
+            the running hash of the file, fed the part too when it is the next one in order
+
+        Returns:
+        --------
+        part : dict
+            the size and SHA-256 of the part, with what the storage needs to put the parts together
+
+        Raises:
+        -------
+        ValueError
+            if the part is larger than the part size
+        """
+        sha256 = hashlib.sha256()
+        hashes = [sha256] if running is None else [sha256, running]
+        received = [0]
+
+        def chunks():
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    return
+                received[0] += len(chunk)
+                if received[0] > self.part_size:
+                    raise ValueError(f"A part can't be larger than {self.part_size} bytes")
+                started = time.perf_counter()
+                for hash_object in hashes:
+                    hash_object.update(chunk)
+                METRICS.throughput('hash', len(chunk) * len(hashes), time.perf_counter() - started)
+                yield chunk
+
+        stored = self._store_part(number, chunks())
+        return {'size': received[0], 'sha256': sha256.hexdigest(), **stored}
+
+    def finish(self, parts, running=None, hashed_parts=0):
+        """
+        Puts the parts together and completes the SHA-256 of the file
+
+        Parameters:
+        -----------
+        parts : list
+            the parts of the file in order, as returned by write_part
+        running : hashlib.sha256
+            the hash of the first ``hashed_parts`` parts, None to hash the whole file
+        hashed_parts : int
+            the number of parts covered by ``running``
+        """
+        self.size = sum(part['size'] for part in parts)
+        self._finish(parts)
+        if running is None:
+            running, hashed_parts = hashlib.sha256(), 0
+        offset = hashed_parts * self.part_size
+        for chunk in self._read_from(offset):
+            started = time.perf_counter()
+            running.update(chunk)
+            METRICS.throughput('hash', len(chunk), time.perf_counter() - started)
+            self.rehashed_bytes += len(chunk)
+        self._sha256 = running
+
+    def hexdigest(self):
+        """
+        Returns the SHA-256 of the file, once finished
+        """
+        return self._sha256.hexdigest()
+
+    def commit(self, name):
+        """
+        Stores the file under its final name and returns where it is
+        """
+        raise NotImplementedError
+
+    def discard(self):
+        """
+        Drops the parts or the file
+        """
+        raise NotImplementedError
+
+    def _store_part(self, number, chunks):
+        raise NotImplementedError
+
+    def _finish(self, parts):
+        raise NotImplementedError
+
+    def _read_from(self, offset):
+        # Yields the content of the finished file from an offset
+        raise NotImplementedError
+
+
+class LocalChunkedUpload(ChunkedUpload):
+    """
+    A ChunkedUpload writing every part at its offset in one temporary file of the upload folder
+    """
+
+    def __init__(self, folder, upload_id, part_size):
+        super().__init__(upload_id, part_size)
+        self.folder = folder
+        self.path = os.path.join(folder, f'.chunked-{upload_id}')
+
+    def commit(self, name):
+        path = os.path.join(self.folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path, path)
+        return path
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _store_part(self, number, chunks):
+        os.makedirs(self.folder, exist_ok=True)
+        # Opened without truncating, as other parts may be written concurrently
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as handle:
+            handle.seek((number - 1) * self.part_size)
+            for chunk in chunks:
+                handle.write(chunk)
+        return {}
+
+    def _finish(self, parts):
+        # A retried last part may have been longer than the one kept
+        os.truncate(self.path, self.size)
+
+    def _read_from(self, offset):
+        with open(self.path, 'rb') as handle:
+            handle.seek(offset)
+            for chunk in iter(lambda: handle.read(UPLOAD_CHUNK_SIZE), b''):
+                yield chunk
+
+
+class S3ChunkedUpload(ChunkedUpload):
+    """
+    A ChunkedUpload sent as an S3 multipart upload to a staging key, copied to its final key on commit
+    """
+
+    def __init__(self, s3, bucket, prefix, upload_id, part_size, s3_upload_id=None, content_type=None,
+                 transfer_config=TRANSFER_CONFIG):
+        super().__init__(upload_id, part_size)
+        self.s3 = s3
+        self.transfer_config = transfer_config
+        self.bucket = bucket
+        self.prefix = prefix
+        self.staging_key = os.path.join(prefix, '.staging', upload_id)
+        self.s3_upload_id = s3_upload_id
+        self.content_type = content_type
+        self._completed = False
+
+    def initiate(self):
+        extra_args = {'ContentType': self.content_type} if self.content_type else {}
+        response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.staging_key, **extra_args)
+        self.s3_upload_id = response['UploadId']
+        return {'s3UploadId': self.s3_upload_id}
+
+    def commit(self, name):
+        key = os.path.join(self.prefix, name)
+        self.s3.copy({'Bucket': self.bucket, 'Key': self.staging_key}, self.bucket, key, Config=self.transfer_config)
+        self.s3.delete_object(Bucket=self.bucket, Key=self.staging_key)
+        self._completed = False
+        self.s3_upload_id = None
+        return key
+
+    def discard(self):
+        if self._completed:
+            self.s3.delete_object(Bucket=self.bucket, Key=self.staging_key)
+        elif self.s3_upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.staging_key, UploadId=self.s3_upload_id)
+        self._completed = False
+        self.s3_upload_id = None
+
+    def _store_part(self, number, chunks):
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.staging_key, UploadId=self.s3_upload_id,
+                                       PartNumber=number, Body=b''.join(chunks))
+        return {'etag': response['ETag']}
+
+    def _finish(self, parts):
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.staging_key, UploadId=self.s3_upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': part['etag']}
+                                       for number, part in enumerate(parts, start=1)]})
+        self._completed = True
+
+    def _read_from(self, offset):
+        if offset >= self.size:
+            return
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.staging_key, Range=f'bytes={offset}-')
+        yield from response['Body'].iter_chunks(UPLOAD_CHUNK_SIZE)
+
+
+class ChunkedUploads:
+    """
+    The resumable uploads in progress, kept in a database table so any process can take the next part
+
+    A session is created by ``initiate``, receives its parts in any order
+    and any number of times through ``put_part``, and is turned into a
+    finished ChunkedUpload by ``complete``.
+
+    SHA-256 can't be combined from the hashes of the parts, so each process
+    also keeps a running hash of the uploads it receives parts of, fed every
+    part that arrives right after the ones already hashed. ``complete`` only
+    reads back the parts after the last one it covers: nothing when the
+    parts came in order to the same process, the whole file when the process
+    never saw the first part.
+
+    Attributes:
+    ----------
+    db : TinyDB
+        the database holding the sessions
+    blob_store : BlobStore
+        the store the parts are kept in, through its chunked uploads
+    max_running_hashes : int
+        the largest number of running hashes kept, the oldest are dropped first
+
+    Methods:
+    --------
+    initiate(self, fields, part_size=DEFAULT_PART_SIZE)
+        Starts an upload
+
+    get(self, upload_id)
+        Returns the session of an upload
+
+    put_part(self, upload_id, number, stream)
+        Stores a part of an upload, replacing any earlier copy
+
+    complete(self, upload_id)
+        Puts the parts of an upload together
+
+    close(self, upload_id)
+        Forgets an upload once its file has been committed or discarded
+
+    abort(self, upload_id)
+        Drops an upload and its parts
+
+    expire(self, max_age, now=None)
+        Aborts the uploads started more than max_age seconds ago
+    """
+
+    def __init__(self, db, blob_store, max_running_hashes=1000):
+        self.db = db
+        self.blob_store = blob_store
+        self.max_running_hashes = max_running_hashes
+        # upload id -> {'next': first part not hashed, 'sha256': hash so far, 'fed': part number -> part hash,
+        #               'busy': whether a part is being fed}
+        self._running = OrderedDict()
+        self._lock = threading.Lock()
+
+    def initiate(self, fields, part_size=DEFAULT_PART_SIZE):
+        """
+        Starts an upload
+
+        Parameters:
+        -----------
+        fields : dict
+            what the session keeps for completing the upload, e.g. the user id and title
+        part_size : int
+            the size of every part but the last
+
+        Returns:
+        --------
+        session : dict
+            the stored session, with its id
+
+        Raises:
+        -------
+        ValueError
+            if the part size is out of bounds
+        """
+        if not MIN_PART_SIZE <= part_size <= MAX_PART_SIZE:
+            raise ValueError(f"The part size must be between {MIN_PART_SIZE} and {MAX_PART_SIZE} bytes")
+        session = {**fields, 'id': uuid.uuid4().hex, 'partSize': part_size, 'parts': {}, 'created': time.time()}
+        session.update(self.blob_store.chunked_upload(session).initiate())
+        self.db.table(UPLOADS_TABLE).insert(session)
+        with self._lock:
+            self._running[session['id']] = {'next': 1, 'sha256': hashlib.sha256(), 'fed': {}, 'busy': False}
+            while len(self._running) > self.max_running_hashes:
+                self._running.popitem(last=False)
+        return session
+
+    def get(self, upload_id):
+        """
+        Returns the session of an upload, None if there is no such upload
+        """
+        return self.db.table(UPLOADS_TABLE).get(Query().id == upload_id)
+
+    def put_part(self, upload_id, number, stream):
+        """
+        Stores a part of an upload, replacing any earlier copy
+
+        Parameters:
+        -----------
+        upload_id : str
+            the id of the upload
+        number : int
+            the number of the part, from 1
+        stream : file
+            the content of the part
+
+        Returns:
+        --------
+        part : dict
+            the size and SHA-256 of the part
+
+        Raises:
+        -------
+        KeyError
+            if there is no such upload
+        ValueError
+            if the part number is out of bounds or the part too large
+        """
+        session = self.get(upload_id)
+        if session is None:
+            raise KeyError(upload_id)
+        if not 1 <= number <= MAX_PARTS:
+            raise ValueError(f"The part number must be between 1 and {MAX_PARTS}")
+
+        with self._lock:
+            state = self._running.get(upload_id)
+            running = None
+            if state is not None and state['next'] == number and not state['busy']:
+                # Fed a copy, so a part that fails halfway leaves the hash as it was
+                state['busy'] = True
+                running = state['sha256'].copy()
+        try:
+            part = self.blob_store.chunked_upload(session).write_part(number, stream, running)
+        finally:
+            if running is not None:
+                with self._lock:
+                    state['busy'] = False
+        with self._lock:
+            if running is not None:
+                state.update(next=number + 1, sha256=running)
+                state['fed'][number] = part['sha256']
+
+        def record(stored):
+            stored['parts'][str(number)] = part
+        self.db.table(UPLOADS_TABLE).update(record, Query().id == upload_id)
+        return part
+
+    def complete(self, upload_id):
+        """
+        Puts the parts of an upload together and completes the SHA-256 of the file
+
+        Parameters:
+        -----------
+        upload_id : str
+            the id of the upload
+
+        Returns:
+        --------
+        session : dict
+            the session of the upload
+        upload : ChunkedUpload
+            the finished file, to be committed or discarded, then closed
+
+        Raises:
+        -------
+        KeyError
+            if there is no such upload
+        ValueError
+            if parts are missing, or a part other than the last is shorter than the part size
+        """
+        session = self.get(upload_id)
+        if session is None:
+            raise KeyError(upload_id)
+        count = len(session['parts'])
+        parts = [session['parts'].get(str(number)) for number in range(1, count + 1)]
+        if not parts or None in parts:
+            raise ValueError("The parts must be numbered from 1 without gaps")
+        if any(part['size'] != session['partSize'] for part in parts[:-1]):
+            raise ValueError(f"Every part but the last must have {session['partSize']} bytes")
+
+        with self._lock:
+            state = self._running.pop(upload_id, None)
+        running, hashed_parts = None, 0
+        # The running hash is only used if it covers exactly the parts that were kept
+        if state is not None and not state['busy'] and state['next'] - 1 <= count and all(
+                state['fed'][number] == parts[number - 1]['sha256'] for number in range(1, state['next'])):
+            running, hashed_parts = state['sha256'], state['next'] - 1
+
+        upload = self.blob_store.chunked_upload(session)
+        upload.finish(parts, running, hashed_parts)
+        return session, upload
+
+    def close(self, upload_id):
+        """
+        Forgets an upload once its file has been committed or discarded
+        """
+        with self._lock:
+            self._running.pop(upload_id, None)
+        self.db.table(UPLOADS_TABLE).remove(Query().id == upload_id)
+
+    def abort(self, upload_id):
+        """
+        Drops an upload and its parts
+
+        Returns:
+        --------
+        aborted : bool
+            False if there is no such upload
+        """
+        session = self.get(upload_id)
+        if session is None:
+            return False
+        self.blob_store.chunked_upload(session).discard()
+        self.close(upload_id)
+        return True
+
+    def expire(self, max_age, now=None):
+        """
+        Aborts the uploads started more than max_age seconds ago
+
+        Returns:
+        --------
+        expired : list
+            the ids of the aborted uploads
+        """
+        now = time.time() if now is None else now
+        expired = [session['id'] for session in self.db.table(UPLOADS_TABLE).all()
+                   if now - session['created'] > max_age]
+        for upload_id in expired:
+            self.abort(upload_id)
+        return expired
@@ -0,0 +1,7 @@
+class ConcurrentModificationError(Exception):
+    """
+    Raised by a storage when a write lost a race against another writer
+
+    The data the write was based on is outdated. The storage has dropped its
+    cached copy, so the operation can be retried against fresh data.
+    """
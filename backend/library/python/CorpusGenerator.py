@@ -0,0 +1,198 @@
+import base64
+import hashlib
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from library.python.Database import Database
+
+# Documents generated, stored and inserted at a time, each batch in one write of the documents table
+CORPUS_BATCH_SIZE = 50000
+
+# Threads writing the files of a batch to the blob store
+CORPUS_WRITE_WORKERS = 16
+
+# The words titles are made of, so a corpus needs no network and is the same for the same seed
+WORDS = (
+    'account', 'action', 'agenda', 'agreement', 'alpha', 'analysis', 'annual', 'answer', 'appendix', 'application',
+    'approval', 'archive', 'area', 'article', 'asset', 'audit', 'autumn', 'backlog', 'balance', 'baseline',
+    'basic', 'benefit', 'beta', 'billing', 'blueprint', 'board', 'brief', 'budget', 'building', 'bulletin',
+    'business', 'calendar', 'campaign', 'campus', 'capital', 'case', 'catalogue', 'certificate', 'change', 'chapter',
+    'charter', 'checklist', 'claim', 'class', 'client', 'clinic', 'closing', 'committee', 'community', 'company',
+    'compliance', 'concept', 'conference', 'contract', 'control', 'council', 'course', 'cover', 'credit', 'customer',
+    'daily', 'data', 'deadline', 'decision', 'delivery', 'demo', 'department', 'deposit', 'design', 'detail',
+    'development', 'diagram', 'digital', 'director', 'draft', 'east', 'edition', 'education', 'energy', 'estimate',
+    'event', 'evidence', 'exam', 'expense', 'export', 'facility', 'family', 'feedback', 'field', 'final',
+    'finance', 'first', 'fiscal', 'folder', 'forecast', 'form', 'framework', 'fund', 'future', 'general',
+    'global', 'goal', 'grant', 'guide', 'handbook', 'health', 'history', 'holiday', 'housing', 'import',
+    'incident', 'index', 'insurance', 'interim', 'internal', 'interview', 'inventory', 'invoice', 'journal', 'kickoff',
+    'launch', 'lease', 'lecture', 'ledger', 'legal', 'letter', 'library', 'license', 'list', 'loan',
+    'local', 'logistics', 'maintenance', 'manual', 'market', 'master', 'meeting', 'memo', 'method', 'migration',
+    'milestone', 'minutes', 'model', 'monthly', 'national', 'network', 'notes', 'notice', 'office', 'onboarding',
+    'operations', 'order', 'outline', 'overview', 'partner', 'patent', 'payment', 'payroll', 'performance', 'permit',
+    'personal', 'phase', 'pilot', 'plan', 'policy', 'portfolio', 'position', 'preliminary', 'presentation', 'price',
+    'procedure', 'process', 'product', 'profile', 'program', 'progress', 'project', 'proposal', 'protocol', 'purchase',
+    'quality', 'quarterly', 'question', 'receipt', 'record', 'recovery', 'reference', 'regional', 'register', 'release',
+    'renewal', 'rental', 'report', 'request', 'research', 'resource', 'response', 'review', 'revision', 'risk',
+    'roadmap', 'safety', 'salary', 'sales', 'schedule', 'school', 'science', 'second', 'security', 'seminar',
+    'service', 'session', 'settlement', 'shipping', 'site', 'specification', 'spring', 'staff', 'standard', 'statement',
+    'status', 'strategy', 'study', 'summary', 'summer', 'supplier', 'support', 'survey', 'system', 'target',
+    'task', 'tax', 'team', 'technical', 'template', 'tender', 'test', 'thesis', 'timeline', 'training',
+    'transfer', 'travel', 'trial', 'update', 'upgrade', 'vendor', 'version', 'village', 'visit', 'warranty',
+    'weekly', 'west', 'winter', 'workshop', 'yearly', 'zone',
+)
+
+
+class CorpusGenerator:
+    """
+    Generates synthetic documents and their files offline, reproducibly from a seed
+
+    Titles are drawn from a built-in word list, files are random text and
+    the documents carry the SHA-256 of their file, as uploaded ones do, so
+    the files can be stored in the BlobStore under their real keys. Upload
+    dates come from the same random generator, so a seed always yields the
+    same corpus. Ids don't: they are generated like those of uploaded
+    documents, so corpora seeded alike for different users, or twice for
+    one, never share an id.
+
+    Attributes:
+    ----------
+    seed : int
+        the seed of the random generator, None for a different corpus every time
+    content_size : int
+        the size in bytes of every file
+    days : int
+        the upload dates are spread over this many days up to ``now``
+    now : datetime
+        the latest upload date
+
+    Methods:
+    --------
+    title(self)
+        Returns a title of whole words
+
+    documents(self, users, count, categories)
+        Returns the given number of documents, each with the content of its file
+    """
+
+    def __init__(self, seed=None, content_size=1024, days=365, now=None, words=WORDS):
+        self.seed = seed
+        self.content_size = content_size
+        self.days = days
+        self.now = now or datetime.now()
+        self.words = words
+        self._random = random.Random(seed)
+        self._generated = 0  # so the users take turns across calls
+
+    def title(self):
+        """
+        Returns a title of whole words, 10 to 50 characters long or a word longer
+        """
+        length = self._random.randint(10, 50)
+        title = self._random.choice(self.words)
+        while len(title) < length:
+            title = f"{title} {self._random.choice(self.words)}"
+        return title.capitalize()
+
+    def documents(self, users, count, categories):
+        """
+        Returns the given number of documents, each with the content of its file
+
+        The documents go to the users in turn, continuing from the last call,
+        so their counts differ by at most one.
+
+        Parameters:
+        -----------
+        users : list
+            the users, with their id and name
+        count : int
+            the number of documents
+        categories : list
+            the categories to draw one from for every document
+
+        Returns:
+        --------
+        documents : list
+            (document, content) pairs, the document as stored in the documents table
+        """
+        documents = []
+        for _ in range(count):
+            user = users[self._generated % len(users)]
+            self._generated += 1
+            # Random bytes, base64-encoded into text, are much faster to draw than random characters
+            content = base64.b64encode(self._random.randbytes(self.content_size // 4 * 3 + 3))[:self.content_size]
+            upload_date = self.now - timedelta(seconds=self._random.randrange(self.days * 24 * 3600))
+            documents.append(({
+                'id': Database.generate_id(),
+                'userId': user['id'],
+                'author': user['name'],
+                'title': self.title(),
+                'hashValue': hashlib.sha256(content).hexdigest(),
+                'fileExt': '.txt',
+                'fileType': '.txt',
+                'uploadDate': upload_date.isoformat(),
+                'uploadDateReadable': upload_date.strftime('%d-%b-%Y %H:%M'),
+                'categories': [self._random.choice(categories)],
+                'mimeType': 'text/plain'
+            }, content))
+        return documents
+
+
+def seed_documents(generator, blob_store, documents_table, users, count, categories, batch_size=CORPUS_BATCH_SIZE,
+                   workers=CORPUS_WRITE_WORKERS, write_files=True):
+    """
+    Generates documents of users and stores them with their files, a batch at a time
+
+    The files of a batch are written to the blob store by a pool of
+    threads, then the batch is inserted with one ``insert_multiple``, so a
+    storage that rewrites the whole database on every write, like the JSON
+    one, does so once per batch. The tries aren't updated; discard the
+    users' cached TrieUsers so they are built again, in bulk, when next
+    needed.
+
+    Parameters:
+    -----------
+    generator : CorpusGenerator
+        generates the documents
+    blob_store : BlobStore
+        stores the files
+    documents_table : Table
+        the documents table
+    users : list
+        the users, with their id and name, taking turns
+    count : int
+        the number of documents
+    categories : list
+        the categories to draw from
+    batch_size : int
+        the number of documents generated and inserted at a time
+    workers : int
+        the number of threads writing files
+    write_files : bool
+        whether to store the files, or only the documents
+
+    Returns:
+    --------
+    inserted : int
+        the number of documents inserted
+    """
+    def store(item):
+        document, content = item
+        spool = blob_store.create_spool(document['mimeType'])
+        try:
+            spool.write(content)
+            document['filePath'] = spool.commit(blob_store.key_of(document))
+        except BaseException:
+            spool.discard()
+            raise
+
+    inserted = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while inserted < count:
+            batch = generator.documents(users, min(batch_size, count - inserted), categories)
+            if write_files:
+                # Raises the first error, after the batch's other files are written
+                list(executor.map(store, batch))
+            documents_table.insert_multiple(document for document, _ in batch)
+            inserted += len(batch)
+    return inserted
@@ -1,12 +1,18 @@
-import json
 import os
 import uuid
 
 from tinydb import TinyDB
 
 from library.python.DynamoDbCachedStorage import DynamoDbCachedStorage
+from library.python.DynamoDbItemStorage import DynamoDbItemStorage
+from library.python.IndexedTable import IndexedTable
+from library.python.InstrumentedMiddleware import InstrumentedMiddleware
+from library.python.JournaledJSONStorage import JournaledJSONStorage
+from library.python.Metrics import METRICS
 from library.python.Singleton import Singleton
+from library.python.SnapshotCodec import decode_snapshot
 from library.python.UTF8JSONStorage import UTF8JSONStorage
+from library.python.WriteBehindCachingMiddleware import WriteBehindCachingMiddleware
 
 
 def is_list_of_dicts(data):
@@ -40,11 +46,40 @@ def preprocess_data(data):
     return transformed_data
 
 
+def with_write_behind(storage):
+    """
+    Wraps a storage class in the write-behind cache when DB_WRITE_BEHIND is enabled
+    """
+    storage = with_instrumentation(storage)
+    if os.environ.get('DB_WRITE_BEHIND', 'false').lower() != 'true':
+        return storage
+    read_ttl = os.environ.get('DB_CACHE_READ_TTL')
+    return WriteBehindCachingMiddleware(storage,
+                                        flush_every=int(os.environ.get('DB_FLUSH_EVERY', 100)),
+                                        flush_interval=float(os.environ.get('DB_FLUSH_INTERVAL', 5)),
+                                        read_ttl=float(read_ttl) if read_ttl else None)
+
+
+def with_instrumentation(storage):
+    """
+    Wraps a storage class in the timing middleware when METRICS_ENABLED is set, and leaves it alone otherwise
+    """
+    if not METRICS.enabled:
+        return storage
+    return InstrumentedMiddleware(storage)
+
+
 class Database(metaclass=Singleton):
     def __init__(self):
         # use_s3 = os.environ.get('USE_S3', 'false').lower() == 'true'
         use_dynamodb = os.environ.get('USE_DYNAMODB', 'false').lower() == 'true'
+        use_journal = os.environ.get('USE_JOURNAL_STORAGE', 'false').lower() == 'true'
         dynamodb_table_name = os.environ.get('DYNAMODB_TABLE_NAME', 'dms')
+        dynamodb_layout = os.environ.get('DYNAMODB_LAYOUT', 'dump').lower()
+        # json-pretty, json, zlib or lzma; unset keeps writing the pretty-printed JSON dump
+        snapshot_codec = os.environ.get('DB_SNAPSHOT_CODEC') or None
+        snapshot_chunk_size = os.environ.get('DB_SNAPSHOT_CHUNK_SIZE')
+        snapshot_chunk_size = int(snapshot_chunk_size) if snapshot_chunk_size else None
         try:
             # if use_s3:
             #     storage = S3CachedStorage
@@ -52,28 +87,60 @@ class Database(metaclass=Singleton):
             #     self.db = TinyDB(storage=storage, bucket_name=os.environ.get('S3_BUCKET_NAME'),
             #                      file_name=os.environ.get('S3_FILE_NAME'), lock_timeout=500, max_retries=10, base_delay=10)
             #     print("TinyDb Database init completed successfully")
-            if use_dynamodb:
-                storage = DynamoDbCachedStorage
+            if use_dynamodb and dynamodb_layout == 'items':
+                storage = with_write_behind(DynamoDbItemStorage)
+                print("Using DynamoDb item-per-document storage")
+                self.db = TinyDB(storage=storage,
+                                 table_name=os.environ.get('DYNAMODB_ITEMS_TABLE_NAME', 'dms-items'))
+            elif use_dynamodb:
+                storage = with_write_behind(DynamoDbCachedStorage)
                 print("Using DynamoDb storage")
-                self.db = TinyDB(storage=storage, table_name=dynamodb_table_name)
+                self.db = TinyDB(storage=storage, table_name=dynamodb_table_name,
+                                 codec=snapshot_codec, chunk_size=snapshot_chunk_size)
+            elif use_journal:
+                storage = with_write_behind(JournaledJSONStorage)
+                print("Using journaled JSON storage")
+                self.db_path = './db.json'
+                compact_threshold = int(os.environ.get('JOURNAL_COMPACT_THRESHOLD', 4 * 1024 * 1024))
+                self.db = TinyDB(self.db_path, storage=storage, compact_threshold=compact_threshold)
             else:
-                storage = UTF8JSONStorage
+                storage = with_write_behind(UTF8JSONStorage)
                 print("Using JSON storage")
                 self.db_path = './db.json'
-                self.db = TinyDB(self.db_path, storage=storage, sort_keys=True, indent=4, separators=(',', ': '))
+                self.db = TinyDB(self.db_path, storage=storage, sort_keys=True, indent=4, separators=(',', ': '),
+                                 codec=snapshot_codec, chunk_size=snapshot_chunk_size)
+            # Answer equality lookups on id, userId, hashValue and email from hash indexes
+            self.db.table_class = IndexedTable
         except Exception as e:
             print(f"Error initializing database: {e}")
 
     def get_db(self):
         return self.db
 
+    def flush(self):
+        """
+        Writes changes held by the write-behind cache to the storage, if one is in use
+        """
+        storage = self.db.storage
+        if isinstance(storage, WriteBehindCachingMiddleware):
+            storage.flush()
+
+    def cache_stats(self):
+        """
+        Returns the write-behind cache counters, or None if the cache is not in use
+        """
+        storage = self.db.storage
+        if isinstance(storage, WriteBehindCachingMiddleware):
+            return storage.stats()
+        return None
+
     @staticmethod
     def generate_id():
         return str(uuid.uuid4())
 
     def populate_db(self, resource_name):
-        with open(self.db_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(self.db_path, 'rb') as f:
+            data = decode_snapshot(f.read())
             resources = data.get(resource_name, [])  # Access the resource key
             resources = preprocess_data(resources)  # Preprocess the data
             self.db.drop_table(resource_name)  # Drop the table
@@ -12,9 +12,11 @@ class Document:
         a string that represents the hash value of the document
     fileExt : str
         the file extension of the document
+    uploadDate : str
+        the ISO 8601 upload timestamp of the document, used to rank search results
     """
 
-    def __init__(self, id, title, hashValue, fileExt):
+    def __init__(self, id, title, hashValue, fileExt, uploadDate=None):
         """
         Constructs all the necessary attributes for the Document object.
 
@@ -28,8 +30,11 @@ class Document:
                 a string that represents the hash value of the document
             fileExt : str
                 the file extension of the document
+            uploadDate : str
+                the ISO 8601 upload timestamp of the document
         """
         self.id = id
         self.hashValue = hashValue
         self.title = title
         self.fileExt = fileExt
+        self.uploadDate = uploadDate
@@ -1,23 +1,105 @@
 import logging
 import json
+import uuid
+
 import boto3
+from boto3.dynamodb.conditions import Attr
 from botocore.exceptions import ClientError
 from tinydb.storages import Storage
 
+from library.python.ConcurrentModificationError import ConcurrentModificationError
+from library.python.SnapshotCodec import decode_snapshot, get_codec, split_chunks
+
+# DynamoDB items are limited to 400 KB, leave room for the key and the other attributes
+DEFAULT_CHUNK_SIZE = 350 * 1024
+
+# How often a read is attempted when the chunks it needs were replaced meanwhile
+MAX_CHUNK_READ_ATTEMPTS = 3
+
+# Key of the small item holding only the version, which a warm read checks instead of the item with the dump
+VERSION_ITEM_ID = 'db#version'
+
+
+class MissingChunksError(Exception):
+    pass
+
 
 class DynamoDbCachedStorage(Storage):
-    def __init__(self, table_name):
-        self.dynamodb = boto3.resource('dynamodb')
+    """
+    A TinyDB storage that keeps the whole database as one JSON dump in a DynamoDB item
+
+    The item carries a ``version`` attribute that every write increments. A
+    warm container keeps the data it parsed last and, on the next read, only
+    gets the ``VERSION_ITEM_ID`` item, which holds nothing but the version,
+    as a projection read would still be charged for the whole dump; the dump
+    is downloaded and parsed again only when another writer has bumped the
+    version.
+
+    A write raises the version item before putting the dump, and never
+    lowers it, so it is never behind the dump: a copy read at the version it
+    holds is current. It may be ahead, while a write is in flight or after
+    one failed; warm reads then download the dump until the next write.
+
+    Writes are conditional on the version the data was read at. When another
+    writer got there first the cached copy is dropped and a
+    ConcurrentModificationError is raised, so the operation can be retried
+    against fresh data instead of overwriting the other write.
+
+    With a snapshot codec (DB_SNAPSHOT_CODEC) the dump is written compact or
+    compressed. A compressed dump is kept in the binary ``db_blob`` attribute;
+    a dump larger than ``chunk_size`` is split over ``db#<version>#...`` chunk
+    items that are written before the versioned head item points at them.
+
+    Attributes:
+    ----------
+    version : int
+        the version of the cached data, or None if nothing is cached
+    generation : int
+        incremented whenever the cached data is replaced by data written by
+        someone else, so callers can tell when derived state is outdated
+    codec : SnapshotCodec
+        the codec new dumps are written with, None for the plain JSON dump
+    chunk_size : int
+        the maximum number of bytes stored per item
+    """
+
+    def __init__(self, table_name, dynamodb=None, codec=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.dynamodb = dynamodb or boto3.resource('dynamodb')
+        self.table_name = table_name
         self.table = self.dynamodb.Table(table_name)
+        self.codec = get_codec(codec) if codec else None
+        self.chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
         self.logger = logging.getLogger()
+        self.last_read_bytes = 0
+        self.last_write_bytes = 0
+        self.version = None
+        self.generation = 0
+        self._data = None
+        self._chunk_keys = []  # keys of the chunk items the cached version is stored in
 
     def read(self):
+        # Forget the cached copy until it is confirmed current. If the read
+        # fails, a write based on the empty result then can't pass the
+        # version check and wipe the database.
+        cached_data, cached_version = self._data, self.version
+        self._data, self.version = None, None
+        self.last_read_bytes = 0
         try:
-            response = self.table.get_item(Key={'id': 'db'}, ConsistentRead=True)
-            if 'Item' in response:
-                return json.loads(response['Item']['db_dump'])
-            else:
-                return {}
+            if cached_data is not None:
+                response = self.table.get_item(Key={'id': VERSION_ITEM_ID}, ConsistentRead=True)
+                current_version = int(response['Item'].get('version', 0)) if 'Item' in response else 0
+                if current_version == cached_version:
+                    self._data, self.version = cached_data, cached_version
+                    return cached_data
+
+            data, version = self._read_head()
+            if cached_data is not None and version == cached_version:
+                # Only the version item was ahead of the dump: the copy is still current
+                self._data, self.version = cached_data, cached_version
+                return cached_data
+            self._data, self.version = data, version
+            self.generation += 1
+            return data
         except ClientError as e:
             self.logger.error(f"Error reading from DynamoDB: {e}")
             return {}
@@ -31,11 +113,94 @@ class DynamoDbCachedStorage(Storage):
             self.logger.error(f"Error reading from DynamoDB: {e}")
             return {}
 
+    def _read_head(self):
+        for attempt in range(MAX_CHUNK_READ_ATTEMPTS):
+            response = self.table.get_item(Key={'id': 'db'}, ConsistentRead=True)
+            if 'Item' not in response:
+                self._chunk_keys = []
+                return {}, 0
+            item = response['Item']
+            try:
+                data = self._decode_item(item)
+            except MissingChunksError:
+                # A newer version was committed and its writer removed the
+                # chunks this head pointed at, read the new head
+                if attempt == MAX_CHUNK_READ_ATTEMPTS - 1:
+                    raise
+                continue
+            return data, int(item.get('version', 0))
+
+    def _decode_item(self, item):
+        if 'chunks' in item:
+            keys = [{'id': f"{item['chunk_prefix']}#{index}"} for index in range(int(item['chunks']))]
+            payload = b''.join(self._get_chunks(keys))
+            self._chunk_keys = keys
+        else:
+            self._chunk_keys = []
+            payload = _binary_value(item['db_blob']) if 'db_blob' in item else item['db_dump']
+        self.last_read_bytes = len(payload)
+        return decode_snapshot(payload)
+
+    def _get_chunks(self, keys):
+        chunks = {}
+        for offset in range(0, len(keys), 100):
+            request = {self.table_name: {'Keys': keys[offset:offset + 100], 'ConsistentRead': True}}
+            while request:
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.table_name, []):
+                    chunks[item['id']] = _binary_value(item['chunk'])
+                request = response.get('UnprocessedKeys')
+        try:
+            return [chunks[key['id']] for key in keys]
+        except KeyError as e:
+            raise MissingChunksError(f"Snapshot chunk {e} is gone") from e
+
     def write(self, data):
+        expected_version = self.version or 0
+        if expected_version:
+            condition = Attr('version').eq(expected_version)
+        else:
+            condition = Attr('version').not_exists()
+
+        # TinyDB modifies the data it read in place, so whatever happens the
+        # cached copy can't be trusted until the write has succeeded
+        self._data, self.version = None, None
+        previous_chunk_keys, self._chunk_keys = self._chunk_keys, []
+        chunk_keys = []
         try:
-            json_data = json.dumps(data)
-            self.table.put_item(Item={'id': 'db', 'db_dump': json_data})
+            item = {'id': 'db', 'version': expected_version + 1}
+            if self.codec is None:
+                item['db_dump'] = json.dumps(data)
+                payload = item['db_dump'].encode('utf-8')
+            else:
+                payload = self.codec.encode(data)
+                item['codec'] = self.codec.name
+                chunks = split_chunks(payload, self.chunk_size)
+                if len(chunks) > 1:
+                    # Chunk items get a fresh prefix, they only become visible
+                    # once the conditional head write below succeeds
+                    prefix = f"db#{expected_version + 1}#{uuid.uuid4().hex[:12]}"
+                    chunk_keys = [{'id': f"{prefix}#{index}"} for index in range(len(chunks))]
+                    self._write_chunks(chunk_keys, chunks)
+                    item.update({'chunks': len(chunks), 'chunk_prefix': prefix})
+                elif self.codec.compression is None:
+                    item['db_dump'] = payload.decode('utf-8')
+                else:
+                    item['db_blob'] = payload
+            # Fails if another writer already raised it past our version, whose dump we'd then fail to replace
+            version_condition = Attr('version').not_exists() | Attr('version').lte(expected_version + 1)
+            self.table.put_item(Item={'id': VERSION_ITEM_ID, 'version': expected_version + 1},
+                                ConditionExpression=version_condition)
+            self.table.put_item(Item=item, ConditionExpression=condition)
+            self._data, self.version = data, expected_version + 1
+            self._chunk_keys = chunk_keys
+            self.last_write_bytes = len(payload)
+            self._delete_chunks(previous_chunk_keys)
         except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                self.logger.warning(f"Database version {expected_version} is outdated, write rejected")
+                self._delete_chunks(chunk_keys)
+                raise ConcurrentModificationError(f"Database changed since version {expected_version}") from e
             self.logger.error(f"Error writing to DynamoDB: {e}")
         except json.JSONDecodeError as e:
             self.logger.error(f"Error parsing JSON data: {e}")
@@ -44,5 +209,26 @@ class DynamoDbCachedStorage(Storage):
         except Exception as e:
             self.logger.error(f"Error writing to DynamoDB: {e}")
 
+    def _write_chunks(self, keys, chunks):
+        with self.table.batch_writer() as batch:
+            for key, chunk in zip(keys, chunks):
+                batch.put_item(Item={**key, 'chunk': chunk})
+
+    def _delete_chunks(self, keys):
+        if not keys:
+            return
+        try:
+            with self.table.batch_writer() as batch:
+                for key in keys:
+                    batch.delete_item(Key=key)
+        except ClientError as e:
+            # Leftover chunks are unreferenced, so this only costs storage
+            self.logger.warning(f"Could not delete snapshot chunks: {e}")
+
     def __len__(self):
         return len(self.read())
+
+
+def _binary_value(value):
+    # boto3 wraps binary attributes in a Binary object
+    return bytes(getattr(value, 'value', value))
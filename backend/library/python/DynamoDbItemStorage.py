@@ -0,0 +1,275 @@
+import json
+import logging
+import uuid
+
+import boto3
+from boto3.dynamodb.conditions import Attr, ConditionExpressionBuilder, Key
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+from tinydb.storages import Storage
+
+from library.python.ConcurrentModificationError import ConcurrentModificationError
+from library.python.JournaledJSONStorage import copy_document, encode_document
+
+# Partition holding one item per TinyDB table, so tables can be listed without a scan, with the version of the
+# table's documents
+TABLES_PARTITION = '__tables__'
+
+# Most document writes sent in one TransactWriteItems call, DynamoDB's own limit
+TRANSACTION_MAX_ITEMS = 100
+
+# Most document bytes, new and expected content together, sent in one transaction: a little under DynamoDB's 4 MB,
+# to leave room for the keys
+TRANSACTION_MAX_BYTES = 4_000_000
+
+# Cancellation reasons meaning another writer got to an item first
+_CONFLICT_REASONS = {'ConditionalCheckFailed', 'TransactionConflict'}
+
+_SERIALIZER = TypeSerializer()
+
+
+class DynamoDbItemStorage(Storage):
+    """
+    A TinyDB storage that keeps every document in its own DynamoDB item
+
+    Items are keyed by ``table_name`` (partition key, the TinyDB table) and
+    ``doc_id`` (sort key, the TinyDB document id) and hold the document as a
+    JSON string in ``doc``. A table is loaded with a paginated query on its
+    partition. Writes are diffed against the state that was last read, and
+    only the documents that changed are sent. Concurrent writers touching
+    different documents therefore no longer overwrite each other, and the
+    database is not bound by the 400 KB item size limit.
+
+    Every write of a document is conditional on what was last read of it:
+    new documents must not exist yet, changed and removed ones must still
+    hold the content read. The writes are grouped into TransactWriteItems
+    calls of up to ``TRANSACTION_MAX_ITEMS``, so a bulk insert costs a
+    round trip per hundred documents rather than one per document; a
+    single write is sent on its own, as a transaction costs twice the
+    write capacity. A writer that lost a race to another gets a
+    ConcurrentModificationError, and IndexedTable retries the operation
+    against fresh data. The transactions committed before the conflict
+    stay written; they hold the full new state, so the retry finds them done.
+
+    The item registering a table in ``TABLES_PARTITION`` holds a
+    ``version``, which every write changing the table replaces after its
+    documents. A read queries that partition, then only the tables whose
+    version changed since they were last queried, and only decodes the
+    documents that changed; the others are kept decoded in memory, and
+    handed out as copies. A writer failing between its documents and the
+    version leaves them unseen by the other instances until the table
+    changes again; writing one of them still conflicts, and reloads it.
+
+    ``generation`` counts the reads that found documents written by someone
+    else, so IndexedTable drops its indexes and the next document id it
+    picked from the older data.
+
+    Attributes:
+    ----------
+    generation : int
+        bumped whenever a read finds documents different from those last read or written
+
+    Methods:
+    --------
+    read(self)
+        Loads the tables changed in DynamoDB since the last read
+
+    write(self, data)
+        Writes the documents that changed since the last read
+    """
+
+    def __init__(self, table_name, dynamodb=None):
+        self.dynamodb = dynamodb or boto3.resource('dynamodb')
+        self.table = self.dynamodb.Table(table_name)
+        self.logger = logging.getLogger()
+        self.last_read_bytes = 0
+        self.last_write_bytes = 0
+        self.generation = 0
+        self._documents = {}  # table name -> {doc id: serialized document} as last read or written
+        self._decoded = {}  # table name -> {doc id: decoded document}, never handed out
+        self._versions = {}  # table name -> version the documents are at, None if unknown
+
+    def read(self):
+        try:
+            versions = {name: item.get('version') for name, item in self._query_partition(TABLES_PARTITION).items()}
+            documents, decoded, read_bytes = {}, {}, 0
+            for name, version in versions.items():
+                if version is not None and version == self._versions.get(name):
+                    documents[name], decoded[name] = self._documents[name], self._decoded[name]
+                    continue
+                documents[name] = {doc_id: item['doc'] for doc_id, item in self._query_partition(name).items()}
+                stored, stored_decoded = self._documents.get(name, {}), self._decoded.get(name, {})
+                decoded[name] = {doc_id: stored_decoded[doc_id] if stored.get(doc_id) == document
+                                 else json.loads(document) for doc_id, document in documents[name].items()}
+                read_bytes += sum(len(document) for document in documents[name].values())
+        except ClientError as e:
+            # Don't return an empty database here: a following write would be diffed against it
+            self.logger.error(f"Error reading from DynamoDB: {e}")
+            raise
+
+        if documents != self._documents:
+            self.generation += 1
+        self._documents, self._decoded, self._versions = documents, decoded, versions
+        self.last_read_bytes = read_bytes
+        if not self._documents:
+            return None
+        return {
+            name: {doc_id: copy_document(document) for doc_id, document in table_documents.items()}
+            for name, table_documents in self._decoded.items()
+        }
+
+    def write(self, data):
+        state, state_decoded = {}, {}
+        puts, deletes = [], []  # (item or key, content expected)
+        changed = []  # tables whose version is replaced
+        dropped = [name for name in self._documents if name not in data]
+        for name in dropped:
+            deletes.extend(({'table_name': name, 'doc_id': doc_id}, encoded)
+                           for doc_id, encoded in self._documents[name].items())
+
+        for name, table_documents in data.items():
+            stored = self._documents.get(name)
+            if stored is None:
+                stored = {}
+                changed.append(name)
+            stored_decoded = self._decoded.get(name, {})
+            writes = len(puts) + len(deletes)
+
+            encoded_documents, decoded = state[name], state_decoded[name] = {}, {}
+            for doc_id, document in table_documents.items():
+                doc_id = str(doc_id)
+                # Comparing the decoded documents is much cheaper than serializing them all
+                if doc_id in stored_decoded and stored_decoded[doc_id] == document:
+                    encoded_documents[doc_id], decoded[doc_id] = stored[doc_id], stored_decoded[doc_id]
+                    continue
+                encoded = encoded_documents[doc_id] = encode_document(document)
+                # A copy of our own, as the caller may go on changing the document
+                decoded[doc_id] = json.loads(encoded)
+                if stored.get(doc_id) != encoded:
+                    puts.append(({'table_name': name, 'doc_id': doc_id, 'doc': encoded}, stored.get(doc_id)))
+            deletes.extend(({'table_name': name, 'doc_id': doc_id}, encoded)
+                           for doc_id, encoded in stored.items() if doc_id not in encoded_documents)
+            if len(puts) + len(deletes) > writes and name not in changed:
+                changed.append(name)
+
+        versions = dict(self._versions)
+        writes = [('Put', item, expected) for item, expected in puts]
+        writes.extend(('Delete', key, expected) for key, expected in deletes)
+        try:
+            for transaction in _transactions(writes):
+                self._write_transaction(transaction)
+            for name in changed:
+                versions[name] = self._replace_version(name, versions.get(name))
+            for name in dropped:
+                self.table.delete_item(Key={'table_name': TABLES_PARTITION, 'doc_id': name})
+                versions.pop(name, None)
+        except ClientError as e:
+            # Some documents may be written: load everything again on the next read
+            self._versions = {}
+            if _is_conflict(e):
+                raise ConcurrentModificationError("A document was changed concurrently") from e
+            self.logger.error(f"Error writing to DynamoDB: {e}")
+            raise
+
+        self._documents, self._decoded, self._versions = state, state_decoded, versions
+        self.last_write_bytes = sum(len(item['doc']) for item, _ in puts)
+
+    def _write_transaction(self, writes):
+        """
+        Sends conditional document writes, given as (action, item or key, content expected), all or none applied
+        """
+        if len(writes) == 1:
+            (action, target, expected), = writes
+            if action == 'Put':
+                self.table.put_item(Item=target, ConditionExpression=_unchanged(expected))
+            else:
+                self.table.delete_item(Key=target, ConditionExpression=_unchanged(expected))
+            return
+
+        transact_items = []
+        for action, target, expected in writes:
+            condition = ConditionExpressionBuilder().build_expression(_unchanged(expected))
+            request = {
+                'TableName': self.table.name,
+                'Item' if action == 'Put' else 'Key': _serialize(target),
+                'ConditionExpression': condition.condition_expression,
+                'ExpressionAttributeNames': condition.attribute_name_placeholders,
+            }
+            if condition.attribute_value_placeholders:
+                request['ExpressionAttributeValues'] = _serialize(condition.attribute_value_placeholders)
+            transact_items.append({action: request})
+        self.dynamodb.meta.client.transact_write_items(TransactItems=transact_items)
+
+    def _replace_version(self, name, expected):
+        """
+        Gives a table a new version once its documents are written
+
+        Returns the new version, or None if another writer changed the table
+        since it was last read, whose documents then have to be queried again.
+        """
+        item = {'table_name': TABLES_PARTITION, 'doc_id': name, 'version': uuid.uuid4().hex}
+        condition = Attr('version').not_exists() if expected is None else Attr('version').eq(expected)
+        try:
+            self.table.put_item(Item=item, ConditionExpression=condition)
+            return item['version']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        # Still replaced, as the other writer may have set its version before we wrote our documents
+        item['version'] = uuid.uuid4().hex
+        self.table.put_item(Item=item)
+        return None
+
+    def _query_partition(self, name):
+        """
+        Returns all items of a partition, keyed by doc_id
+        """
+        items = {}
+        kwargs = {'KeyConditionExpression': Key('table_name').eq(name), 'ConsistentRead': True}
+        while True:
+            response = self.table.query(**kwargs)
+            for item in response['Items']:
+                items[item['doc_id']] = item
+            if 'LastEvaluatedKey' not in response:
+                return items
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def _transactions(writes):
+    """
+    Splits document writes into groups that fit in one transaction each
+    """
+    transaction, size = [], 0
+    for write in writes:
+        _, target, expected = write
+        write_size = len(target.get('doc', '')) + len(expected or '')
+        if transaction and (len(transaction) == TRANSACTION_MAX_ITEMS or size + write_size > TRANSACTION_MAX_BYTES):
+            yield transaction
+            transaction, size = [], 0
+        transaction.append(write)
+        size += write_size
+    if transaction:
+        yield transaction
+
+
+def _serialize(values):
+    return {name: _SERIALIZER.serialize(value) for name, value in values.items()}
+
+
+def _is_conflict(error):
+    """
+    Tells whether a failed write lost a race to another writer
+    """
+    code = error.response['Error']['Code']
+    if code == 'TransactionCanceledException':
+        return any(reason.get('Code') in _CONFLICT_REASONS for reason in error.response.get('CancellationReasons', []))
+    return code == 'ConditionalCheckFailedException'
+
+
+def _unchanged(expected):
+    """
+    Returns the condition that a document still holds what was last read of it, or doesn't exist if nothing was
+    """
+    if expected is None:
+        return Attr('doc_id').not_exists()
+    return Attr('doc').eq(expected)
@@ -0,0 +1,297 @@
+import copy
+import re
+from decimal import Decimal
+from types import SimpleNamespace
+
+from boto3.dynamodb.conditions import AttributeBase
+from boto3.dynamodb.table import BatchWriter
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+_DESERIALIZER = TypeDeserializer()
+
+
+def _to_dynamodb_value(value):
+    # DynamoDB hands numbers back as Decimal, so store them that way too
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {key: _to_dynamodb_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_dynamodb_value(item) for item in value]
+    return value
+
+
+def _evaluate(condition, item):
+    """
+    Evaluates a boto3 condition object (Key/Attr expressions) against an item
+    """
+    name = type(condition).__name__
+    values = condition.get_expression()['values']
+
+    def resolve(value):
+        if isinstance(value, AttributeBase):
+            return item.get(value.name)
+        return _to_dynamodb_value(value)
+
+    if name == 'And':
+        return _evaluate(values[0], item) and _evaluate(values[1], item)
+    if name == 'Or':
+        return _evaluate(values[0], item) or _evaluate(values[1], item)
+    if name == 'Not':
+        return not _evaluate(values[0], item)
+    if name == 'AttributeExists':
+        return values[0].name in item
+    if name == 'AttributeNotExists':
+        return values[0].name not in item
+
+    left = resolve(values[0])
+    if name == 'Equals':
+        return left == resolve(values[1])
+    if name == 'NotEquals':
+        return left != resolve(values[1])
+    if left is None:
+        return False
+    if name == 'LessThan':
+        return left < resolve(values[1])
+    if name == 'LessThanEquals':
+        return left <= resolve(values[1])
+    if name == 'GreaterThan':
+        return left > resolve(values[1])
+    if name == 'GreaterThanEquals':
+        return left >= resolve(values[1])
+    if name == 'Between':
+        return resolve(values[1]) <= left <= resolve(values[2])
+    if name == 'BeginsWith':
+        return left.startswith(resolve(values[1]))
+    raise NotImplementedError(f"Condition {name} is not supported by the in-memory DynamoDB")
+
+
+def _deserialize(item):
+    # The low-level client sends typed attribute values, e.g. {'S': 'text'}
+    return {name: _DESERIALIZER.deserialize(value) for name, value in item.items()}
+
+
+def _evaluate_expression(expression, names, values, item):
+    """
+    Evaluates a condition expression string, as sent through the low-level client, against an item
+
+    Only the expressions boto3 builds from a single exists/not_exists/eq/ne condition object are supported.
+    """
+    match = re.fullmatch(r'attribute_(not_)?exists\((#\w+)\)', expression)
+    if match:
+        return (names[match[2]] in item) != bool(match[1])
+    match = re.fullmatch(r'(#\w+) (=|<>) (:\w+)', expression)
+    if match:
+        equal = item.get(names[match[1]]) == _DESERIALIZER.deserialize(values[match[3]])
+        return equal == (match[2] == '=')
+    raise NotImplementedError(f"Condition expression {expression} is not supported by the in-memory DynamoDB")
+
+
+def _validation_error(operation_name, message):
+    return ClientError({'Error': {'Code': 'ValidationException', 'Message': message}}, operation_name)
+
+
+def _conditional_check_failed(operation_name):
+    return ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}},
+        operation_name)
+
+
+class InMemoryDynamoDbTable:
+    """
+    An in-memory stand-in for a boto3 DynamoDB ``Table`` resource
+
+    Supports the subset of the API the storages use: get_item, put_item and
+    delete_item (with condition objects), query on the partition key with
+    pagination, scan and batch_writer.
+
+    Attributes:
+    ----------
+    name : str
+        the name of the table
+    key_names : tuple
+        the partition key name, followed by the sort key name if there is one
+    page_size : int
+        the maximum number of items returned per query/scan page
+    """
+
+    def __init__(self, resource, name, key_names=('id',), page_size=100):
+        self.resource = resource
+        self.name = name
+        self.key_names = tuple(key_names)
+        self.page_size = page_size
+        self.items = {}
+
+    def _key(self, key):
+        return tuple(key[name] for name in self.key_names)
+
+    def get_item(self, Key, ConsistentRead=False, ProjectionExpression=None, **kwargs):
+        self.resource.record('GetItem', self.name)
+        item = self.items.get(self._key(Key))
+        if item is None:
+            return {}
+        if ProjectionExpression:
+            names = kwargs.get('ExpressionAttributeNames', {})
+            attributes = [names.get(name.strip(), name.strip()) for name in ProjectionExpression.split(',')]
+            item = {name: item[name] for name in attributes if name in item}
+        return {'Item': copy.deepcopy(item)}
+
+    def put_item(self, Item, ConditionExpression=None, **kwargs):
+        self.resource.record('PutItem', self.name)
+        key = self._key(Item)
+        if ConditionExpression is not None and not _evaluate(ConditionExpression, self.items.get(key, {})):
+            raise _conditional_check_failed('PutItem')
+        self.items[key] = _to_dynamodb_value(copy.deepcopy(Item))
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, **kwargs):
+        self.resource.record('DeleteItem', self.name)
+        key = self._key(Key)
+        if ConditionExpression is not None and not _evaluate(ConditionExpression, self.items.get(key, {})):
+            raise _conditional_check_failed('DeleteItem')
+        self.items.pop(key, None)
+        return {}
+
+    def query(self, KeyConditionExpression, ExclusiveStartKey=None, ConsistentRead=False, **kwargs):
+        self.resource.record('Query', self.name)
+        matches = sorted((key, item) for key, item in self.items.items() if _evaluate(KeyConditionExpression, item))
+        return self._page(matches, ExclusiveStartKey)
+
+    def scan(self, ExclusiveStartKey=None, ConsistentRead=False, **kwargs):
+        self.resource.record('Scan', self.name)
+        return self._page(sorted(self.items.items()), ExclusiveStartKey)
+
+    def _page(self, matches, exclusive_start_key):
+        if exclusive_start_key is not None:
+            start = self._key(exclusive_start_key)
+            matches = [(key, item) for key, item in matches if key > start]
+        page = matches[:self.page_size]
+        response = {'Items': [copy.deepcopy(item) for _, item in page], 'Count': len(page)}
+        if len(matches) > self.page_size:
+            response['LastEvaluatedKey'] = dict(zip(self.key_names, page[-1][0]))
+        return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return BatchWriter(self.name, self.resource, overwrite_by_pkeys=overwrite_by_pkeys)
+
+
+class InMemoryDynamoDbClient:
+    """
+    An in-memory stand-in for the low-level client behind ``boto3.resource('dynamodb')``
+
+    Reached as ``meta.client``, like on a boto3 resource, for the calls the
+    resource doesn't expose. Only supports transact_write_items with Put and
+    Delete actions. Its requests are counted in the resource's ``requests``.
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        self.resource.record('TransactWriteItems', None)
+        if len(TransactItems) > 100:
+            raise _validation_error('TransactWriteItems', 'Member must have length less than or equal to 100')
+        operations = []
+        for transact_item in TransactItems:
+            (action, request), = transact_item.items()
+            if action not in ('Put', 'Delete'):
+                raise NotImplementedError(f"Transaction action {action} is not supported by the in-memory DynamoDB")
+            table = self.resource.Table(request['TableName'])
+            operations.append((action, table, _deserialize(request['Item' if action == 'Put' else 'Key']), request))
+        keys = [(table.name, table._key(target)) for _, table, target, _ in operations]
+        if len(set(keys)) < len(keys):
+            raise _validation_error('TransactWriteItems',
+                                    'Transaction request cannot include multiple operations on one item')
+
+        reasons = []
+        for _, table, target, request in operations:
+            condition = request.get('ConditionExpression')
+            if condition is None or _evaluate_expression(condition, request.get('ExpressionAttributeNames', {}),
+                                                         request.get('ExpressionAttributeValues', {}),
+                                                         table.items.get(table._key(target), {})):
+                reasons.append({'Code': 'None'})
+            else:
+                reasons.append({'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'})
+        if any(reason['Code'] != 'None' for reason in reasons):
+            # Nothing is written when any condition fails
+            raise ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+                               'CancellationReasons': reasons}, 'TransactWriteItems')
+
+        for action, table, target, _ in operations:
+            if action == 'Put':
+                table.items[table._key(target)] = _to_dynamodb_value(target)
+            else:
+                table.items.pop(table._key(target), None)
+        return {}
+
+
+class InMemoryDynamoDb:
+    """
+    An in-memory stand-in for ``boto3.resource('dynamodb')``
+
+    Used by the tests and benchmarks to exercise the DynamoDB storages without
+    AWS. Every call is counted in ``requests`` so callers can assert how many
+    round trips an operation would cost.
+
+    Methods:
+    --------
+    create_table(self, TableName, KeySchema, **kwargs)
+        Creates a table with the given key schema
+
+    Table(self, name)
+        Returns a table, creating it with an ``id`` partition key if needed
+
+    batch_get_item(self, RequestItems)
+        Returns the requested items of one or more tables
+
+    batch_write_item(self, RequestItems)
+        Applies put and delete requests to one or more tables
+
+    The low-level ``meta.client`` provides transact_write_items.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.requests = {}
+        self.meta = SimpleNamespace(client=InMemoryDynamoDbClient(self))
+
+    def record(self, operation, table_name):
+        self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def create_table(self, TableName, KeySchema, page_size=100, **kwargs):
+        key_names = [key['AttributeName'] for key in sorted(KeySchema, key=lambda key: key['KeyType'] != 'HASH')]
+        self.tables[TableName] = InMemoryDynamoDbTable(self, TableName, key_names, page_size)
+        return self.tables[TableName]
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = InMemoryDynamoDbTable(self, name)
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.record('BatchGetItem', None)
+        if sum(len(request['Keys']) for request in RequestItems.values()) > 100:
+            raise _validation_error('BatchGetItem', 'Too many items requested')
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.Table(table_name)
+            items = [table.items.get(table._key(key)) for key in request['Keys']]
+            responses[table_name] = [copy.deepcopy(item) for item in items if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.record('BatchWriteItem', None)
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise _validation_error('BatchWriteItem', 'Too many items requested')
+        for table_name, requests in RequestItems.items():
+            table = self.Table(table_name)
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    table.items[table._key(item)] = _to_dynamodb_value(copy.deepcopy(item))
+                else:
+                    table.items.pop(table._key(request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': {}}
@@ -0,0 +1,412 @@
+import random
+import time
+from collections.abc import Mapping
+
+from tinydb import where
+from tinydb.table import Table
+
+from library.python.ChangeLog import LOGGED_FIELDS, record_changes
+from library.python.ConcurrentModificationError import ConcurrentModificationError
+
+# Fields that get an in-memory hash index, per table name
+INDEXED_FIELDS = {
+    'documents': ('id', 'userId', 'hashValue'),
+    'users': ('id', 'email'),
+    'uploads': ('id',),
+}
+
+# Only scalar comparison values can be looked up in a hash index
+INDEXABLE_TYPES = (str, int, float, bool, type(None))
+
+
+class IndexedTable(Table):
+    """
+    A TinyDB Table that keeps in-memory hash indexes on declared fields
+
+    Equality queries on indexed fields (``Query().id == x``) and ``&``/``|``
+    combinations of them are answered by probing the indexes instead of
+    scanning the whole table. Every other condition falls back to the regular
+    TinyDB scan. Candidates found through an index are still checked against
+    the full condition, so an index never returns a document that doesn't
+    match; a stale one would miss documents, though.
+
+    Storages that load data written by other processes expose a
+    ``generation`` counter, which every storage of the application does;
+    when it changes the indexes and the query cache are dropped. Writes
+    rejected with a ConcurrentModificationError are retried against fresh
+    data.
+
+    Writes to the tables listed in ChangeLog.LOGGED_FIELDS also append an
+    entry to the change log, in the same storage write, so that other
+    processes can tell which documents changed.
+
+    Attributes:
+    ----------
+    indexed_fields : tuple
+        the document fields that are indexed for this table
+
+    Methods:
+    --------
+    search(self, cond)
+        Searches for documents matching a condition, using the indexes if possible
+
+    get(self, cond=None, doc_id=None, doc_ids=None)
+        Gets one document matching a condition, using the indexes if possible
+
+    search_any(self, field, values)
+        Searches for documents whose field has any of the given values
+
+    invalidate_indexes(self)
+        Drops the indexes so they are rebuilt from storage on the next lookup
+    """
+
+    #: How often a write rejected by a concurrent writer is attempted in total
+    max_write_attempts = 5
+
+    def __init__(self, storage, name, cache_size=Table.default_query_cache_capacity, indexed_fields=None):
+        super().__init__(storage, name, cache_size)
+        if indexed_fields is None:
+            indexed_fields = INDEXED_FIELDS.get(name, ())
+        self.indexed_fields = tuple(indexed_fields)
+        self._indexes = None  # field -> value -> set of (string) doc ids
+        self._indexed_values = None  # doc id -> {field: value}
+        self._indexed_count = 0
+        self._storage_generation = None
+        self._changing_ids = ()  # ids of the documents the next write updates in place
+
+    def search(self, cond):
+        """
+        Searches for documents matching a condition
+
+        Parameters:
+        -----------
+        cond : Query
+            the condition to check against
+
+        Returns:
+        --------
+        documents : list
+            a list of matching tinydb Documents, in document id order
+        """
+        hashval = getattr(cond, '_hash', None)
+        if not self._is_indexable(hashval):
+            return super().search(cond)
+
+        table = self._read_table()
+        self._ensure_indexes(table)
+        doc_ids = self._candidates(hashval)
+
+        documents = []
+        for doc_id in sorted(doc_ids, key=self.document_id_class):
+            doc = table.get(doc_id)
+            if doc is not None and cond(doc):
+                documents.append(self.document_class(doc, self.document_id_class(doc_id)))
+        return documents
+
+    def search_any(self, field, values):
+        """
+        Searches for documents whose field has any of the given values
+
+        On an indexed field this is one read and one index probe per value,
+        where the equivalent ``|`` of equality queries grows with every value.
+
+        Parameters:
+        -----------
+        field : str
+            the field to match
+        values : iterable
+            the values to look for
+
+        Returns:
+        --------
+        documents : list
+            a list of matching tinydb Documents, in document id order
+        """
+        values = set(values)
+        if field not in self.indexed_fields or not all(isinstance(value, INDEXABLE_TYPES) for value in values):
+            return super().search(where(field).one_of(list(values)))
+
+        table = self._read_table()
+        self._ensure_indexes(table)
+        doc_ids = set().union(*(self._indexes[field].get(value, ()) for value in values))
+
+        documents = []
+        for doc_id in sorted(doc_ids, key=self.document_id_class):
+            doc = table.get(doc_id)
+            if doc is not None and doc.get(field) in values:
+                documents.append(self.document_class(doc, self.document_id_class(doc_id)))
+        return documents
+
+    def get(self, cond=None, doc_id=None, doc_ids=None):
+        if cond is not None and doc_id is None and doc_ids is None \
+                and self._is_indexable(getattr(cond, '_hash', None)):
+            documents = self.search(cond)
+            return documents[0] if documents else None
+        return super().get(cond, doc_id, doc_ids)
+
+    def insert(self, document):
+        doc_id = self._retry_on_conflict(super().insert, document)
+        self._index_document(str(doc_id), document)
+        return doc_id
+
+    def insert_multiple(self, documents):
+        documents = list(documents)
+        doc_ids = self._retry_on_conflict(super().insert_multiple, documents)
+        for doc_id, document in zip(doc_ids, documents):
+            self._index_document(str(doc_id), document)
+        return doc_ids
+
+    def update(self, fields, cond=None, doc_ids=None):
+        updated_ids = self._retry_on_conflict(self._update, fields, cond, doc_ids)
+
+        if isinstance(fields, Mapping):
+            for doc_id in updated_ids:
+                self._reindex_document(str(doc_id), fields)
+        else:
+            # We can't tell which fields a callable has changed
+            self.invalidate_indexes()
+        return updated_ids
+
+    def update_multiple(self, updates):
+        updates = list(updates)
+        updated_ids = self._retry_on_conflict(self._update_multiple, updates)
+        self.invalidate_indexes()
+        return updated_ids
+
+    def remove(self, cond=None, doc_ids=None):
+        removed_ids = self._retry_on_conflict(self._remove, cond, doc_ids)
+        for doc_id in removed_ids:
+            self._unindex_document(str(doc_id))
+        return removed_ids
+
+    def truncate(self):
+        self._retry_on_conflict(super().truncate)
+        self.invalidate_indexes()
+
+    def invalidate_indexes(self):
+        """
+        Drops the indexes so they are rebuilt from storage on the next lookup
+        """
+        self._indexes = None
+        self._indexed_values = None
+        self._indexed_count = 0
+
+    def _update(self, fields, cond, doc_ids):
+        doc_ids = self._resolve_doc_ids(cond, doc_ids)
+        if doc_ids is None and self.name in LOGGED_FIELDS:
+            # The change log needs to know which documents the update changes
+            doc_ids = [document.doc_id for document in super().search(cond)]
+        if doc_ids is not None and not doc_ids:
+            # Nothing matches, so there is no need to rewrite the storage
+            return []
+        self._changing_ids = doc_ids or ()
+        return super().update(fields, cond, doc_ids)
+
+    def _update_multiple(self, updates):
+        if self.name in LOGGED_FIELDS:
+            self._changing_ids = sorted({document.doc_id for _, cond in updates for document in self.search(cond)})
+        return super().update_multiple(updates)
+
+    def _remove(self, cond, doc_ids):
+        doc_ids = self._resolve_doc_ids(cond, doc_ids)
+        if doc_ids is not None and not doc_ids:
+            return []
+        return super().remove(cond, doc_ids)
+
+    def _retry_on_conflict(self, operation, *args):
+        """
+        Runs a write operation, re-running it against fresh data when the
+        storage reports that another writer got there first
+        """
+        for attempt in range(self.max_write_attempts):
+            try:
+                result = operation(*args)
+                break
+            except ConcurrentModificationError:
+                if attempt == self.max_write_attempts - 1:
+                    raise
+                self._forget_storage_state()
+                # Back off with jitter so competing writers don't collide again
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        self._check_generation()
+        return result
+
+    def _read_table(self):
+        table = super()._read_table()
+        self._check_generation()
+        return table
+
+    def _update_table(self, updater):
+        def checked_updater(table):
+            # The read TinyDB just did may have loaded someone else's changes,
+            # while document ids were picked from the older data
+            if self._check_generation():
+                raise ConcurrentModificationError("Stored data changed while the write was prepared")
+            updater(table)
+
+        logged_fields = LOGGED_FIELDS.get(self.name)
+        if logged_fields is None:
+            super()._update_table(checked_updater)
+            return
+
+        # Table._update_table, noting the documents the updater changes for the change log
+        changing_ids, self._changing_ids = self._changing_ids, ()
+        tables = self._storage.read() or {}
+        table = _ChangeTrackingTable((self.document_id_class(doc_id), doc)
+                                     for doc_id, doc in tables.get(self.name, {}).items())
+        updated = [table[doc_id] for doc_id in changing_ids if doc_id in table]
+        before = [{field: document.get(field) for field in logged_fields} for document in updated]
+        checked_updater(table)
+        tables[self.name] = {str(doc_id): doc for doc_id, doc in table.items()}
+
+        if table.cleared:
+            record_changes(tables, self.name, None)
+        else:
+            changed = {}
+            for document in before + updated + table.changed:
+                values = {field: document.get(field) for field in logged_fields}
+                changed.setdefault(tuple(values.values()), values)
+            if changed:
+                record_changes(tables, self.name, list(changed.values()))
+        self._storage.write(tables)
+        self.clear_cache()
+
+    def _check_generation(self):
+        """
+        Drops derived state if the storage has loaded data written elsewhere
+
+        Returns True if state derived from earlier data had to be dropped.
+        """
+        generation = getattr(self._storage, 'generation', None)
+        if generation == self._storage_generation:
+            return False
+        changed = self._storage_generation is not None
+        self._storage_generation = generation
+        self._forget_storage_state()
+        return changed
+
+    def _forget_storage_state(self):
+        # Everything derived from the stored data may be outdated
+        self._next_id = None
+        self.clear_cache()
+        self.invalidate_indexes()
+
+    def _resolve_doc_ids(self, cond, doc_ids):
+        """
+        Turns an indexable condition into the list of matching document ids
+
+        Returns the given doc_ids unchanged when the condition can't be
+        answered from the indexes, so the caller falls back to a scan.
+        """
+        if doc_ids is not None or cond is None:
+            return doc_ids
+        if not self._is_indexable(getattr(cond, '_hash', None)):
+            return None
+        return [document.doc_id for document in self.search(cond)]
+
+    def _is_indexable(self, hashval):
+        """
+        Checks whether a query hash can be answered from the indexes
+
+        ``==`` on an indexed field is indexable, ``&`` is indexable when at
+        least one side is, and ``|`` only when every side is.
+        """
+        if not self.indexed_fields or not isinstance(hashval, tuple) or not hashval:
+            return False
+        operator = hashval[0]
+        if operator == '==':
+            _, path, value = hashval
+            return len(path) == 1 and path[0] in self.indexed_fields and isinstance(value, INDEXABLE_TYPES)
+        if operator == 'and':
+            return any(self._is_indexable(part) for part in hashval[1])
+        if operator == 'or':
+            return all(self._is_indexable(part) for part in hashval[1])
+        return False
+
+    def _candidates(self, hashval):
+        """
+        Returns the set of document ids that may match an indexable query hash
+        """
+        operator = hashval[0]
+        if operator == '==':
+            _, path, value = hashval
+            return self._indexes[path[0]].get(value, set())
+        if operator == 'and':
+            parts = sorted((self._candidates(part) for part in hashval[1] if self._is_indexable(part)), key=len)
+            return parts[0].intersection(*parts[1:])
+        # 'or'
+        return set().union(*(self._candidates(part) for part in hashval[1]))
+
+    def _ensure_indexes(self, table):
+        # Changes written elsewhere are caught by the storage generation. The size check only
+        # covers storages without one, and misses a removal followed by an insert
+        if self._indexes is None or len(table) != self._indexed_count:
+            self._build_indexes(table)
+
+    def _build_indexes(self, table):
+        self._indexes = {field: {} for field in self.indexed_fields}
+        self._indexed_values = {}
+        self._indexed_count = 0
+        for doc_id, doc in table.items():
+            self._index_document(doc_id, doc)
+
+    def _index_document(self, doc_id, document):
+        if self._indexes is None:
+            return
+        values = {}
+        for field in self.indexed_fields:
+            value = document.get(field)
+            if field in document and isinstance(value, INDEXABLE_TYPES):
+                self._indexes[field].setdefault(value, set()).add(doc_id)
+                values[field] = value
+        self._indexed_values[doc_id] = values
+        self._indexed_count += 1
+
+    def _unindex_document(self, doc_id):
+        if self._indexes is None:
+            return
+        values = self._indexed_values.pop(doc_id, None)
+        if values is None:
+            return
+        for field, value in values.items():
+            bucket = self._indexes[field].get(value)
+            if bucket is not None:
+                bucket.discard(doc_id)
+                if not bucket:
+                    del self._indexes[field][value]
+        self._indexed_count -= 1
+
+    def _reindex_document(self, doc_id, fields):
+        if self._indexes is None or doc_id not in self._indexed_values:
+            return
+        if not any(field in fields for field in self.indexed_fields):
+            return
+        document = {**self._indexed_values[doc_id], **fields}
+        self._unindex_document(doc_id)
+        self._index_document(doc_id, document)
+
+
+class _ChangeTrackingTable(dict):
+    """
+    The table TinyDB's write operations run on, noting the documents they insert or remove
+    """
+
+    def __init__(self, items):
+        super().__init__(items)
+        self.changed = []  # documents inserted, replaced or removed
+        self.cleared = False
+
+    def __setitem__(self, doc_id, document):
+        if doc_id in self:
+            self.changed.append(self[doc_id])
+        super().__setitem__(doc_id, document)
+        self.changed.append(document)
+
+    def pop(self, doc_id, *default):
+        if doc_id in self:
+            self.changed.append(self[doc_id])
+        return super().pop(doc_id, *default)
+
+    def clear(self):
+        self.cleared = True
+        super().clear()
@@ -0,0 +1,38 @@
+from tinydb.middlewares import Middleware
+
+from library.python.Metrics import METRICS
+
+
+class InstrumentedMiddleware(Middleware):
+    """
+    A TinyDB middleware timing the reads and writes of the storage it wraps, and counting their bytes
+
+    It goes directly around the storage, inside the write-behind cache, so
+    it sees the reads and writes that reach the file or DynamoDB, not the
+    ones the cache answers. Bytes are taken from the storage's
+    ``last_read_bytes`` and ``last_write_bytes``, where it has them.
+
+    Attributes:
+    ----------
+    metrics : Metrics
+        the registry to record to
+    """
+
+    def __init__(self, storage_cls, metrics=METRICS):
+        super().__init__(storage_cls)
+        self.metrics = metrics
+
+    def read(self):
+        name = type(self.storage).__name__
+        with self.metrics.time('storage_operation_duration_seconds', storage=name, operation='read'):
+            data = self.storage.read()
+        self.metrics.inc('storage_bytes_total', getattr(self.storage, 'last_read_bytes', 0), storage=name,
+                         operation='read')
+        return data
+
+    def write(self, data):
+        name = type(self.storage).__name__
+        with self.metrics.time('storage_operation_duration_seconds', storage=name, operation='write'):
+            self.storage.write(data)
+        self.metrics.inc('storage_bytes_total', getattr(self.storage, 'last_write_bytes', 0), storage=name,
+                         operation='write')
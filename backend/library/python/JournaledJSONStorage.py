@@ -0,0 +1,335 @@
+import json
+import logging
+import os
+import threading
+
+from tinydb.storages import Storage, touch
+
+
+def encode_document(document):
+    """
+    Serializes a single document the way it is stored in the journal and snapshot
+    """
+    return json.dumps(document, ensure_ascii=False, separators=(',', ':'))
+
+
+def copy_document(value):
+    """
+    Copies a decoded JSON value, so the copy can be changed without changing the original
+
+    Faster than decoding the document again, or than copy.deepcopy.
+    """
+    if type(value) is dict:
+        return {key: copy_document(item) for key, item in value.items()}
+    if type(value) is list:
+        return [copy_document(item) for item in value]
+    return value
+
+
+class JournaledJSONStorage(Storage):
+    """
+    A TinyDB storage that appends changes to a JSON-lines journal instead of
+    rewriting the whole database file on every write
+
+    The database file (``path``) holds a snapshot in the regular TinyDB JSON
+    format. Every ``write`` is diffed against the current state and only the
+    changed documents are appended to ``<path>.journal`` as one JSON line. On
+    startup the snapshot is loaded and the journal replayed on top of it. Once
+    the journal grows past ``compact_threshold`` bytes a background thread
+    writes a new snapshot (temp file, fsync, atomic rename) and discards the
+    journal entries it covers.
+
+    Journal records hold the full new state of a document, so replaying a
+    record twice is harmless. This is what makes a crash at any point during
+    compaction recoverable.
+
+    The storage keeps the database state in memory, both serialized and
+    decoded. A read hands out copies of the decoded documents, as TinyDB
+    updates the documents it reads in place, and a write only serializes
+    the documents that no longer equal their decoded state. A value replaced
+    by an equal one of another type, e.g. 1 by 1.0, is therefore not written.
+
+    Every read first picks up what other processes appended to the journal
+    since, and reloads everything if one of them compacted it, bumping
+    ``generation`` so IndexedTable drops the indexes it built from the older
+    state. Two processes writing at once can still lose updates, as with
+    the JSON storage, so keep one writer.
+
+    Attributes:
+    ----------
+    generation : int
+        bumped whenever a read finds changes written by another process
+
+    Methods:
+    --------
+    read(self)
+        Returns the current database state
+
+    write(self, data)
+        Appends the difference between data and the current state to the journal
+
+    compact(self)
+        Writes a new snapshot and truncates the journal
+
+    close(self)
+        Compacts the journal and closes the storage
+    """
+
+    def __init__(self, path, create_dirs=False, encoding='utf-8', compact_threshold=4 * 1024 * 1024,
+                 fsync_writes=False, background_compaction=True, **kwargs):
+        super().__init__()
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.rotated_journal_path = f"{path}.journal.1"
+        self.encoding = encoding
+        self.compact_threshold = compact_threshold
+        self.fsync_writes = fsync_writes
+        self.background_compaction = background_compaction
+        self.logger = logging.getLogger()
+        self.last_write_bytes = 0
+        self.generation = 0
+
+        self._lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+        self._tables = {}  # table name -> {doc id: serialized document}
+        self._documents = {}  # table name -> {doc id: decoded document}, never handed out
+
+        touch(path, create_dirs=create_dirs)
+        self._load()
+        self._journal = open(self.journal_path, 'ab')
+        self._journal_size = self._journal.tell()  # bytes of the journal applied to the state
+
+    def read(self):
+        with self._lock:
+            if self._catch_up():
+                self.generation += 1
+            if not self._tables:
+                return None
+            return {
+                name: {doc_id: copy_document(document) for doc_id, document in documents.items()}
+                for name, documents in self._documents.items()
+            }
+
+    def write(self, data):
+        with self._lock:
+            records = []
+            for name in list(self._tables):
+                if name not in data:
+                    del self._tables[name]
+                    del self._documents[name]
+                    records.append('{"op":"drop","table":%s}' % json.dumps(name))
+
+            for name, documents in data.items():
+                stored = self._tables.get(name)
+                if stored is None:
+                    stored = self._tables[name] = {}
+                    self._documents[name] = {}
+                    records.append('{"op":"create","table":%s}' % json.dumps(name))
+                decoded = self._documents[name]
+
+                doc_ids = set()
+                for doc_id, document in documents.items():
+                    doc_id = str(doc_id)
+                    doc_ids.add(doc_id)
+                    # Comparing the decoded documents is much cheaper than serializing them all
+                    if decoded.get(doc_id, _MISSING) == document:
+                        continue
+                    encoded = encode_document(document)
+                    if stored.get(doc_id) != encoded:
+                        stored[doc_id] = encoded
+                        records.append('{"op":"put","table":%s,"id":%s,"doc":%s}'
+                                       % (json.dumps(name), json.dumps(doc_id), encoded))
+                    # A copy of our own, as the caller may go on changing the document
+                    decoded[doc_id] = json.loads(encoded)
+
+                if len(doc_ids) < len(stored):
+                    for doc_id in [doc_id for doc_id in stored if doc_id not in doc_ids]:
+                        del stored[doc_id]
+                        del decoded[doc_id]
+                        records.append('{"op":"del","table":%s,"id":%s}' % (json.dumps(name), json.dumps(doc_id)))
+
+            if not records:
+                self.last_write_bytes = 0
+                return
+
+            # One line per write keeps the operation atomic on replay: a torn
+            # last line is simply dropped
+            line = ('{"ops":[%s]}\n' % ','.join(records)).encode(self.encoding)
+            self._journal.write(line)
+            self._journal.flush()
+            if self.fsync_writes:
+                os.fsync(self._journal.fileno())
+            # If another process appended meanwhile, the next read replays from before its line, then ours
+            # again, which leaves the state in the order of the journal
+            if os.fstat(self._journal.fileno()).st_size == self._journal_size + len(line):
+                self._journal_size += len(line)
+            self.last_write_bytes = len(line)
+
+        if self._journal_size >= self.compact_threshold:
+            if self.background_compaction:
+                self._start_background_compaction()
+            else:
+                self.compact()
+
+    def compact(self):
+        """
+        Writes a new snapshot of the current state and truncates the journal
+
+        The current journal is first rotated to ``<path>.journal.1`` so writes
+        can continue while the snapshot is written. The snapshot goes to a
+        temp file that is fsynced and atomically renamed over ``path``; only
+        then is the rotated journal deleted.
+        """
+        with self._compaction_lock:
+            with self._lock:
+                self._rotate_journal()
+                tables = {name: dict(documents) for name, documents in self._tables.items()}
+
+            self._write_snapshot(tables)
+            os.remove(self.rotated_journal_path)
+
+    def close(self):
+        if self._journal_size or os.path.exists(self.rotated_journal_path):
+            self.compact()
+        with self._lock:
+            self._journal.close()
+
+    def _start_background_compaction(self):
+        if self._compaction_lock.locked():
+            return
+        thread = threading.Thread(target=self._compact_in_background, name='journal-compaction', daemon=True)
+        thread.start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            self.logger.error(f"Error compacting journal {self.journal_path}: {e}")
+
+    def _rotate_journal(self):
+        self._journal.close()
+        if os.path.exists(self.rotated_journal_path):
+            # A previous compaction did not finish; keep its entries in order
+            with open(self.journal_path, 'rb') as source, open(self.rotated_journal_path, 'ab') as target:
+                target.write(source.read())
+                target.flush()
+                os.fsync(target.fileno())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.rotated_journal_path)
+        self._journal = open(self.journal_path, 'ab')
+        self._journal_size = 0
+
+    def _write_snapshot(self, tables):
+        parts = []
+        for name, documents in tables.items():
+            entries = ','.join(f"{json.dumps(doc_id)}:{document}" for doc_id, document in documents.items())
+            parts.append(f"{json.dumps(name)}:{{{entries}}}")
+        content = ('{%s}' % ','.join(parts)).encode(self.encoding)
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'wb') as handle:
+            handle.write(content)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, self.path)
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        except OSError:
+            return  # Directories can't be opened on Windows
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _load(self):
+        with open(self.path, 'r', encoding=self.encoding) as handle:
+            content = handle.read()
+        if content.strip():
+            for name, documents in json.loads(content).items():
+                self._documents[name] = {str(doc_id): document for doc_id, document in documents.items()}
+                self._tables[name] = {doc_id: encode_document(document)
+                                      for doc_id, document in self._documents[name].items()}
+
+        for journal_path in (self.rotated_journal_path, self.journal_path):
+            if os.path.exists(journal_path):
+                self._replay(journal_path)
+
+    def _replay(self, journal_path):
+        with open(journal_path, 'rb') as handle:
+            content = handle.read()
+
+        offset = 0
+        for line in content.splitlines(keepends=True):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Torn write from a crash: drop it and everything after it
+                self.logger.warning(f"Discarding incomplete journal entry in {journal_path} at byte {offset}")
+                with open(journal_path, 'r+b') as handle:
+                    handle.truncate(offset)
+                return
+            if not line.endswith(b'\n'):
+                # Complete JSON but no newline; terminate it so appends start on a new line
+                with open(journal_path, 'ab') as handle:
+                    handle.write(b'\n')
+            self._apply(entry['ops'])
+            offset += len(line)
+
+    def _catch_up(self):
+        """
+        Applies what other processes wrote since the state was last read or written
+
+        Returns True if the state was changed.
+        """
+        try:
+            current = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return False  # another process is rotating the journal, its changes are read next time
+        opened = os.fstat(self._journal.fileno())
+        if (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+            # Another process compacted: its snapshot and new journal replace everything
+            self._journal.close()
+            self._tables = {}
+            self._documents = {}
+            self._load()
+            self._journal = open(self.journal_path, 'ab')
+            self._journal_size = self._journal.tell()
+            return True
+        if current.st_size <= self._journal_size:
+            return False
+
+        with open(self.journal_path, 'rb') as handle:
+            handle.seek(self._journal_size)
+            content = handle.read(current.st_size - self._journal_size)
+        # A line still being written is left for the next read
+        content = content[:content.rfind(b'\n') + 1]
+        for line in content.splitlines():
+            self._apply(json.loads(line)['ops'])
+        self._journal_size += len(content)
+        return bool(content)
+
+    def _apply(self, records):
+        for record in records:
+            name = record['table']
+            if record['op'] == 'drop':
+                self._tables.pop(name, None)
+                self._documents.pop(name, None)
+            elif record['op'] == 'create':
+                self._tables.setdefault(name, {})
+                self._documents.setdefault(name, {})
+            elif record['op'] == 'put':
+                self._tables.setdefault(name, {})[record['id']] = encode_document(record['doc'])
+                self._documents.setdefault(name, {})[record['id']] = record['doc']
+            elif record['op'] == 'del':
+                self._tables.get(name, {}).pop(record['id'], None)
+                self._documents.get(name, {}).pop(record['id'], None)
+
+
+# Stands for a document the storage doesn't hold, which no document equals
+_MISSING = object()
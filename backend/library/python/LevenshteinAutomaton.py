@@ -0,0 +1,153 @@
+import heapq
+
+from library.python.SearchRanking import rank_key
+
+
+class LevenshteinAutomaton:
+    """
+    Matches strings within an edit budget of a query, one character at a time
+
+    A state is one row of the Levenshtein dynamic programming table: entry i
+    is the edit distance between the first i characters of the query and the
+    characters fed so far, capped at max_edits + 1. Walking a trie, each
+    node's row is computed from its parent's, and a branch is abandoned as soon
+    as no entry of the row is within the budget, since the distance can only
+    grow from there.
+
+    Attributes:
+    ----------
+    query : str
+        the string to match against
+    max_edits : int
+        the largest edit distance that still counts as a match
+
+    Methods:
+    --------
+    start(self)
+        Returns the state before any character has been fed
+
+    step(self, row, char)
+        Returns the state after feeding one more character
+
+    can_match(self, row)
+        Checks whether strings continuing from a state can still match
+    """
+
+    def __init__(self, query, max_edits):
+        self.query = query
+        self.max_edits = max_edits
+        # Capped rows repeat a lot across a trie, so transitions are computed
+        # once per (row, character), which turns the rows into a lazily built DFA
+        self._transitions = {}
+        self._dead = set()  # rows from which no string can match any more
+
+    def start(self):
+        return tuple(range(len(self.query) + 1))
+
+    def step(self, row, char):
+        new_row = self._transitions.get((row, char))
+        if new_row is None:
+            new_row = self._transitions[(row, char)] = self._compute_step(row, char)
+        return new_row
+
+    def can_match(self, row):
+        return row not in self._dead
+
+    def _compute_step(self, row, char):
+        # Only entries within max_edits of the diagonal can be within budget,
+        # the others are capped at max_edits + 1 without being computed
+        query, over_budget = self.query, self.max_edits + 1
+        depth = row[0] + 1
+        new_row = [depth] + [over_budget] * len(query)
+        for index in range(max(1, depth - self.max_edits), min(len(query), depth + self.max_edits) + 1):
+            distance = row[index - 1] if query[index - 1] == char else row[index - 1] + 1
+            if row[index] + 1 < distance:
+                distance = row[index] + 1
+            if new_row[index - 1] + 1 < distance:
+                distance = new_row[index - 1] + 1
+            new_row[index] = distance if distance < over_budget else over_budget
+        new_row = tuple(new_row)
+        if min(new_row) > self.max_edits:
+            self._dead.add(new_row)
+        return new_row
+
+
+def fuzzy_search_page(root, query, max_edits, limit, edge_label, ranked_documents):
+    """
+    Finds the documents of a title trie whose title starts with something
+    within max_edits edits of the query
+
+    The trie is walked with a LevenshteinAutomaton, so only branches that
+    can still match are visited. Once a branch can't be extended within the
+    budget, every document below it matches at the best distance seen on the
+    way, so its documents are taken from the ranked walk of that subtree and
+    its size from the node counts, without visiting it character by character.
+
+    Parameters:
+    -----------
+    root : TrieNode or RadixTrieNode
+        the root of the trie
+    query : str
+        the normalized text typed by the user
+    max_edits : int
+        the largest edit distance that still counts as a match
+    limit : int
+        the maximum number of documents to return, None for all of them
+    edge_label : callable
+        returns the characters on the edge to a child, given its key and the child
+    ranked_documents : callable
+        yields the (rank key, document) pairs below a node at a depth, best ranked first
+
+    Returns:
+    --------
+    matches : list
+        (document, edit distance) pairs, closest first and then in rank order
+    total : int
+        the number of documents that match
+    """
+    automaton = LevenshteinAutomaton(query, max_edits)
+    subtrees = {}  # distance -> [(node, depth, whether its whole subtree matches)]
+    row = automaton.start()
+    if root.is_end_of_word and row[-1] <= max_edits:
+        subtrees.setdefault(row[-1], []).append((root, 0, False))
+    stack = [(root, 0, row, row[-1])]
+    while stack:
+        node, depth, row, best = stack.pop()
+        for key, child in node.children.items():
+            label = edge_label(key, child)
+            child_row, child_best, alive = row, best, True
+            for char in label:
+                child_row = automaton.step(child_row, char)
+                if child_row[-1] < child_best:
+                    child_best = child_row[-1]
+                if not automaton.can_match(child_row):
+                    alive = False
+                    break
+            child_depth = depth + len(label)
+            if alive:
+                if child.is_end_of_word and child_best <= max_edits:
+                    # Deeper documents may match more closely, so keep walking
+                    subtrees.setdefault(child_best, []).append((child, child_depth, False))
+                stack.append((child, child_depth, child_row, child_best))
+            elif child_best <= max_edits:
+                subtrees.setdefault(child_best, []).append((child, child_depth, True))
+
+    matches = []
+    total = 0
+    for distance in sorted(subtrees):
+        sources = []
+        for node, depth, whole_subtree in subtrees[distance]:
+            if whole_subtree:
+                total += node.count
+                sources.append(ranked_documents(node, depth))
+            else:
+                total += 1
+                sources.append(iter([(rank_key(depth, node.document), node.document)]))
+        if limit is not None and len(matches) == limit:
+            continue
+        for _, document in heapq.merge(*sources, key=lambda pair: pair[0]):
+            if limit is not None and len(matches) == limit:
+                break
+            matches.append((document, distance))
+    return matches, total
+
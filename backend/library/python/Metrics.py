@@ -0,0 +1,367 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# Off by default; when off the hooks return before taking a lock, and the storages aren't wrapped
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+
+# Whether to log a structured line per request, with the time it spent in storage, hashing, S3 and the tries
+METRICS_LOG_REQUESTS = os.environ.get('METRICS_LOG_REQUESTS', 'true').lower() == 'true'
+
+# Upper bounds in seconds of the histogram buckets, from a cached trie search to a large upload to S3
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Prefix of the exported metric names
+METRIC_PREFIX = 'dms_'
+
+# The help text of the exported metrics; others are exported without one
+DESCRIPTIONS = {
+    'http_request_duration_seconds': "Time to handle a request, by route, method and status",
+    'lambda_invocation_duration_seconds': "Time of a Lambda invocation, including the event conversion",
+    'storage_operation_duration_seconds': "Time of the database storage reads and writes, by storage",
+    'storage_bytes_total': "Bytes the database storage read and wrote, by storage",
+    'snapshot_decode_duration_seconds': "Time to parse a database snapshot",
+    'snapshot_encode_duration_seconds': "Time to serialize a database snapshot",
+    'trie_operation_duration_seconds': "Time of the trie and word index operations",
+    'hash_bytes_total': "Bytes of file content hashed",
+    'hash_seconds_total': "Time spent hashing file content",
+    's3_call_duration_seconds': "Time of the S3 API calls, retries included, by operation",
+    's3_call_errors_total': "S3 API calls that failed, by operation",
+    'presigned_url_cache_events_total': "Presigned download URL cache hits, misses, expirations, evictions and "
+                                        "invalidations",
+    'presigned_url_cache_urls': "Presigned download URLs cached",
+    'trie_user_cache_events_total': "Trie cache hits, misses, builds and evictions",
+    'trie_user_cache_build_seconds_total': "Time spent building users' tries",
+    'trie_user_cache_users': "Users whose tries are cached",
+    'trie_user_cache_documents': "Documents in the cached tries",
+    'write_behind_cache_events_total': "Write-behind cache hits, misses, writes, flushes and rejected flushes",
+    'write_behind_cache_bytes_written_total': "Bytes the write-behind cache flushed",
+    'write_behind_cache_pending_writes': "Writes not flushed yet",
+}
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the application, exported in the Prometheus text format
+
+    Samples are keyed by name and labels. Values kept elsewhere, e.g. the
+    counters of the caches, are exported through collectors, which are
+    read at every render. Besides the totals of the
+    process, the samples recorded by a thread between ``begin_request`` and
+    ``end_request`` are summed for that request, so one log line shows where
+    its time went. Work handed to other threads, e.g. the parallel stores of
+    a batch upload or a background compaction, only counts in the totals.
+
+    Attributes:
+    ----------
+    enabled : bool
+        whether anything is recorded; when not, the hooks return at once
+    buckets : tuple
+        the upper bounds in seconds of the histogram buckets
+
+    Methods:
+    --------
+    inc(self, name, amount=1, **labels)
+        Adds to a counter
+
+    observe(self, name, seconds, **labels)
+        Records a duration in a histogram
+
+    time(self, name, **labels)
+        A context manager recording the duration of the block it wraps
+
+    throughput(self, name, size, seconds, **labels)
+        Adds bytes processed and the time it took to a pair of counters
+
+    begin_request(self)
+        Starts summing the samples of the current thread for a request
+
+    end_request(self)
+        Stops summing and returns the request's totals
+
+    register_collector(self, collector)
+        Adds a callable whose samples are read at every render
+
+    render(self)
+        Returns every metric in the Prometheus text format
+    """
+
+    def __init__(self, enabled=False, buckets=LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., count, sum]
+        self._local = threading.local()
+        self._collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Adds to a counter
+
+        Parameters:
+        -----------
+        name : str
+            the name of the counter, ending in ``_total``
+        amount : float
+            the amount to add
+        labels : str
+            the labels of the sample
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        request = getattr(self._local, 'request', None)
+        if request is not None:
+            request[_log_key(key)] = request.get(_log_key(key), 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records a duration in a histogram
+
+        Parameters:
+        -----------
+        name : str
+            the name of the histogram, ending in ``_seconds``
+        seconds : float
+            the duration
+        labels : str
+            the labels of the sample
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += 1
+            histogram[-1] += seconds
+        request = getattr(self._local, 'request', None)
+        if request is not None:
+            totals = request.setdefault(_log_key(key), {'calls': 0, 'ms': 0.0})
+            totals['calls'] += 1
+            totals['ms'] += seconds * 1000
+
+    def time(self, name, **labels):
+        """
+        A context manager recording the duration of the block it wraps, raising or not
+        """
+        if not self.enabled:
+            return _NOT_TIMED
+        return _Timer(self, name, labels)
+
+    def throughput(self, name, size, seconds, **labels):
+        """
+        Adds bytes processed and the time it took to the counters ``<name>_bytes_total`` and ``<name>_seconds_total``,
+        whose rates divide into bytes per second
+        """
+        if not self.enabled:
+            return
+        self.inc(f'{name}_bytes_total', size, **labels)
+        self.inc(f'{name}_seconds_total', seconds, **labels)
+
+    def begin_request(self):
+        """
+        Starts summing the samples of the current thread for a request
+        """
+        if self.enabled:
+            self._local.request = {}
+
+    def end_request(self):
+        """
+        Stops summing the samples of the current thread
+
+        Returns:
+        --------
+        totals : dict
+            the counters, and the calls and milliseconds of the histograms,
+            recorded during the request, keyed by name and label values
+        """
+        request = getattr(self._local, 'request', None)
+        self._local.request = None
+        if request is None:
+            return {}
+        return {key: {'calls': value['calls'], 'ms': round(value['ms'], 3)} if isinstance(value, dict)
+                else round(value, 6) for key, value in sorted(request.items())}
+
+    def register_collector(self, collector):
+        """
+        Adds a callable whose samples are read at every render, to export values kept elsewhere
+
+        Parameters:
+        -----------
+        collector : callable
+            returns (name, kind, value, labels) samples, the kind being
+            'counter' or 'gauge' and the labels a dict
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format, version 0.0.4
+        """
+        with self._lock:
+            samples = {'counter': dict(self._counters), 'gauge': {}}
+            histograms = {key: list(histogram) for key, histogram in self._histograms.items()}
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                collected = list(collector())
+            except Exception:
+                # The other metrics are still worth scraping
+                logging.getLogger().exception("Metrics collector %r failed", collector)
+                continue
+            for name, kind, value, labels in collected:
+                samples[kind][(name, tuple(sorted(labels.items())))] = value
+
+        lines = []
+        for kind, values in samples.items():
+            for name in sorted({name for name, _ in values}):
+                _describe(lines, name, kind)
+                for (sample_name, labels), value in sorted(values.items()):
+                    if sample_name == name:
+                        lines.append(f"{METRIC_PREFIX}{name}{_labels(labels)} {_number(value)}")
+        for name in sorted({name for name, _ in histograms}):
+            _describe(lines, name, 'histogram')
+            for (sample_name, labels), histogram in sorted(histograms.items()):
+                if sample_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram):
+                    cumulative += count
+                    lines.append(f"{METRIC_PREFIX}{name}_bucket{_labels(labels + (('le', _number(bound)),))} "
+                                 f"{cumulative}")
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram[-2]}")
+                lines.append(f"{METRIC_PREFIX}{name}_sum{_labels(labels)} {_number(histogram[-1])}")
+                lines.append(f"{METRIC_PREFIX}{name}_count{_labels(labels)} {histogram[-2]}")
+        return '\n'.join(lines) + '\n'
+
+
+# Returned by time() while disabled; a nullcontext can be entered any number of times
+_NOT_TIMED = nullcontext()
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class MetricsMiddleware:
+    """
+    A WSGI middleware timing every request of a Flask app and logging a structured line per request
+
+    It wraps ``app.wsgi_app``, so the time includes the teardown handlers,
+    e.g. flushing the write-behind cache. A streamed body, e.g. a file
+    download, is sent after the time is taken. The route is the URL rule
+    that matched, so the ids in the path don't make a label per document.
+    """
+
+    def __init__(self, app, metrics, log_requests=METRICS_LOG_REQUESTS):
+        self.wsgi_app = app.wsgi_app
+        self.metrics = metrics
+        self.log_requests = log_requests
+        self.logger = logging.getLogger()
+        app.before_request(self._match_route)
+
+    def __call__(self, environ, start_response):
+        if not self.metrics.enabled:
+            return self.wsgi_app(environ, start_response)
+
+        status = []
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        environ['dms.route'] = None
+        self.metrics.begin_request()
+        started = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, recording_start_response)
+        finally:
+            seconds = time.perf_counter() - started
+            route = environ['dms.route'] or 'unmatched'
+            method = environ.get('REQUEST_METHOD', '')
+            code = status[-1] if status else '500'
+            totals = self.metrics.end_request()
+            self.metrics.observe('http_request_duration_seconds', seconds, route=route, method=method, status=code)
+            if self.log_requests:
+                self.logger.info(json.dumps({'event': 'request', 'method': method, 'route': route,
+                                             'path': environ.get('PATH_INFO', ''), 'status': int(code),
+                                             'duration_ms': round(seconds * 1000, 3), 'metrics': totals}))
+
+    @staticmethod
+    def _match_route():
+        from flask import request
+        if request.url_rule is not None:
+            request.environ['dms.route'] = request.url_rule.rule
+
+
+def init_app(app, metrics=None):
+    """
+    Instruments a Flask app: times its requests and serves /metrics while metrics are enabled
+
+    Parameters:
+    -----------
+    app : Flask
+        the application
+    metrics : Metrics
+        the registry, the process-wide one by default
+    """
+    metrics = metrics or METRICS
+    app.wsgi_app = MetricsMiddleware(app, metrics)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        if not metrics.enabled:
+            return {'message': 'Metrics are disabled'}, 404
+        return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def _describe(lines, name, kind):
+    if name in DESCRIPTIONS:
+        lines.append(f"# HELP {METRIC_PREFIX}{name} {DESCRIPTIONS[name]}")
+    lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _log_key(key):
+    name, labels = key
+    return '.'.join([name, *(str(value) for _, value in labels)])
+
+
+# The registry of the process, which the storages, tries, hashing and S3 clients record to
+METRICS = Metrics(METRICS_ENABLED)
@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import OrderedDict
+
+from library.python.Metrics import METRICS
+
+
+class PresignedUrlCache:
+    """
+    A bounded least-recently-used cache of presigned download URLs, keyed by the content of the file
+
+    A URL is signed for ``expires_in`` seconds and handed out again until
+    less than ``min_remaining`` seconds of it are left, so a client always
+    gets at least that long to use it. While it is reused, the URL, and so
+    the browser's cached copy of the file behind it, stays the same. The
+    key is the (hashValue, fileExt) of the blob; an entry also remembers
+    what else went into the signature, e.g. the content type, and is signed
+    again if that differs. Besides ``stats``, the counters are recorded in
+    the process metrics as ``presigned_url_cache_events_total``, by event.
+
+    Attributes:
+    ----------
+    expires_in : int
+        the seconds a URL is signed for
+    min_remaining : int
+        the seconds a URL must still be valid for to be handed out
+    max_entries : int
+        the largest number of URLs kept, None for no limit
+    clock : callable
+        returns the current time, time.time by default
+
+    Methods:
+    --------
+    get(self, key, variant, sign)
+        Returns the cached URL of a blob, signing a new one on a miss
+
+    discard(self, key)
+        Drops the URL of a blob, e.g. once its document is deleted
+
+    clear(self)
+        Drops every URL
+
+    stats(self)
+        Returns the cache counters
+    """
+
+    def __init__(self, expires_in=3600, min_remaining=900, max_entries=None, clock=time.time):
+        if not 0 <= min_remaining < expires_in:
+            raise ValueError("min_remaining must be less than expires_in")
+        self.expires_in = expires_in
+        self.min_remaining = min_remaining
+        self.max_entries = max_entries
+        self.clock = clock
+
+        self._urls = OrderedDict()  # key -> (url, variant, expiry), least recently used first
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'expirations': 0, 'evictions': 0, 'invalidations': 0}
+        # Counts the discards, so a URL signed while its blob was discarded isn't cached
+        self._discards = 0
+
+    def __len__(self):
+        return len(self._urls)
+
+    def get(self, key, variant, sign):
+        """
+        Returns the cached URL of a blob, signing a new one on a miss
+
+        Signing happens outside the lock, so a miss doesn't hold up the
+        other requests; two concurrent misses for a blob both sign. A URL
+        signed while a blob was discarded is returned but not cached.
+
+        Parameters:
+        -----------
+        key : tuple
+            the (hashValue, fileExt) of the blob
+        variant : hashable
+            the other inputs of the signature, e.g. the content type
+        sign : callable
+            signs and returns a URL valid for the given number of seconds, or
+            None if there is nothing to sign, which isn't cached
+
+        Returns:
+        --------
+        url : str
+            a URL valid for at least ``min_remaining`` seconds, or None
+        expiry : float
+            the time the URL expires at, or None
+        """
+        now = self.clock()
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None and entry[1] == variant:
+                if entry[2] - now >= self.min_remaining:
+                    self._urls.move_to_end(key)
+                    self._count('hits')
+                    return entry[0], entry[2]
+                self._count('expirations')
+            self._count('misses')
+            discards = self._discards
+
+        url = sign(self.expires_in)
+        if url is None:
+            return None, None
+        expiry = now + self.expires_in
+        with self._lock:
+            if self._discards != discards:
+                return url, expiry
+            self._urls[key] = (url, variant, expiry)
+            self._urls.move_to_end(key)
+            while self.max_entries is not None and len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
+                self._count('evictions')
+        return url, expiry
+
+    def discard(self, key):
+        """
+        Drops the URL of a blob, e.g. once its document is deleted
+
+        Parameters:
+        -----------
+        key : tuple
+            the (hashValue, fileExt) of the blob
+        """
+        with self._lock:
+            self._discards += 1
+            if self._urls.pop(key, None) is not None:
+                self._count('invalidations')
+
+    def _count(self, counter):
+        # Called with the lock held
+        self._counters[counter] += 1
+        METRICS.inc('presigned_url_cache_events_total', event=counter)
+
+    def clear(self):
+        """
+        Drops every URL
+        """
+        with self._lock:
+            self._urls.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters
+
+        Returns:
+        --------
+        stats : dict
+            hits, misses, expired URLs signed again, evictions, invalidations
+            and the hit rate, with the number of URLs currently cached
+        """
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return {**self._counters, 'hit_rate': round(self._counters['hits'] / lookups, 3) if lookups else 0.0,
+                    'urls': len(self._urls)}
@@ -0,0 +1,366 @@
+import heapq
+from itertools import count as counter
+
+from library.python.LevenshteinAutomaton import fuzzy_search_page
+from library.python.SearchRanking import decode_cursor, encode_cursor, rank_key
+
+
+class RadixTrieNode:
+    """
+    A compressed (radix) trie node, a drop-in replacement for TrieNode
+
+    Chains of nodes with a single child are merged into one node whose edge
+    ``label`` holds several characters, and nodes use ``__slots__``, so a
+    trie takes a fraction of the memory of a TrieNode trie holding the same
+    titles. ``remove`` deletes leaves that no longer hold a document and merges
+    nodes left with a single child back into their parent edge.
+
+    Search results are ranked like TrieNode's: shortest title first, then the
+    most recent upload.
+
+    Attributes:
+    ----------
+    label : str
+        the characters on the edge from the parent to this node
+    children : dict
+        a dictionary that maps the first character of each child's label to the child
+    is_end_of_word : bool
+        a boolean that represents whether the node is the end of a word
+    is_root : bool
+        a boolean that represents whether the node is the root of the trie
+    document : Document
+        a Document object representing the document associated with the node
+    count : int
+        the number of documents stored in this node and the nodes below it
+
+    Methods:
+    --------
+    insert(self, document)
+        Inserts a document into the trie
+
+    remove(self, document)
+        Removes a document from the trie
+
+    search(self, prefix, limit=None, cursor=None)
+        Searches for documents with a given prefix
+
+    search_page(self, prefix, limit=None, cursor=None)
+        Searches for a page of documents with a given prefix, with the total and a continuation cursor
+
+    count_prefix(self, prefix)
+        Counts the documents with a given prefix
+
+    fuzzy_search_page(self, query, max_edits=1, limit=None)
+        Searches for documents whose title starts within max_edits edits of the query
+
+    build(cls, documents)
+        Builds a trie holding the documents in one pass over their sorted titles
+    """
+
+    __slots__ = ('label', 'children', 'is_end_of_word', 'is_root', 'document', 'count')
+
+    def __init__(self, is_root=False, label=''):
+        self.label = label
+        self.children = {}
+        self.is_end_of_word = False
+        self.is_root = is_root
+        self.document = None
+        self.count = 0
+
+    def insert(self, document):
+        """
+        Inserts a document into the trie
+
+        Parameters:
+        -----------
+        document : Document
+            a Document object representing the document to be inserted
+        """
+        path = [self]
+        word = document.title.lower().strip()
+        while word:
+            node = path[-1]
+            child = node.children.get(word[0])
+            if child is None:
+                child = RadixTrieNode(label=word)
+                node.children[word[0]] = child
+                path.append(child)
+                break
+            common = _common_prefix_length(child.label, word)
+            if common < len(child.label):
+                child = self._split(node, child, common)
+            path.append(child)
+            word = word[common:]
+
+        node = path[-1]
+        if not node.is_end_of_word:
+            for ancestor in path:
+                ancestor.count += 1
+        node.is_end_of_word = True
+        node.document = document
+
+    @classmethod
+    def build(cls, documents):
+        """
+        Builds a trie holding the documents in one pass over their sorted titles
+
+        Each title shares its path with the previous one up to their common
+        prefix, so new nodes are appended at the end of that path instead of
+        being looked up from the root. The result is the trie inserting the
+        documents one by one would give; of documents with the same title, the
+        last one is kept.
+
+        Parameters:
+        -----------
+        documents : iterable
+            the Document objects to be inserted
+
+        Returns:
+        --------
+        trie : RadixTrieNode
+            the root of the new trie
+        """
+        root = cls(True)
+        path = [(root, 0)]  # the nodes of the previous title, with the title length at each
+        previous = ''
+        # The sort is stable, so documents with the same title keep their order
+        for word, document in sorted(((document.title.lower().strip(), document) for document in documents),
+                                     key=lambda pair: pair[0]):
+            common = _common_prefix_length(previous, word)
+            # Nodes leaving the path are complete, so their counts are added to their parent
+            while path[-1][1] > common:
+                child = path.pop()[0]
+                node, depth = path[-1]
+                if depth < common:
+                    # The titles part in the middle of the edge to child
+                    path.append((cls._split(node, child, common - depth), common))
+                else:
+                    node.count += child.count
+            node = path[-1][0]
+            if len(word) > common:
+                child = RadixTrieNode(label=word[common:])
+                node.children[word[common]] = child
+                path.append((child, len(word)))
+                node = child
+            if not node.is_end_of_word:
+                node.count += 1
+            node.is_end_of_word = True
+            node.document = document
+            previous = word
+        while len(path) > 1:
+            child = path.pop()[0]
+            path[-1][0].count += child.count
+        return root
+
+    def remove(self, document):
+        """
+        Removes a document from the trie
+
+        Parameters:
+        -----------
+        document : Document
+            a Document object representing the document to be removed
+        """
+        path = [self]
+        word = document.title.lower().strip()
+        while word:
+            child = path[-1].children.get(word[0])
+            if child is None or not word.startswith(child.label):
+                return
+            path.append(child)
+            word = word[len(child.label):]
+
+        node = path[-1]
+        if not node.is_end_of_word:
+            return
+        node.is_end_of_word = False
+        node.document = None
+        for ancestor in path:
+            ancestor.count -= 1
+
+        # Delete the node if nothing is left below it, then merge whatever is
+        # left with a single child into that child
+        if node is not self and not node.children:
+            parent = path[-2]
+            del parent.children[node.label[0]]
+            node = parent
+            path.pop()
+        if node is not self and not node.is_end_of_word and len(node.children) == 1:
+            self._merge(path[-2], node)
+
+    def search(self, prefix, limit=None, cursor=None):
+        """
+        Searches for documents with a given prefix
+
+        Parameters:
+        -----------
+        prefix : str
+            a string representing the prefix to search for
+        limit : int
+            the maximum number of documents to return, None for all of them
+        cursor : str
+            the cursor returned with the previous page, to continue after it
+
+        Returns:
+        --------
+        documents : list
+            a list of Document objects that match the prefix, best ranked first
+        """
+        return self.search_page(prefix, limit, cursor)[0]
+
+    def search_page(self, prefix, limit=None, cursor=None):
+        """
+        Searches for a page of documents with a given prefix
+
+        Parameters:
+        -----------
+        prefix : str
+            a string representing the prefix to search for
+        limit : int
+            the maximum number of documents to return, None for all of them
+        cursor : str
+            the cursor returned with the previous page, to continue after it
+
+        Returns:
+        --------
+        documents : list
+            a list of Document objects that match the prefix, best ranked first
+        total : int
+            the number of documents that match the prefix
+        next_cursor : str
+            the cursor for the next page, None if there are no more documents
+
+        Raises:
+        -------
+        ValueError
+            if the cursor is malformed
+        """
+        after = decode_cursor(cursor) if cursor else None
+        node, depth = self._find(prefix.lower().strip())
+        if node is None:
+            return [], 0, None
+
+        ranked = []
+        has_more = False
+        for key, document in self._ranked_documents(node, depth, after):
+            if limit is not None and len(ranked) == limit:
+                has_more = True
+                break
+            ranked.append((key, document))
+
+        next_cursor = encode_cursor(ranked[-1][0]) if has_more else None
+        return [document for _, document in ranked], node.count, next_cursor
+
+    def count_prefix(self, prefix):
+        """
+        Counts the documents with a given prefix, without visiting them
+
+        Parameters:
+        -----------
+        prefix : str
+            a string representing the prefix to count
+
+        Returns:
+        --------
+        count : int
+            the number of documents that match the prefix
+        """
+        node, _ = self._find(prefix.lower().strip())
+        return node.count if node is not None else 0
+
+    def fuzzy_search_page(self, query, max_edits=1, limit=None):
+        """
+        Searches for documents whose title starts within max_edits edits of the query
+
+        Only branches that can still match within the edit budget are walked,
+        see LevenshteinAutomaton.fuzzy_search_page.
+
+        Parameters:
+        -----------
+        query : str
+            a string representing the possibly mistyped prefix
+        max_edits : int
+            the largest number of inserted, deleted or replaced characters
+        limit : int
+            the maximum number of documents to return, None for all of them
+
+        Returns:
+        --------
+        matches : list
+            (Document, edit distance) pairs, closest first and then in rank order
+        total : int
+            the number of documents that match
+        """
+        return fuzzy_search_page(self, query.lower().strip(), max_edits, limit,
+                                 lambda key, child: child.label, self._ranked_documents)
+
+    def _find(self, word):
+        """
+        Returns the highest node whose title starts with word, and the title length at that node
+
+        The prefix may end in the middle of the node's edge label.
+        """
+        node, depth = self, 0
+        while word:
+            child = node.children.get(word[0])
+            if child is None:
+                return None, 0
+            if word.startswith(child.label):
+                word = word[len(child.label):]
+            elif child.label.startswith(word):
+                word = ''
+            else:
+                return None, 0
+            node, depth = child, depth + len(child.label)
+        return node, depth
+
+    @staticmethod
+    def _ranked_documents(node, depth, after=None):
+        """
+        Yields (rank key, document) pairs below a node, best ranked first
+
+        Nodes are visited in order of title length through a heap, so no
+        recursion is needed and the walk ends when the caller stops iterating.
+        """
+        sequence = counter()
+        heap = [(depth, next(sequence), node)]
+        while heap:
+            depth = heap[0][0]
+            level = []
+            while heap and heap[0][0] == depth:
+                level.append(heapq.heappop(heap)[2])
+            if after is None or depth >= after[0]:
+                found = [(rank_key(depth, n.document), n.document) for n in level if n.is_end_of_word]
+                found.sort(key=lambda pair: pair[0])
+                for key, document in found:
+                    if after is None or key > after:
+                        yield key, document
+            for n in level:
+                for child in n.children.values():
+                    heapq.heappush(heap, (depth + len(child.label), next(sequence), child))
+
+    @staticmethod
+    def _split(parent, child, length):
+        # Put a new node holding the first length characters of the edge between parent and child
+        middle = RadixTrieNode(label=child.label[:length])
+        middle.count = child.count
+        child.label = child.label[length:]
+        middle.children[child.label[0]] = child
+        parent.children[middle.label[0]] = middle
+        return middle
+
+    @staticmethod
+    def _merge(parent, node):
+        # Fold the only child of node into it, so the edge from parent carries both labels
+        (child,) = node.children.values()
+        child.label = node.label + child.label
+        parent.children[child.label[0]] = child
+
+
+def _common_prefix_length(first, second):
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+    return length
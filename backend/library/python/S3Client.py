@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from library.python.Metrics import METRICS
+
+# Connections the shared client keeps open to S3, enough for the batch upload workers each running a managed copy
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 50))
+
+# Threads of one managed transfer, e.g. the parts of a large copy
+S3_TRANSFER_CONCURRENCY = int(os.environ.get('S3_TRANSFER_CONCURRENCY', 8))
+
+# Size from which, and parts in which, managed transfers go multipart. Copies within S3 cost
+# nothing per byte on our side, so larger parts mean fewer UploadPartCopy requests
+S3_TRANSFER_PART_SIZE = 64 * 1024 * 1024
+
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=S3_TRANSFER_PART_SIZE,
+                                 multipart_chunksize=S3_TRANSFER_PART_SIZE,
+                                 max_concurrency=S3_TRANSFER_CONCURRENCY)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def shared_s3_client():
+    """
+    Returns the S3 client of the process, created on first use
+
+    Creating a client resolves the credentials and the endpoint, and every
+    client has its own connection pool, so a client per request also pays
+    a TLS handshake per request. The shared client is created once, under a
+    lock as boto3's default session isn't thread-safe, and its pool is
+    sized for the threads using it at once. Clients are thread-safe.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = boto3.client('s3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                                                           tcp_keepalive=True))
+    return _client
+
+
+class LatencyCounters:
+    """
+    Counts the calls of each operation of a store, with their failures and the time they took
+
+    Methods:
+    --------
+    record(self, operation, seconds, failed=False)
+        Counts a call of an operation
+
+    time(self, operation)
+        A context manager counting the call it wraps
+
+    track(self, s3)
+        Counts every API call made through an S3 client
+
+    stats(self)
+        Returns the counters of each operation
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # operation -> [calls, errors, seconds, max seconds]
+
+    def record(self, operation, seconds, failed=False):
+        """
+        Counts a call of an operation
+
+        Parameters:
+        -----------
+        operation : str
+            the name of the operation, e.g. ``HeadObject``
+        seconds : float
+            how long the call took
+        failed : bool
+            whether the call raised
+        """
+        with self._lock:
+            counters = self._counters.setdefault(operation, [0, 0, 0.0, 0.0])
+            counters[0] += 1
+            counters[1] += failed
+            counters[2] += seconds
+            counters[3] = max(counters[3], seconds)
+
+    @contextmanager
+    def time(self, operation):
+        """
+        A context manager counting the call it wraps, as failed if it raises
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.record(operation, time.perf_counter() - started, failed=True)
+            raise
+        self.record(operation, time.perf_counter() - started)
+
+    def track(self, s3):
+        """
+        Counts every API call made through an S3 client, by the name of the operation
+
+        A call is timed from the building of its parameters to its parsed
+        response, so retries are part of its time. Error responses and
+        connection errors count as failed.
+        """
+        # Unique ids are per client, not per event, and make tracking twice a no-op
+        for event, handler in (('before-parameter-build.s3', self._started), ('after-call.s3', self._finished),
+                               ('after-call-error.s3', self._failed)):
+            s3.meta.events.register(event, handler, unique_id=f'latency-{id(self)}-{event}')
+
+    def stats(self):
+        """
+        Returns the counters of each operation
+
+        Returns:
+        --------
+        stats : dict
+            the calls, errors, total seconds and mean and max milliseconds of each operation
+        """
+        with self._lock:
+            return {operation: {'calls': calls, 'errors': errors, 'seconds': round(seconds, 3),
+                                'mean_ms': round(seconds / calls * 1000, 2), 'max_ms': round(max_seconds * 1000, 2)}
+                    for operation, (calls, errors, seconds, max_seconds) in sorted(self._counters.items())}
+
+    def _started(self, context, **kwargs):
+        # Keyed by tracker, so several can count the calls of one client
+        context[f'latency-{id(self)}'] = time.perf_counter()
+
+    def _finished(self, model, http_response, context, **kwargs):
+        started = context.pop(f'latency-{id(self)}', None)
+        if started is not None:
+            self._record_call(model.name, time.perf_counter() - started, http_response.status_code >= 300)
+
+    def _failed(self, event_name, context, **kwargs):
+        started = context.pop(f'latency-{id(self)}', None)
+        if started is not None:
+            self._record_call(event_name.rsplit('.', 1)[-1], time.perf_counter() - started, True)
+
+    def _record_call(self, operation, seconds, failed):
+        # The application-wide metrics count the S3 calls too, for /metrics and the request log lines
+        self.record(operation, seconds, failed)
+        METRICS.observe('s3_call_duration_seconds', seconds, operation=operation)
+        if failed:
+            METRICS.inc('s3_call_errors_total', operation=operation)
@@ -0,0 +1,35 @@
+import base64
+import json
+from datetime import datetime
+
+
+def rank_key(depth, document):
+    """
+    Returns the key search results are ordered by
+
+    Shorter titles come first, then newer uploads, then the id for a stable order.
+    """
+    upload_date = getattr(document, 'uploadDate', None)
+    try:
+        recency = datetime.fromisoformat(upload_date).timestamp() if upload_date else 0.0
+    except ValueError:
+        recency = 0.0
+    return depth, -recency, document.id
+
+
+def encode_cursor(key):
+    """
+    Turns the rank key of the last returned document into an opaque cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Turns a cursor back into a rank key, raising a ValueError if it is malformed
+    """
+    try:
+        depth, recency, document_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return int(depth), float(recency), str(document_id)
+    except (ValueError, TypeError, UnicodeError) as e:
+        raise ValueError(f"Invalid search cursor: {cursor}") from e
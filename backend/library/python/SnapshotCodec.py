@@ -0,0 +1,107 @@
+import json
+import lzma
+import zlib
+
+from library.python.Metrics import METRICS
+
+# Magic bytes used to recognise compressed snapshots when decoding
+ZLIB_MAGIC = (b'\x78\x01', b'\x78\x5e', b'\x78\x9c', b'\x78\xda')
+LZMA_MAGIC = b'\xfd7zXZ\x00'
+
+
+class SnapshotCodec:
+    """
+    A class that turns the database state into the bytes that get persisted, and back
+
+    Attributes
+    ----------
+    name : str
+        the name the codec is selected by (DB_SNAPSHOT_CODEC)
+    compression : str
+        None, 'zlib' or 'lzma'
+    pretty : bool
+        whether the JSON is indented the way db.json has always been written
+    """
+
+    def __init__(self, name, compression=None, pretty=False):
+        self.name = name
+        self.compression = compression
+        self.pretty = pretty
+
+    def encode(self, data):
+        """
+        Serializes the database state
+
+        Parameters
+        ----------
+            data : dict
+                the TinyDB tables
+
+        Returns
+        -------
+            payload : bytes
+                the encoded snapshot
+        """
+        with METRICS.time('snapshot_encode_duration_seconds', codec=self.name):
+            if self.pretty:
+                payload = json.dumps(data, indent=4, separators=(',', ': ')).encode('utf-8')
+            else:
+                payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            if self.compression == 'zlib':
+                return zlib.compress(payload, 6)
+            if self.compression == 'lzma':
+                return lzma.compress(payload, preset=6)
+            return payload
+
+    def decode(self, payload):
+        """
+        Deserializes a snapshot; any codec's output is accepted, see decode_snapshot
+        """
+        return decode_snapshot(payload)
+
+
+CODECS = {
+    'json-pretty': SnapshotCodec('json-pretty', pretty=True),
+    'json': SnapshotCodec('json'),
+    'zlib': SnapshotCodec('zlib', compression='zlib'),
+    'lzma': SnapshotCodec('lzma', compression='lzma'),
+}
+
+
+def get_codec(name):
+    """
+    Returns the codec registered under name
+
+    Raises a ValueError naming the available codecs if there is none.
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown snapshot codec {name!r}, expected one of {', '.join(CODECS)}")
+
+
+def decode_snapshot(payload):
+    """
+    Deserializes a snapshot written by any of the codecs
+
+    The compression is recognised from the payload itself, so switching
+    DB_SNAPSHOT_CODEC never makes existing data unreadable.
+    """
+    with METRICS.time('snapshot_decode_duration_seconds'):
+        if isinstance(payload, str):
+            return json.loads(payload)
+        payload = bytes(payload)
+        if payload.startswith(LZMA_MAGIC):
+            payload = lzma.decompress(payload)
+        elif payload[:2] in ZLIB_MAGIC:
+            payload = zlib.decompress(payload)
+        return json.loads(payload.decode('utf-8'))
+
+
+def split_chunks(payload, chunk_size):
+    """
+    Splits a payload into chunks of at most chunk_size bytes
+    """
+    if not chunk_size or len(payload) <= chunk_size:
+        return [payload]
+    return [payload[offset:offset + chunk_size] for offset in range(0, len(payload), chunk_size)]
@@ -0,0 +1,286 @@
+import heapq
+import re
+from bisect import bisect_left, insort
+
+from library.python.SearchRanking import decode_cursor, encode_cursor, rank_key
+
+# Titles and queries are split into lower-case runs of letters and digits
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """
+    Splits a title or query into its lower-case words
+    """
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+class TitleSearchIndex:
+    """
+    An inverted index from title words to documents, searched by word prefixes
+
+    Every word of a title is indexed, so "report" finds "Weekly Report", and
+    a query matches the documents having, for each query word, a title word
+    that starts with it. Postings hold document ids, so documents with the
+    same title don't replace each other.
+
+    The vocabulary is kept sorted, so the words starting with a query word
+    are one contiguous slice of it. For multi-word queries only the query
+    word with the fewest postings is expanded into candidates. They are
+    intersected with the postings of the other query words, or checked
+    against their titles when those postings are much larger.
+
+    Results are ranked like the title tries: shortest title first, then the
+    most recent upload.
+
+    Attributes:
+    ----------
+    documents : dict
+        a dictionary that maps document ids to Document objects
+
+    Methods:
+    --------
+    insert(self, document)
+        Adds a document to the index, replacing an older version with the same id
+
+    remove(self, document)
+        Removes a document from the index
+
+    search(self, query, limit=None, cursor=None)
+        Searches for documents matching every word of a query
+
+    search_page(self, query, limit=None, cursor=None)
+        Searches for a page of documents, with the total and a continuation cursor
+
+    from_documents(cls, documents)
+        Creates an index of a list of documents in one pass
+
+    postings(self, positions)
+        Returns the postings with documents replaced by their positions, for snapshots
+
+    from_postings(cls, documents, postings)
+        Creates an index from a list of documents and postings returned by postings()
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self._postings = {}  # word -> set of document ids
+        self._vocabulary = []  # sorted words with postings
+        self._rank_keys = {}  # document id -> rank key
+
+    def __len__(self):
+        return len(self.documents)
+
+    def insert(self, document):
+        """
+        Adds a document to the index, replacing an older version with the same id
+
+        Parameters:
+        -----------
+        document : Document
+            a Document object representing the document to be indexed
+        """
+        if document.id in self.documents:
+            self.remove(document)
+        words = tuple(dict.fromkeys(tokenize(document.title)))
+        self.documents[document.id] = document
+        self._rank_keys[document.id] = rank_key(len(document.title.lower().strip()), document)
+        for word in words:
+            posting = self._postings.get(word)
+            if posting is None:
+                posting = self._postings[word] = set()
+                insort(self._vocabulary, word)
+            posting.add(document.id)
+
+    def remove(self, document):
+        """
+        Removes a document from the index
+
+        Parameters:
+        -----------
+        document : Document
+            a Document object representing the document to be removed, matched by id
+        """
+        indexed = self.documents.pop(document.id, None)
+        if indexed is None:
+            return
+        del self._rank_keys[document.id]
+        for word in set(tokenize(indexed.title)):
+            posting = self._postings[word]
+            posting.discard(document.id)
+            if not posting:
+                del self._postings[word]
+                del self._vocabulary[bisect_left(self._vocabulary, word)]
+
+    def search(self, query, limit=None, cursor=None):
+        """
+        Searches for documents matching every word of a query
+
+        Parameters:
+        -----------
+        query : str
+            the words to search for; each one matches title words starting with it
+        limit : int
+            the maximum number of documents to return, None for all of them
+        cursor : str
+            the cursor returned with the previous page, to continue after it
+
+        Returns:
+        --------
+        documents : list
+            a list of Document objects that match the query, best ranked first
+        """
+        return self.search_page(query, limit, cursor)[0]
+
+    def search_page(self, query, limit=None, cursor=None):
+        """
+        Searches for a page of documents matching every word of a query
+
+        Parameters:
+        -----------
+        query : str
+            the words to search for; each one matches title words starting with it
+        limit : int
+            the maximum number of documents to return, None for all of them
+        cursor : str
+            the cursor returned with the previous page, to continue after it
+
+        Returns:
+        --------
+        documents : list
+            a list of Document objects that match the query, best ranked first
+        total : int
+            the number of documents that match the query
+        next_cursor : str
+            the cursor for the next page, None if there are no more documents
+
+        Raises:
+        -------
+        ValueError
+            if the cursor is malformed
+        """
+        after = decode_cursor(cursor) if cursor else None
+        matches = self._match(tokenize(query))
+        total = len(matches)
+        keys = self._rank_keys
+        if after is not None:
+            matches = [doc_id for doc_id in matches if keys[doc_id] > after]
+
+        if limit is None:
+            page = sorted(matches, key=keys.__getitem__)
+        else:
+            page = heapq.nsmallest(limit + 1, matches, key=keys.__getitem__)
+        has_more = limit is not None and len(page) > limit
+        page = page[:limit] if has_more else page
+
+        next_cursor = encode_cursor(keys[page[-1]]) if has_more else None
+        return [self.documents[doc_id] for doc_id in page], total, next_cursor
+
+    @classmethod
+    def from_documents(cls, documents):
+        """
+        Creates an index of a list of documents in one pass, sorting the vocabulary once
+
+        Parameters:
+        -----------
+        documents : iterable
+            the Document objects to be indexed; of documents with the same id, the last one is kept
+
+        Returns:
+        --------
+        index : TitleSearchIndex
+            the new index
+        """
+        index = cls()
+        index.documents = {document.id: document for document in documents}
+        postings = index._postings
+        for doc_id, document in index.documents.items():
+            for word in set(tokenize(document.title)):
+                posting = postings.get(word)
+                if posting is None:
+                    posting = postings[word] = set()
+                posting.add(doc_id)
+        index._vocabulary = sorted(postings)
+        index._rank_keys = {doc_id: rank_key(len(document.title.lower().strip()), document)
+                            for doc_id, document in index.documents.items()}
+        return index
+
+    def postings(self, positions):
+        """
+        Returns the postings with documents replaced by their positions, for snapshots
+
+        Parameters:
+        -----------
+        positions : dict
+            the position of each document id in the list the snapshot stores
+
+        Returns:
+        --------
+        postings : dict
+            the sorted list of document positions for each word
+        """
+        return {word: sorted(positions[doc_id] for doc_id in self._postings[word]) for word in self._vocabulary}
+
+    @classmethod
+    def from_postings(cls, documents, postings):
+        """
+        Creates an index from a list of documents and postings returned by postings(),
+        without tokenizing the titles again
+
+        Parameters:
+        -----------
+        documents : list
+            the Document objects, in the order the postings refer to them
+        postings : dict
+            the list of document positions for each word
+
+        Returns:
+        --------
+        index : TitleSearchIndex
+            the restored index
+        """
+        index = cls()
+        index.documents = {document.id: document for document in documents}
+        doc_ids = [document.id for document in documents]
+        index._postings = {word: {doc_ids[position] for position in document_positions}
+                           for word, document_positions in postings.items()}
+        index._vocabulary = sorted(postings)
+        index._rank_keys = {document.id: rank_key(len(document.title.lower().strip()), document)
+                            for document in documents}
+        return index
+
+    def _match(self, terms):
+        """
+        Returns the ids of the documents that have a title word starting with each term
+        """
+        terms = sorted(set(terms))
+        if not terms:
+            return set(self.documents)
+        # Terms that are a prefix of another term are implied by it
+        terms = [term for index, term in enumerate(terms)
+                 if not any(other.startswith(term) for other in terms[index + 1:])]
+
+        expansions = sorted((self._expand(term) + (term,) for term in terms), key=lambda expansion: expansion[1])
+        words, _, _ = expansions[0]
+        candidates = set().union(*(self._postings[word] for word in words))
+
+        documents = self.documents
+        for words, postings, term in expansions[1:]:
+            if postings <= 16 * len(candidates):
+                # Intersecting sets is cheap compared to checking the candidates one by one
+                candidates &= set().union(*(self._postings[word] for word in words))
+            else:
+                candidates = {doc_id for doc_id in candidates
+                              if any(word.startswith(term) for word in tokenize(documents[doc_id].title))}
+        return candidates
+
+    def _expand(self, term):
+        """
+        Returns the vocabulary words starting with term and their total number of postings
+        """
+        vocabulary = self._vocabulary
+        start = end = bisect_left(vocabulary, term)
+        while end < len(vocabulary) and vocabulary[end].startswith(term):
+            end += 1
+        words = vocabulary[start:end]
+        return words, sum(len(self._postings[word]) for word in words)
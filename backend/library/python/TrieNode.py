@@ -1,7 +1,16 @@
+from library.python.LevenshteinAutomaton import fuzzy_search_page
+from library.python.SearchRanking import decode_cursor, encode_cursor, rank_key
+
+
 class TrieNode:
     """
     A TrieNode class to represent a node in a Trie data structure
 
+    Search results are ranked by the shortest title first and then by the most
+    recent upload. Because a node's depth is the length of its title, walking
+    the trie breadth-first visits the titles in rank order, so a limited search
+    stops as soon as it has enough results.
+
     Attributes:
     ----------
     children : dict
@@ -12,6 +21,8 @@ class TrieNode:
         a boolean that represents whether the node is the root of the Trie
     document : Document
         a Document object representing the document associated with the node
+    count : int
+        the number of documents stored in this node and the nodes below it
 
     Methods:
     --------
@@ -21,11 +32,20 @@ class TrieNode:
     remove(self, document)
         Removes a document from the Trie
 
-    search(self, prefix)
+    search(self, prefix, limit=None, cursor=None)
         Searches for documents with a given prefix
 
-    _get_words(self, node)
-        Helper method to get all documents associated with a node
+    search_page(self, prefix, limit=None, cursor=None)
+        Searches for a page of documents with a given prefix, with the total and a continuation cursor
+
+    count_prefix(self, prefix)
+        Counts the documents with a given prefix
+
+    fuzzy_search_page(self, query, max_edits=1, limit=None)
+        Searches for documents whose title starts within max_edits edits of the query
+
+    build(cls, documents)
+        Builds a Trie holding the documents in one pass over their sorted titles
     """
 
     def __init__(self, is_root=False):
@@ -33,6 +53,7 @@ class TrieNode:
         self.is_end_of_word = False
         self.is_root = is_root
         self.document = None
+        self.count = 0
 
     def insert(self, document):
         """
@@ -43,15 +64,68 @@ class TrieNode:
         document : Document
             a Document object representing the document to be inserted
         """
-        node = self
+        path = [self]
         word = document.title.lower().strip()
         for char in word:
+            node = path[-1]
             if char not in node.children:
                 node.children[char] = TrieNode()
-            node = node.children[char]
+            path.append(node.children[char])
+        node = path[-1]
+        if not node.is_end_of_word:
+            for ancestor in path:
+                ancestor.count += 1
         node.is_end_of_word = True
         node.document = document
 
+    @classmethod
+    def build(cls, documents):
+        """
+        Builds a Trie holding the documents in one pass over their sorted titles
+
+        Each title shares its path with the previous one up to their common
+        prefix, so only the nodes after it are created, without walking down
+        from the root. Of documents with the same title, the last one is kept,
+        as with insert.
+
+        Parameters:
+        -----------
+        documents : iterable
+            the Document objects to be inserted
+
+        Returns:
+        --------
+        trie : TrieNode
+            the root of the new Trie
+        """
+        path = [cls(True)]  # the nodes of the previous title
+        previous = ''
+        # The sort is stable, so documents with the same title keep their order
+        for word, document in sorted(((document.title.lower().strip(), document) for document in documents),
+                                     key=lambda pair: pair[0]):
+            common = 0
+            for a, b in zip(previous, word):
+                if a != b:
+                    break
+                common += 1
+            # Nodes leaving the path are complete, so their counts are added to their parent
+            for depth in range(len(path) - 1, common, -1):
+                path[depth - 1].count += path[depth].count
+            del path[common + 1:]
+            node = path[-1]
+            for char in word[common:]:
+                child = node.children[char] = TrieNode()
+                path.append(child)
+                node = child
+            if not node.is_end_of_word:
+                node.count += 1
+            node.is_end_of_word = True
+            node.document = document
+            previous = word
+        for depth in range(len(path) - 1, 0, -1):
+            path[depth - 1].count += path[depth].count
+        return path[0]
+
     def remove(self, document):
         """
         Removes a document from the Trie
@@ -61,16 +135,26 @@ class TrieNode:
         document : Document
             a Document object representing the document to be removed
         """
-        node = self
+        path = [self]
         word = document.title.lower().strip()
         for char in word:
-            if char not in node.children:
+            if char not in path[-1].children:
                 return
-            node = node.children[char]
+            path.append(path[-1].children[char])
+        node = path[-1]
+        if not node.is_end_of_word:
+            return
         node.is_end_of_word = False
         node.document = None
+        for ancestor in path:
+            ancestor.count -= 1
+        # Drop the branch that no longer leads to any document
+        for depth in range(1, len(path)):
+            if path[depth].count == 0:
+                del path[depth - 1].children[word[depth - 1]]
+                break
 
-    def search(self, prefix):
+    def search(self, prefix, limit=None, cursor=None):
         """
         Searches for documents with a given prefix
 
@@ -78,37 +162,129 @@ class TrieNode:
         -----------
         prefix : str
             a string representing the prefix to search for
+        limit : int
+            the maximum number of documents to return, None for all of them
+        cursor : str
+            the cursor returned with the previous page, to continue after it
 
         Returns:
         --------
         documents : list
-            a list of Document objects that match the prefix
+            a list of Document objects that match the prefix, best ranked first
         """
-        node = self
-        prefix = prefix.lower().strip()
-        for char in prefix:
-            if char not in node.children:
-                return []
-            node = node.children[char]
-        return self._get_words(node)
+        return self.search_page(prefix, limit, cursor)[0]
 
-    def _get_words(self, node):
+    def search_page(self, prefix, limit=None, cursor=None):
         """
-        Helper method to get all documents associated with a node
+        Searches for a page of documents with a given prefix
 
         Parameters:
         -----------
-        node : TrieNode
-            a TrieNode object representing the node to get documents from
+        prefix : str
+            a string representing the prefix to search for
+        limit : int
+            the maximum number of documents to return, None for all of them
+        cursor : str
+            the cursor returned with the previous page, to continue after it
 
         Returns:
         --------
         documents : list
-            a list of Document objects associated with the node
-        """
-        documents = []
-        if node.is_end_of_word:
-            documents.append(node.document)
-        for child in node.children.values():
-            documents.extend(self._get_words(child))
-        return documents
+            a list of Document objects that match the prefix, best ranked first
+        total : int
+            the number of documents that match the prefix
+        next_cursor : str
+            the cursor for the next page, None if there are no more documents
+
+        Raises:
+        -------
+        ValueError
+            if the cursor is malformed
+        """
+        after = decode_cursor(cursor) if cursor else None
+        prefix = prefix.lower().strip()
+        node = self._find(prefix)
+        if node is None:
+            return [], 0, None
+
+        ranked = []
+        has_more = False
+        for key, document in self._ranked_documents(node, len(prefix), after):
+            if limit is not None and len(ranked) == limit:
+                has_more = True
+                break
+            ranked.append((key, document))
+
+        next_cursor = encode_cursor(ranked[-1][0]) if has_more else None
+        return [document for _, document in ranked], node.count, next_cursor
+
+    def count_prefix(self, prefix):
+        """
+        Counts the documents with a given prefix, without visiting them
+
+        Parameters:
+        -----------
+        prefix : str
+            a string representing the prefix to count
+
+        Returns:
+        --------
+        count : int
+            the number of documents that match the prefix
+        """
+        node = self._find(prefix.lower().strip())
+        return node.count if node is not None else 0
+
+    def fuzzy_search_page(self, query, max_edits=1, limit=None):
+        """
+        Searches for documents whose title starts within max_edits edits of the query
+
+        Only branches that can still match within the edit budget are walked,
+        see LevenshteinAutomaton.fuzzy_search_page.
+
+        Parameters:
+        -----------
+        query : str
+            a string representing the possibly mistyped prefix
+        max_edits : int
+            the largest number of inserted, deleted or replaced characters
+        limit : int
+            the maximum number of documents to return, None for all of them
+
+        Returns:
+        --------
+        matches : list
+            (Document, edit distance) pairs, closest first and then in rank order
+        total : int
+            the number of documents that match
+        """
+        return fuzzy_search_page(self, query.lower().strip(), max_edits, limit,
+                                 lambda key, child: key, self._ranked_documents)
+
+    def _find(self, word):
+        node = self
+        for char in word:
+            if char not in node.children:
+                return None
+            node = node.children[char]
+        return node
+
+    @staticmethod
+    def _ranked_documents(node, depth, after=None):
+        """
+        Yields (rank key, document) pairs below a node, best ranked first
+
+        The trie is walked one level at a time, so no recursion is needed and
+        the walk ends when the caller stops iterating.
+        """
+        level = [node]
+        while level:
+            if after is None or depth >= after[0]:
+                found = [(rank_key(depth, n.document), n.document) for n in level if n.is_end_of_word]
+                found.sort(key=lambda pair: pair[0])
+                for key, document in found:
+                    if after is None or key > after:
+                        yield key, document
+            level = [child for n in level for child in n.children.values()]
+            depth += 1
+
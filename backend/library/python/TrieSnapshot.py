@@ -0,0 +1,234 @@
+import hashlib
+import json
+import logging
+import os
+import zlib
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+from library.python.Document import Document
+from library.python.RadixTrieNode import RadixTrieNode
+from library.python.S3Client import shared_s3_client
+from library.python.SnapshotCodec import decode_snapshot, get_codec
+from library.python.TitleSearchIndex import TitleSearchIndex
+from library.python.TrieUser import TrieUser
+
+# Bumped whenever the layout below changes; snapshots of another format are ignored
+SNAPSHOT_FORMAT = 1
+
+# The Document fields stored per document, in this order
+DOCUMENT_FIELDS = ('id', 'title', 'hashValue', 'fileExt', 'uploadDate')
+
+
+class TrieSnapshot:
+    """
+    A serialized copy of every user's title trie and word index
+
+    Loading a snapshot replaces rebuilding the tries from the database at
+    process start. Every user entry carries a fingerprint of the documents
+    it was built from; a user whose documents have changed since is detected
+    by comparing fingerprints, and only that user is rebuilt.
+
+    The snapshot is a zlib-compressed JSON document::
+
+        {"format": 1, "trie": "RadixTrieNode", "users": {user id: {
+            "fingerprint": str,
+            "data": JSON string of {
+                "documents": [[id, title, hashValue, fileExt, uploadDate], ...],
+                "nodes": [label, document position or -1, count, number of children, ...],
+                "words": {word: [document positions]}}}}}
+
+    Each user's data is a nested JSON string, so only the users that are
+    restored pay for parsing it. ``nodes`` lists the trie in pre-order, so it
+    is rebuilt without any of the prefix comparisons and node splits an
+    insert does.
+
+    Attributes:
+    ----------
+    location : str
+        a file path, or an ``s3://bucket/key`` URL
+    trie_class : type
+        TrieNode or RadixTrieNode, the kind of trie the snapshot holds
+    users : dict
+        the serialized entry of each user, by user id
+    changed : bool
+        whether entries were updated or removed since the snapshot was loaded or saved
+
+    Methods:
+    --------
+    load(self)
+        Reads the snapshot, leaving it empty if it is missing, unreadable or of another format
+
+    restore(self, user_id, documents)
+        Returns the user's TrieUser if the snapshot entry is still current, otherwise None
+
+    update(self, trie_user, documents)
+        Replaces the entry of a user with their current trie
+
+    save(self)
+        Writes the snapshot
+    """
+
+    def __init__(self, location, trie_class=RadixTrieNode):
+        self.location = location
+        self.trie_class = trie_class
+        self.users = {}
+        self.changed = False
+        self.logger = logging.getLogger()
+
+    def load(self):
+        """
+        Reads the snapshot, leaving it empty if it is missing, unreadable or of another format
+        """
+        self.users = {}
+        self.changed = False
+        try:
+            payload = self._read()
+        except (OSError, ClientError) as e:
+            self.logger.info(f"No trie snapshot loaded from {self.location}: {e}")
+            return
+        try:
+            snapshot = decode_snapshot(payload)
+        except (ValueError, zlib.error) as e:
+            self.logger.warning(f"Ignoring unreadable trie snapshot {self.location}: {e}")
+            return
+        if snapshot.get('format') != SNAPSHOT_FORMAT or snapshot.get('trie') != self.trie_class.__name__:
+            self.logger.info(f"Ignoring trie snapshot {self.location} of another format")
+            return
+        self.users = snapshot['users']
+
+    def restore(self, user_id, documents):
+        """
+        Returns the user's TrieUser if the snapshot entry is still current, otherwise None
+
+        Parameters:
+        -----------
+        user_id : str
+            the id of the user
+        documents : list
+            the user's documents as stored in the database
+
+        Returns:
+        --------
+        trie_user : TrieUser
+            the restored trie and word index, or None if the user has to be rebuilt
+        """
+        entry = self.users.get(user_id)
+        if entry is None or entry['fingerprint'] != fingerprint(documents):
+            return None
+        try:
+            data = json.loads(entry['data'])
+            trie_documents = [Document(*fields) for fields in data['documents']]
+            trie = self._restore_trie(data['nodes'], trie_documents)
+            index = TitleSearchIndex.from_postings(trie_documents, data['words'])
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            self.logger.warning(f"Ignoring damaged trie snapshot entry of user {user_id}: {e}")
+            return None
+        return TrieUser(trie, user_id, index)
+
+    def update(self, trie_user, documents):
+        """
+        Replaces the entry of a user with their current trie
+
+        Parameters:
+        -----------
+        trie_user : TrieUser
+            the user's trie and word index
+        documents : list
+            the user's documents as stored in the database, the trie was built from
+        """
+        trie_documents = list(trie_user.index.documents.values())
+        positions = {document.id: position for position, document in enumerate(trie_documents)}
+        data = {
+            'documents': [[getattr(document, field) for field in DOCUMENT_FIELDS] for document in trie_documents],
+            'nodes': self._serialize_trie(trie_user.trie, positions),
+            'words': trie_user.index.postings(positions),
+        }
+        self.users[trie_user.user_id] = {
+            'fingerprint': fingerprint(documents),
+            'data': json.dumps(data, ensure_ascii=False, separators=(',', ':')),
+        }
+        self.changed = True
+
+    def save(self):
+        """
+        Writes the snapshot
+        """
+        snapshot = {'format': SNAPSHOT_FORMAT, 'trie': self.trie_class.__name__, 'users': self.users}
+        self._write(get_codec('zlib').encode(snapshot))
+        self.changed = False
+
+    def _serialize_trie(self, trie, positions):
+        nodes = []
+        stack = [('', trie)]
+        while stack:
+            label, node = stack.pop()
+            document = positions.get(node.document.id, -1) if node.is_end_of_word else -1
+            nodes.extend((label, document, node.count, len(node.children)))
+            # Pushed in reverse, so children are written in their dictionary order
+            stack.extend(reversed([(getattr(child, 'label', key), child) for key, child in node.children.items()]))
+        return nodes
+
+    def _restore_trie(self, nodes, documents):
+        radix = self.trie_class is RadixTrieNode
+        root = None
+        stack = []  # [node, children still to be attached]
+        fields = iter(nodes)
+        for label, position, count, children in zip(fields, fields, fields, fields):
+            if root is None:
+                node = root = self.trie_class(True)
+            else:
+                node = RadixTrieNode(label=label) if radix else self.trie_class()
+                parent = stack[-1]
+                parent[0].children[label[0] if radix else label] = node
+                parent[1] -= 1
+                if not parent[1]:
+                    stack.pop()
+            if position >= 0:
+                node.is_end_of_word = True
+                node.document = documents[position]
+            node.count = count
+            if children:
+                stack.append([node, children])
+        return root
+
+    def _read(self):
+        url = urlparse(self.location)
+        if url.scheme == 's3':
+            response = shared_s3_client().get_object(Bucket=url.netloc, Key=url.path.lstrip('/'))
+            return response['Body'].read()
+        with open(self.location, 'rb') as handle:
+            return handle.read()
+
+    def _write(self, payload):
+        url = urlparse(self.location)
+        if url.scheme == 's3':
+            shared_s3_client().put_object(Bucket=url.netloc, Key=url.path.lstrip('/'), Body=payload)
+            return
+        temp_path = f"{self.location}.tmp"
+        with open(temp_path, 'wb') as handle:
+            handle.write(payload)
+        os.replace(temp_path, self.location)
+
+
+def fingerprint(documents):
+    """
+    Returns a digest of the fields of a user's documents the trie depends on
+
+    The documents are taken in database order, so a reordering only costs
+    an unnecessary rebuild.
+
+    Parameters:
+    -----------
+    documents : list
+        the user's documents as stored in the database
+
+    Returns:
+    --------
+    fingerprint : str
+        a hex digest that changes when any document is added, removed or retitled
+    """
+    content = '\x1e'.join(f"{document.get('id')}\x1f{document.get('title')}\x1f{document.get('hashValue')}\x1f"
+                          f"{document.get('fileExt')}\x1f{document.get('uploadDate')}" for document in documents)
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
@@ -1,3 +1,7 @@
+from library.python.Metrics import METRICS
+from library.python.TitleSearchIndex import TitleSearchIndex
+
+
 class TrieUser:
     """
     A class to represent a TrieUser.
@@ -10,14 +14,22 @@ class TrieUser:
         a TrieNode object that represents the TrieNode of the user
     user_id : str
         a string that represents the unique id of the user
+    index : TitleSearchIndex
+        the word index over the titles of the user's documents
 
     Methods
     -------
-    __init__(self, trie, user_id)
+    __init__(self, trie, user_id, index=None)
         Constructs all the necessary attributes for the TrieUser object.
+
+    add_document(self, document)
+        Adds a document to the trie and the word index
+
+    remove_document(self, document)
+        Removes a document from the trie and the word index
     """
 
-    def __init__(self, trie, user_id):
+    def __init__(self, trie, user_id, index=None):
         """
         Constructs all the necessary attributes for the TrieUser object.
 
@@ -27,6 +39,35 @@ class TrieUser:
                 a TrieNode object that represents the TrieNode of the user
             user_id : str
                 a string that represents the unique id of the user
+            index : TitleSearchIndex
+                the word index over the titles of the user's documents, an empty one if not given
         """
         self.trie = trie
         self.user_id = user_id
+        self.index = index if index is not None else TitleSearchIndex()
+
+    def add_document(self, document):
+        """
+        Adds a document to the trie and the word index
+
+        Parameters
+        ----------
+            document : Document
+                a Document object representing the document to be added
+        """
+        with METRICS.time('trie_operation_duration_seconds', operation='insert'):
+            self.trie.insert(document)
+            self.index.insert(document)
+
+    def remove_document(self, document):
+        """
+        Removes a document from the trie and the word index
+
+        Parameters
+        ----------
+            document : Document
+                a Document object representing the document to be removed
+        """
+        with METRICS.time('trie_operation_duration_seconds', operation='remove'):
+            self.trie.remove(document)
+            self.index.remove(document)
@@ -0,0 +1,204 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TrieUserCache:
+    """
+    A least-recently-used cache of the users' TrieUsers, built on first use
+
+    A user's trie and word index are only built when a request needs them,
+    by calling ``load(user_id)``. When the cache holds more than
+    ``max_users`` users, or their tries more than ``max_documents``
+    documents, the least recently used users are evicted; they are built
+    again the next time they are needed. The number of documents stands in
+    for memory, which grows linearly with it.
+
+    Users are built outside the cache's lock, so a slow build doesn't hold
+    up the requests of other users; concurrent misses for the same user
+    wait for the one build in progress. A user discarded while being built,
+    e.g. because their documents changed, isn't cached when the build
+    completes, as it may have read the documents before the change.
+
+    Attributes:
+    ----------
+    load : callable
+        a function returning the TrieUser of a user id, or None if there is no such user
+    max_users : int
+        the largest number of users kept, None for no limit
+    max_documents : int
+        the largest number of documents kept over all users, None for no limit
+
+    Methods:
+    --------
+    get(self, user_id)
+        Returns the TrieUser of a user, building it on a miss
+
+    peek(self, user_id)
+        Returns the TrieUser of a user if it is cached, without building it
+
+    put(self, trie_user)
+        Adds an already built TrieUser
+
+    discard(self, user_id)
+        Drops the TrieUser of a user, so it is rebuilt the next time it is needed
+
+    clear(self)
+        Drops every TrieUser
+
+    stats(self)
+        Returns the cache counters
+    """
+
+    def __init__(self, load, max_users=None, max_documents=None):
+        self.load = load
+        self.max_users = max_users
+        self.max_documents = max_documents
+
+        self._trie_users = OrderedDict()  # user id -> TrieUser, least recently used first
+        self._building = {}  # user id -> Future of the build in progress
+        # Only held to look up and publish, never while a user is built
+        self._lock = threading.RLock()
+        self._counters = {'hits': 0, 'misses': 0, 'builds': 0, 'evictions': 0, 'build_seconds': 0.0}
+
+    def __len__(self):
+        return len(self._trie_users)
+
+    def __contains__(self, user_id):
+        return user_id in self._trie_users
+
+    def get(self, user_id):
+        """
+        Returns the TrieUser of a user, building it on a miss
+
+        Parameters:
+        -----------
+        user_id : str
+            the id of the user
+
+        Returns:
+        --------
+        trie_user : TrieUser
+            the user's trie and word index, or None if the user doesn't exist
+        """
+        with self._lock:
+            trie_user = self._trie_users.get(user_id)
+            if trie_user is not None:
+                self._trie_users.move_to_end(user_id)
+                self._counters['hits'] += 1
+                return trie_user
+
+            self._counters['misses'] += 1
+            build = self._building.get(user_id)
+            building_elsewhere = build is not None
+            if not building_elsewhere:
+                build = self._building[user_id] = Future()
+        if building_elsewhere:
+            return build.result()
+
+        started = time.perf_counter()
+        try:
+            trie_user = self.load(user_id)
+        except BaseException as e:
+            with self._lock:
+                self._finish_build(user_id, build)
+            build.set_exception(e)
+            raise
+        with self._lock:
+            # A user discarded meanwhile may have been built from documents that have changed since
+            if self._finish_build(user_id, build) and trie_user is not None:
+                self.put(trie_user)
+            if trie_user is not None:
+                self._counters['builds'] += 1
+                self._counters['build_seconds'] += time.perf_counter() - started
+        build.set_result(trie_user)
+        return trie_user
+
+    def peek(self, user_id):
+        """
+        Returns the TrieUser of a user if it is cached, without building it or counting a hit
+
+        Parameters:
+        -----------
+        user_id : str
+            the id of the user
+
+        Returns:
+        --------
+        trie_user : TrieUser
+            the user's trie and word index, or None if it isn't cached
+        """
+        with self._lock:
+            return self._trie_users.get(user_id)
+
+    def put(self, trie_user):
+        """
+        Adds an already built TrieUser, evicting others if the cache is over budget
+
+        Parameters:
+        -----------
+        trie_user : TrieUser
+            the user's trie and word index
+        """
+        with self._lock:
+            self._trie_users[trie_user.user_id] = trie_user
+            self._trie_users.move_to_end(trie_user.user_id)
+            self._evict()
+
+    def discard(self, user_id):
+        """
+        Drops the TrieUser of a user, so it is rebuilt the next time it is needed
+
+        A build of the user in progress isn't cached when it completes.
+
+        Parameters:
+        -----------
+        user_id : str
+            the id of the user
+        """
+        with self._lock:
+            self._trie_users.pop(user_id, None)
+            self._building.pop(user_id, None)
+
+    def clear(self):
+        """
+        Drops every TrieUser
+        """
+        with self._lock:
+            self._trie_users.clear()
+            self._building.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters
+
+        Returns:
+        --------
+        stats : dict
+            hits, misses, builds, evictions and the seconds spent building, with
+            the number of users and documents currently cached
+        """
+        with self._lock:
+            return {**self._counters, 'build_seconds': round(self._counters['build_seconds'], 3),
+                    'users': len(self._trie_users), 'documents': self._documents()}
+
+    def _finish_build(self, user_id, build):
+        # Whether the build was still the current one of the user
+        if self._building.get(user_id) is not build:
+            return False
+        del self._building[user_id]
+        return True
+
+    def _documents(self):
+        return sum(len(trie_user.index) for trie_user in self._trie_users.values())
+
+    def _evict(self):
+        # The most recently used user is always kept, even if it alone is over budget
+        documents = self._documents() if self.max_documents is not None else 0
+        while len(self._trie_users) > 1 and (
+                (self.max_users is not None and len(self._trie_users) > self.max_users)
+                or (self.max_documents is not None and documents > self.max_documents)):
+            _, trie_user = self._trie_users.popitem(last=False)
+            documents -= len(trie_user.index)
+            self._counters['evictions'] += 1
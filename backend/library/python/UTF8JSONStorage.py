@@ -1,25 +1,121 @@
+import glob
 import json
-import codecs
+import os
+import uuid
+import zlib
+
 from tinydb.storages import JSONStorage
 
+from library.python.Metrics import METRICS
+from library.python.SnapshotCodec import decode_snapshot, get_codec, split_chunks
+
+# Key of the small document written to the database file when the snapshot is split into chunk files
+CHUNK_MANIFEST_KEY = '__snapshot_chunks__'
+
 
 class UTF8JSONStorage(JSONStorage):
-    def __init__(self, path, create_dirs=False, encoding='utf-8', sort_keys=True, indent=4, separators=(',', ': ')):
+    """
+    A TinyDB JSON storage that writes UTF-8 and optionally compresses or splits the snapshot
+
+    ``generation`` is bumped whenever a read finds the file different from
+    what this storage last read or wrote, i.e. written by another process, so
+    IndexedTable drops the indexes it built from the older data. Files are
+    compared by length and CRC-32, as mtimes are too coarse to tell apart
+    writes of the same size within a few milliseconds.
+    """
+
+    def __init__(self, path, create_dirs=False, encoding='utf-8', sort_keys=True, indent=4, separators=(',', ': '),
+                 codec=None, chunk_size=None):
         super().__init__(path, create_dirs)
+        # Reads and writes open the file themselves; an open handle would block the atomic rename on Windows
+        self._handle.close()
         self.path = path
         self.encoding = encoding
         self.sort_keys = sort_keys
         self.indent = indent
         self.separators = separators
+        self.codec = get_codec(codec) if codec else None
+        self.chunk_size = chunk_size
+        self.last_read_bytes = 0
+        self.last_write_bytes = 0
+        self.generation = 0
+        self._fingerprint = None  # (length, CRC-32) of the file as last read or written
 
     def read(self):
-        with codecs.open(self.path, 'r', encoding=self.encoding) as handle:
+        # Read bytes and let the codec detection decide, so a file written with
+        # any DB_SNAPSHOT_CODEC stays readable whatever the current setting is
+        with open(self.path, 'rb') as handle:
             content = handle.read()
-            if not content.strip():  # Check if the file is empty or contains only whitespace
-                print(f"File {self.path} is empty or contains only whitespace.")
-                return None
-            return json.loads(content)
+        self.last_read_bytes = len(content)
+        self._check_fingerprint(content)
+        if not content.strip():  # Check if the file is empty or contains only whitespace
+            print(f"File {self.path} is empty or contains only whitespace.")
+            return None
+        data = decode_snapshot(content)
+        if CHUNK_MANIFEST_KEY in data:
+            data = self._read_chunks(data[CHUNK_MANIFEST_KEY])
+        return data
 
     def write(self, data):
-        with codecs.open(self.path, 'w', encoding=self.encoding) as handle:
-            json.dump(data, handle, indent=self.indent, separators=self.separators)
+        if self.codec is None:
+            with METRICS.time('snapshot_encode_duration_seconds', codec='json-pretty'):
+                content = json.dumps(data, indent=self.indent, separators=self.separators).encode(self.encoding)
+            with open(self.path, 'wb') as handle:
+                handle.write(content)
+            self.last_write_bytes = len(content)
+            self._fingerprint = _fingerprint(content)
+            return
+
+        payload = self.codec.encode(data)
+        chunks = split_chunks(payload, self.chunk_size)
+        if len(chunks) == 1:
+            self._replace(self.path, payload)
+            self._fingerprint = _fingerprint(payload)
+            self._remove_chunk_files()
+        else:
+            # Chunk files are named after a fresh generation, and only the final
+            # rename of the manifest switches readers over to them
+            generation = uuid.uuid4().hex[:12]
+            for index, chunk in enumerate(chunks):
+                self._replace(self._chunk_path(generation, index), chunk)
+            manifest = json.dumps({CHUNK_MANIFEST_KEY: {'generation': generation, 'chunks': len(chunks)}})
+            self._replace(self.path, manifest.encode('utf-8'))
+            self._fingerprint = _fingerprint(manifest.encode('utf-8'))
+            self._remove_chunk_files(keep=generation)
+        self.last_write_bytes = len(payload)
+
+    def _check_fingerprint(self, content):
+        # A manifest names a fresh generation of chunk files on every write, so it changes with them
+        fingerprint = _fingerprint(content)
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            self.generation += 1
+
+    def _read_chunks(self, manifest):
+        parts = []
+        for index in range(manifest['chunks']):
+            with open(self._chunk_path(manifest['generation'], index), 'rb') as handle:
+                parts.append(handle.read())
+        self.last_read_bytes += sum(len(part) for part in parts)
+        return decode_snapshot(b''.join(parts))
+
+    def _chunk_path(self, generation, index):
+        return f"{self.path}.chunk-{generation}-{index:04d}"
+
+    def _remove_chunk_files(self, keep=None):
+        for chunk_path in glob.glob(f"{glob.escape(self.path)}.chunk-*"):
+            if keep is None or not chunk_path.startswith(f"{self.path}.chunk-{keep}-"):
+                os.remove(chunk_path)
+
+    @staticmethod
+    def _replace(path, content):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as handle:
+            handle.write(content)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, path)
+
+
+def _fingerprint(content):
+    return len(content), zlib.crc32(content)
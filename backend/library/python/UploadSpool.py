@@ -0,0 +1,250 @@
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+from werkzeug.formparser import MultiPartParser
+from werkzeug.http import parse_options_header
+
+from library.python.Metrics import METRICS
+from library.python.S3Client import TRANSFER_CONFIG
+
+# Size of the reads from the request body, and so of the writes to the spool
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Size of the parts of an S3 multipart upload; S3 requires at least 5 MiB for all but the last
+S3_PART_SIZE = 8 * 1024 * 1024
+
+
+class UploadSpool:
+    """
+    A writable file that hashes an uploaded file while storing it
+
+    The request body is parsed straight into a spool, so the upload is read
+    once: every chunk updates the SHA-256 and goes to the destination. Only
+    then is the content-addressed name known; ``commit`` moves the upload
+    there, ``discard`` drops it, e.g. when it turns out to be a duplicate.
+
+    Attributes:
+    ----------
+    content_type : str
+        the content type the client sent for the file
+    size : int
+        the number of bytes written
+
+    Methods:
+    --------
+    write(self, data)
+        Hashes and stores a chunk of the file
+
+    hexdigest(self)
+        Returns the SHA-256 of the bytes written so far
+
+    commit(self, name)
+        Stores the file under its final name and returns where it is
+
+    discard(self)
+        Drops the file
+    """
+
+    def __init__(self, content_type=None):
+        self.content_type = content_type
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        """
+        Hashes and stores a chunk of the file
+
+        Parameters:
+        -----------
+        data : bytes
+            the next chunk of the file
+        """
+        started = time.perf_counter()
+        self._sha256.update(data)
+        METRICS.throughput('hash', len(data), time.perf_counter() - started)
+        self._store(data)
+        self.size += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        # Called by the form parser once the file is complete; the spool is write-only
+        return self.size
+
+    def tell(self):
+        return self.size
+
+    def hexdigest(self):
+        """
+        Returns the SHA-256 of the bytes written so far
+        """
+        return self._sha256.hexdigest()
+
+    def commit(self, name):
+        """
+        Stores the file under its final name and returns where it is
+
+        Parameters:
+        -----------
+        name : str
+            the name of the file in the spool's folder or S3 prefix
+
+        Returns:
+        --------
+        location : str
+            the file path or S3 key the file was stored at
+        """
+        raise NotImplementedError
+
+    def discard(self):
+        """
+        Drops the file
+        """
+        raise NotImplementedError
+
+    def _store(self, data):
+        raise NotImplementedError
+
+
+class LocalUploadSpool(UploadSpool):
+    """
+    An UploadSpool writing to a temporary file in the upload folder
+
+    The temporary file is renamed to its final name on commit, which is
+    atomic because both are in the same folder, so a stored file is never
+    seen half written.
+    """
+
+    def __init__(self, folder, content_type=None):
+        super().__init__(content_type)
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=folder, prefix='.upload-', delete=False)
+
+    def commit(self, name):
+        self._file.close()
+        path = os.path.join(self.folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self._file.name, path)
+        return path
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self._file.name)
+        except FileNotFoundError:
+            pass
+
+    def _store(self, data):
+        self._file.write(data)
+
+
+class S3UploadSpool(UploadSpool):
+    """
+    An UploadSpool uploading to S3 while the request is read
+
+    A file smaller than one part is kept in memory and put under its final
+    key on commit. A larger one is sent as a multipart upload to a staging
+    key under ``{prefix}/.staging/``, one part at a time, and copied to its
+    final key within S3 on commit, so at most one part is ever held in memory.
+    """
+
+    def __init__(self, s3, bucket, prefix, content_type=None, part_size=S3_PART_SIZE, transfer_config=TRANSFER_CONFIG):
+        super().__init__(content_type)
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.transfer_config = transfer_config
+        self.staging_key = os.path.join(prefix, '.staging', str(uuid.uuid4()))
+        self.part_size = part_size
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def commit(self, name):
+        key = os.path.join(self.prefix, name)
+        extra_args = {'ContentType': self.content_type} if self.content_type else {}
+        if self._upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=bytes(self._buffer), **extra_args)
+            return key
+        if self._buffer:
+            self._upload_part()
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.staging_key, UploadId=self._upload_id,
+                                          MultipartUpload={'Parts': self._parts})
+        # A managed copy, so files over the 5 GB limit of a single copy work too
+        self.s3.copy({'Bucket': self.bucket, 'Key': self.staging_key}, self.bucket, key, Config=self.transfer_config)
+        self.s3.delete_object(Bucket=self.bucket, Key=self.staging_key)
+        return key
+
+    def discard(self):
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.staging_key, UploadId=self._upload_id)
+            self._upload_id = None
+
+    def _store(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            extra_args = {'ContentType': self.content_type} if self.content_type else {}
+            response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.staging_key, **extra_args)
+            self._upload_id = response['UploadId']
+        part_number = len(self._parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.staging_key, UploadId=self._upload_id,
+                                       PartNumber=part_number, Body=bytes(self._buffer))
+        self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self._buffer = bytearray()
+
+
+def parse_multipart_upload(stream, content_type, content_length, create_spool, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Parses a multipart/form-data request body, streaming each file into a spool
+
+    Parameters:
+    -----------
+    stream : file
+        the request body
+    content_type : str
+        the Content-Type header of the request, with the multipart boundary
+    content_length : int
+        the Content-Length of the request, or None
+    create_spool : callable
+        called with the content type of each file part, returns the UploadSpool to write it to
+    chunk_size : int
+        the number of bytes read from the body at a time
+
+    Returns:
+    --------
+    form : MultiDict
+        the form fields
+    files : MultiDict
+        a FileStorage for each file part, whose stream is its UploadSpool
+
+    Raises:
+    -------
+    ValueError
+        if the request isn't multipart/form-data
+    """
+    mimetype, options = parse_options_header(content_type or '')
+    if mimetype != 'multipart/form-data' or not options.get('boundary'):
+        raise ValueError('The request is not multipart/form-data')
+
+    spools = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        spool = create_spool(content_type)
+        spools.append(spool)
+        return spool
+
+    parser = MultiPartParser(stream_factory, buffer_size=chunk_size)
+    try:
+        return parser.parse(stream, options['boundary'].encode('latin-1'), content_length)
+    except Exception:
+        for spool in spools:
+            spool.discard()
+        raise
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from tinydb.middlewares import Middleware
+
+from library.python.ConcurrentModificationError import ConcurrentModificationError
+
+
+class LostWritesError(Exception):
+    """
+    Raised when a flush of several cached writes is rejected because another writer got there first
+
+    The writes were based on outdated data and have been dropped, so they
+    can't be retried the way a single rejected write is.
+    """
+
+
+class WriteBehindCachingMiddleware(Middleware):
+    """
+    A TinyDB middleware that serves reads from an in-process copy of the
+    database and coalesces writes
+
+    Writes only update the in-process copy. The copy is written to the wrapped
+    storage once ``flush_every`` writes are pending, once ``flush_interval``
+    seconds have passed since the last flush, or when ``flush`` is called
+    explicitly (the Flask app does this after every request).
+
+    Attributes:
+    ----------
+    flush_every : int
+        the number of pending writes that triggers a flush
+    flush_interval : float
+        the number of seconds after which pending writes are flushed on the next write
+    read_ttl : float
+        the number of seconds a clean copy is served before it is re-read
+        from the storage, or None to keep it until the process ends
+
+    Methods:
+    --------
+    read(self)
+        Returns the in-process copy, reading it from the storage if needed
+
+    write(self, data)
+        Replaces the in-process copy and flushes if a threshold is reached
+
+    flush(self)
+        Writes pending changes to the storage
+
+    stats(self)
+        Returns the cache counters
+    """
+
+    def __init__(self, storage_cls, flush_every=100, flush_interval=5.0, read_ttl=None):
+        super().__init__(storage_cls)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.read_ttl = read_ttl
+
+        self.cache = None
+        self._lock = threading.RLock()
+        self._pending_writes = 0
+        self._loaded_at = 0.0
+        self._flushed_at = time.monotonic()
+        self._counters = {'hits': 0, 'misses': 0, 'writes': 0, 'flushes': 0, 'bytes_written': 0, 'conflicts': 0}
+
+    def read(self):
+        with self._lock:
+            if self.cache is None or self._is_expired():
+                self.cache = self.storage.read()
+                self._loaded_at = time.monotonic()
+                self._counters['misses'] += 1
+            else:
+                self._counters['hits'] += 1
+            return self.cache
+
+    def write(self, data):
+        with self._lock:
+            self.cache = data
+            self._pending_writes += 1
+            self._counters['writes'] += 1
+            if self._pending_writes >= self.flush_every \
+                    or time.monotonic() - self._flushed_at >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """
+        Writes pending changes to the storage
+
+        If the storage rejects them because another writer committed first,
+        the cached copy is dropped. A single pending write raises the
+        storage's ConcurrentModificationError, so the table retries it
+        against fresh data; several raise LostWritesError, and the request
+        that made them has to fail.
+        """
+        with self._lock:
+            if self._pending_writes:
+                try:
+                    self.storage.write(self.cache)
+                except ConcurrentModificationError as e:
+                    # The copy holds changes made to outdated data. Drop it, so the next read
+                    # goes to the storage and later writes don't repeat the rejected one
+                    pending_writes = self._pending_writes
+                    self.cache = None
+                    self._pending_writes = 0
+                    self._counters['conflicts'] += 1
+                    if pending_writes > 1:
+                        raise LostWritesError(f"{pending_writes} cached writes were rejected and dropped") from e
+                    raise
+                self._pending_writes = 0
+                self._counters['flushes'] += 1
+                self._counters['bytes_written'] += getattr(self.storage, 'last_write_bytes', 0)
+                self._loaded_at = time.monotonic()
+            self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.storage.close()
+
+    def stats(self):
+        """
+        Returns the cache counters
+
+        Returns:
+        --------
+        stats : dict
+            hits, misses, writes, flushes, bytes_written and rejected flushes
+            (conflicts) since startup, plus the number of writes not flushed yet
+        """
+        with self._lock:
+            return {**self._counters, 'pending_writes': self._pending_writes}
+
+    def _is_expired(self):
+        # Never drop a copy that still holds unflushed writes
+        return self.read_ttl is not None and not self._pending_writes \
+            and time.monotonic() - self._loaded_at >= self.read_ttl
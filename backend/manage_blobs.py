@@ -0,0 +1,61 @@
+"""
+Maintains the store of the uploaded files
+
+    python manage_blobs.py migrate
+    python manage_blobs.py gc [--grace-hours 24] [--dry-run]
+
+The store is the one the application uses, configured by the same
+environment variables (USE_S3, S3_BUCKET_NAME, UPLOAD_FOLDER and the
+database settings). ``migrate`` moves the files stored before sharding,
+directly under UPLOAD_FOLDER, to their sharded keys. ``gc`` aborts the
+resumable uploads started before the grace period, then deletes the files
+no document references and the leftovers of failed uploads, once they are
+older than the grace period. Both end with the calls made to the store.
+"""
+import argparse
+import time
+
+from helpers import create_blob_store, db
+from library.python.BlobStore import GC_GRACE_PERIOD
+from library.python.ChunkedUpload import ChunkedUploads
+from library.python.Database import Database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('migrate', 'gc'))
+    parser.add_argument('--grace-hours', type=float, default=GC_GRACE_PERIOD / 3600,
+                        help="the age a file must have to be collected")
+    parser.add_argument('--dry-run', action='store_true', help="list the files gc would delete without deleting them")
+    args = parser.parse_args()
+
+    blob_store = create_blob_store()
+    started = time.perf_counter()
+    if args.command == 'migrate':
+        moved = blob_store.migrate()
+        print(f"Moved {moved} files to their sharded keys in {time.perf_counter() - started:.1f}s")
+        print_stats(blob_store)
+        return
+
+    if not args.dry_run:
+        expired = ChunkedUploads(db, blob_store).expire(args.grace_hours * 3600)
+        print(f"Aborted {len(expired)} resumable uploads")
+    deleted = blob_store.collect_garbage(args.grace_hours * 3600, dry_run=args.dry_run)
+    for key in deleted:
+        print(key)
+    print(f"{'Would delete' if args.dry_run else 'Deleted'} {len(deleted)} files in {time.perf_counter() - started:.1f}s")
+    print_stats(blob_store)
+
+
+def print_stats(blob_store):
+    for operation, stats in blob_store.stats().items():
+        print(f"{operation}: {stats['calls']} calls, {stats['errors']} failed, "
+              f"{stats['mean_ms']} ms mean, {stats['max_ms']} ms max")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        # The removed upload sessions would otherwise be lost with the write-behind cache at exit
+        Database().flush()
@@ -0,0 +1,73 @@
+"""
+Converts the persisted database between snapshot codecs and compares the codecs
+
+    python migrate_snapshot.py report [--path db.json]
+    python migrate_snapshot.py convert --codec zlib [--path db.json] [--chunk-size BYTES]
+    python migrate_snapshot.py convert --codec zlib --dynamodb-table dms
+
+The snapshot is read with the current storage, which recognises every codec,
+and written back with the requested one. Conversion of a DynamoDB dump goes
+through the versioned conditional write, so it fails instead of overwriting
+changes made while it runs.
+"""
+import argparse
+import time
+
+from library.python.DynamoDbCachedStorage import DynamoDbCachedStorage
+from library.python.SnapshotCodec import CODECS, get_codec
+from library.python.UTF8JSONStorage import UTF8JSONStorage
+
+
+def open_storage(args, codec):
+    if args.dynamodb_table:
+        return DynamoDbCachedStorage(args.dynamodb_table, codec=codec, chunk_size=args.chunk_size)
+    return UTF8JSONStorage(args.path, codec=codec, chunk_size=args.chunk_size)
+
+
+def convert(args):
+    storage = open_storage(args, args.codec)
+    data = storage.read()
+    if not data:
+        print("Nothing to convert, the database is empty")
+        return
+    storage.write(data)
+    print(f"Wrote {storage.last_write_bytes} bytes with the {args.codec} codec")
+
+
+def report(args, repeat=5):
+    data = open_storage(args, None).read() or {}
+    baseline = None
+    print(f"{'codec':<12}{'bytes':>12}{'ratio':>8}{'encode ms':>12}{'decode ms':>12}")
+    for name in CODECS:
+        codec = get_codec(name)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            payload = codec.encode(data)
+        encode_ms = (time.perf_counter() - started) * 1000 / repeat
+        started = time.perf_counter()
+        for _ in range(repeat):
+            codec.decode(payload)
+        decode_ms = (time.perf_counter() - started) * 1000 / repeat
+        baseline = baseline or len(payload)
+        print(f"{name:<12}{len(payload):>12}{len(payload) / baseline:>8.2f}{encode_ms:>12.1f}{decode_ms:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('convert', 'report'))
+    parser.add_argument('--codec', choices=tuple(CODECS), help="the codec to convert to")
+    parser.add_argument('--path', default='./db.json', help="the JSON database file")
+    parser.add_argument('--dynamodb-table', help="convert the dump in this DynamoDB table instead of the file")
+    parser.add_argument('--chunk-size', type=int, help="split snapshots larger than this many bytes")
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        if not args.codec:
+            parser.error("convert needs --codec")
+        convert(args)
+    else:
+        report(args)
+
+
+if __name__ == '__main__':
+    main()
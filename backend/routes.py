@@ -1,29 +1,58 @@
-import hashlib
 import logging
+import operator
 import os
-import random
-import string
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import reduce
 
-import boto3
-import requests
 from botocore.exceptions import ClientError
-from flask import Blueprint, send_file, jsonify, request, current_app
+from flask import Blueprint, send_file, jsonify, request, current_app, redirect
 from flask_cors import cross_origin
 from tinydb import Query
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 
-from helpers import compute_file_hash, initialize_trie_users
+from helpers import create_blob_store, create_trie_user_cache, open_trie_snapshot, sync_trie_users
+from library.python.ChangeLog import ChangeLog
+from library.python.ChunkedUpload import ChunkedUploads, DEFAULT_PART_SIZE, MAX_PARTS
+from library.python.CorpusGenerator import CorpusGenerator, seed_documents
 from library.python.Database import Database
 from library.python.Document import Document as TrieDocument
+from library.python.Metrics import METRICS
+from library.python.PresignedUrlCache import PresignedUrlCache
+from library.python.UploadSpool import parse_multipart_upload
 
 # Upload Path Configuration
 UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', './uploads')
 use_s3 = os.environ.get('USE_S3', 'false').lower() == 'true'
 use_dynamodb = os.environ.get('USE_DYNAMODB', 'false').lower() == 'true'
 
-# Initialize other global variables
-trieUsersMap = initialize_trie_users()
+# Number of autocomplete results returned when the request doesn't ask for a limit, and the most it may ask for
+SEARCH_DEFAULT_LIMIT = int(os.environ.get('SEARCH_DEFAULT_LIMIT', 20))
+SEARCH_MAX_LIMIT = int(os.environ.get('SEARCH_MAX_LIMIT', 100))
+
+# Largest edit budget a fuzzy /search may ask for; the walked part of the trie grows quickly with it
+SEARCH_MAX_EDITS = int(os.environ.get('SEARCH_MAX_EDITS', 2))
+
+# Threads storing the files of a batch upload in the blob store, where S3 round trips dominate
+UPLOAD_BATCH_WORKERS = int(os.environ.get('UPLOAD_BATCH_WORKERS', 8))
+
+# Response headers of /search the frontend needs to read across origins
+SEARCH_HEADERS = ['X-Total-Count', 'X-Next-Cursor']
+
+# Seconds a presigned download URL is signed for, and the least it must still be valid for to be handed out again
+PRESIGNED_URL_EXPIRY = int(os.environ.get('PRESIGNED_URL_EXPIRY', 3600))
+PRESIGNED_URL_MIN_REMAINING = int(os.environ.get('PRESIGNED_URL_MIN_REMAINING', 900))
+
+# Most presigned download URLs kept
+PRESIGNED_URL_CACHE_SIZE = int(os.environ.get('PRESIGNED_URL_CACHE_SIZE', 10000))
+
+# Response headers of /download the frontend needs to read across origins, to resume and revalidate downloads
+DOWNLOAD_HEADERS = ['ETag', 'Accept-Ranges', 'Content-Range']
+
+# The users' tries are built on their first search, upload or delete, restored from the snapshot when it is current
+trieSnapshot = open_trie_snapshot()
+trieUsersCache = create_trie_user_cache(trieSnapshot)
 
 logging.info(f"UPLOAD_FOLDER: {UPLOAD_FOLDER}")
 
@@ -33,6 +62,47 @@ if not use_s3 and not use_dynamodb:
 
 db = Database().get_db()
 
+# The uploaded files, sharded by hash and shared by the documents with the same content
+blobStore = create_blob_store()
+
+# Resumable uploads sent in parts, see /documents/uploads
+chunkedUploads = ChunkedUploads(db, blobStore)
+
+# Download links handed out again while they are valid, so the same file keeps the same URL
+presignedUrls = PresignedUrlCache(PRESIGNED_URL_EXPIRY, PRESIGNED_URL_MIN_REMAINING, PRESIGNED_URL_CACHE_SIZE)
+
+# Documents written by other workers or containers, checked at most every TRIE_SYNC_INTERVAL seconds
+documentChanges = ChangeLog(db, 'documents', float(os.environ.get('TRIE_SYNC_INTERVAL', 1)))
+
+
+def collect_cache_metrics():
+    """
+    Returns the counters and sizes of the caches as metric samples, read at every render of /metrics
+
+    The presigned URL cache records its counters itself; only its size is collected here.
+    """
+    trie_stats = trieUsersCache.stats()
+    samples = [('trie_user_cache_events_total', 'counter', trie_stats[event], {'event': event})
+               for event in ('hits', 'misses', 'builds', 'evictions')]
+    samples += [
+        ('trie_user_cache_build_seconds_total', 'counter', trie_stats['build_seconds'], {}),
+        ('trie_user_cache_users', 'gauge', trie_stats['users'], {}),
+        ('trie_user_cache_documents', 'gauge', trie_stats['documents'], {}),
+        ('presigned_url_cache_urls', 'gauge', presignedUrls.stats()['urls'], {}),
+    ]
+    cache_stats = Database().cache_stats()
+    if cache_stats:
+        samples += [('write_behind_cache_events_total', 'counter', cache_stats[event], {'event': event})
+                    for event in ('hits', 'misses', 'writes', 'flushes', 'conflicts')]
+        samples += [
+            ('write_behind_cache_bytes_written_total', 'counter', cache_stats['bytes_written'], {}),
+            ('write_behind_cache_pending_writes', 'gauge', cache_stats['pending_writes'], {}),
+        ]
+    return samples
+
+
+METRICS.register_collector(collect_cache_metrics)
+
 search_bp = Blueprint('search', __name__)
 upload_file_bp = Blueprint('upload_file', __name__)
 download_bp = Blueprint('download', __name__)
@@ -41,27 +111,69 @@ delete_bp = Blueprint('delete', __name__)
 add_dummy_documents_bp = Blueprint('add_dummy_documents', __name__)
 
 
+def sync_tries():
+    # Bring the cached tries up to date before a request reads or changes them
+    sync_trie_users(trieUsersCache, documentChanges)
+
+
+for blueprint in (search_bp, upload_file_bp, delete_bp, add_dummy_documents_bp):
+    blueprint.before_request(sync_tries)
+
+
 @search_bp.route('/search', methods=['GET'])
 def search():
-    # from app import trieUsersMap  # Lazy import
-
     # Get the user id and document title from the query parameters
     user_id = request.args.get('user_id')
-    title = request.args.get('title')
+    title = request.args.get('title', '')
+    cursor = request.args.get('cursor')
+    # 'words' matches the start of any word of the title, 'prefix' only the start of the whole title
+    match = request.args.get('match', 'words')
+    if match not in ('words', 'prefix'):
+        return {'message': "match must be 'words' or 'prefix'"}, 400
+    try:
+        limit = int(request.args.get('limit', SEARCH_DEFAULT_LIMIT))
+    except ValueError:
+        return {'message': 'limit must be a number'}, 400
+    if limit < 1:
+        return {'message': 'limit must be at least 1'}, 400
+    limit = min(limit, SEARCH_MAX_LIMIT)
+    fuzzy = request.args.get('fuzzy', 'false').lower() in ('1', 'true')
+    try:
+        max_edits = int(request.args.get('max_edits', 1))
+    except ValueError:
+        return {'message': 'max_edits must be a number'}, 400
+    if not 0 <= max_edits <= SEARCH_MAX_EDITS:
+        return {'message': f'max_edits must be between 0 and {SEARCH_MAX_EDITS}'}, 400
 
-    # Fetch the TrieNode for the corresponding user id
-    trie_user = trieUsersMap.get(user_id)
+    # Fetch the TrieNode for the corresponding user id, building it if it isn't cached
+    trie_user = trieUsersCache.get(user_id)
 
     if not trie_user:
         return {'message': 'User not found'}, 404
 
-    # Search the TrieNode for the document using the title
-    documents = trie_user.trie.search(title)
+    if fuzzy:
+        # Tolerate typos: the closest titles first, each with its edit distance
+        with METRICS.time('trie_operation_duration_seconds', operation='fuzzy_search'):
+            matches, total = trie_user.trie.fuzzy_search_page(title, max_edits, limit)
+        documents_dict = [{**document.__dict__, 'editDistance': distance} for document, distance in matches]
+        return documents_dict, 200, {'X-Total-Count': str(total)}
+
+    # Search the word index or the TrieNode for the best ranked documents using the title
+    search_index = trie_user.index if match == 'words' else trie_user.trie
+    try:
+        with METRICS.time('trie_operation_duration_seconds', operation=f'{match}_search'):
+            documents, total, next_cursor = search_index.search_page(title, limit, cursor)
+    except ValueError as e:
+        return {'message': str(e)}, 400
 
     # Convert the documents to a list of dictionaries for the response
     documents_dict = [document.__dict__ for document in documents]
 
-    return documents_dict, 200
+    # The body stays a plain list, the total ("k of N") and continuation go in headers
+    headers = {'X-Total-Count': str(total)}
+    if next_cursor:
+        headers['X-Next-Cursor'] = next_cursor
+    return documents_dict, 200, headers
 
 
 def case_insensitive_equals(field_value, comparison_value):
@@ -93,98 +205,343 @@ def validate_title():
 @upload_file_bp.route('/documents/upload', methods=['POST'])
 @cross_origin()  # This enables CORS for this specific route
 def upload_file():
-    # check if the post request has the file part
-    if 'file' not in request.files:
+    # Read the request body once: the file is hashed while it is stored, see UploadSpool
+    try:
+        form, files = parse_multipart_upload(request.stream, request.content_type, request.content_length,
+                                             blobStore.create_spool)
+    except ValueError:
+        return {'message': 'No file part in the request'}, 400
+
+    file = files.get('file')
+    handed_over = False
+    try:
+        # check if the post request has the file part
+        if file is None:
+            return {'message': 'No file part in the request'}, 400
+
+        user_id = form.get('userId')
+        title = (form.get('title') or '').strip()
+        categories = form.get('categories')
+
+        if not title:
+            return {'message': 'Title is required'}, 400
+
+        if not categories:
+            return {'message': 'Categories are required'}, 400
+
+        # if user does not select file, browser submits an empty part without filename
+        if file.filename == '':
+            return {'message': 'No selected file'}, 400
+
+        handed_over = True
+        return store_uploaded_document(file.stream, user_id, title, categories, file.filename, file.content_type)
+    finally:
+        # Drop every spooled file that wasn't handed over: rejected uploads and any extra file parts
+        for _, part in files.items(multi=True):
+            if part is not file or not handed_over:
+                part.stream.discard()
+
+
+@upload_file_bp.route('/documents/upload/batch', methods=['POST'])
+@cross_origin()
+def upload_files():
+    # Many files sent as 'files' parts of one request, with optional 'titles' in the same order
+    try:
+        form, files = parse_multipart_upload(request.stream, request.content_type, request.content_length,
+                                             blobStore.create_spool)
+    except ValueError:
         return {'message': 'No file part in the request'}, 400
 
-    user_id = request.form.get('userId')
-    file = request.files['file']
-    title = request.form.get('title').strip()
-    categories = request.form.get('categories')
+    uploads = files.getlist('files')
+    stored = set()
+    try:
+        if not uploads:
+            return {'message': 'No file part in the request'}, 400
+        categories = form.get('categories')
+        if not categories:
+            return {'message': 'Categories are required'}, 400
+        titles = form.getlist('titles')
+        if titles and len(titles) != len(uploads):
+            return {'message': 'Give a title for every file, or none'}, 400
+
+        results = store_uploaded_documents(uploads, form.get('userId'), titles, categories.split(','), stored)
+        return {'message': f"{sum(result['status'] == 'uploaded' for result in results)} of {len(results)} "
+                           f"files uploaded", 'results': results}, 200
+    except Exception as e:
+        return {'message': str(e)}, 500
+    finally:
+        for _, part in files.items(multi=True):
+            if id(part) not in stored:
+                part.stream.discard()
+
+
+def store_uploaded_documents(uploads, user_id, titles, categories, stored):
+    """
+    Stores the files of a batch upload as new documents, skipping those whose content already exists
+
+    The files are checked against the documents in one index lookup and
+    against each other, stored in the blob store by a thread pool, and
+    their documents inserted with one storage write.
+
+    Parameters:
+    -----------
+    uploads : list
+        the FileStorage of each file, whose stream is its UploadSpool
+    user_id : str
+        the id of the uploading user
+    titles : list
+        the title of each file, or an empty list to use the file names
+    categories : list
+        the categories of every document
+    stored : set
+        filled with the id() of the uploads committed to the blob store
+
+    Returns:
+    --------
+    results : list
+        the outcome for each file, in order: its status ('uploaded', 'duplicate' or 'error') with the
+        new document, the existing document or an error message
+    """
+    user = db.table('users').get(Query().id == user_id)
+    author = user['firstName'] + ' ' + user['lastName'] if user else 'Anonymous'
+    documents_table = db.table('documents')
+    hashes = [upload.stream.hexdigest() for upload in uploads]
+    existing = {document['hashValue']: document for document in documents_table.search_any('hashValue', hashes)}
+
+    results, new_documents, first_in_batch = [], [], {}
+    for number, (upload, file_hash) in enumerate(zip(uploads, hashes)):
+        file_name = upload.filename or ''
+        filename = secure_filename(file_name)
+        title = (titles[number] if titles else os.path.splitext(file_name)[0]).strip()
+        result = {'fileName': file_name}
+        if not filename:
+            result.update(status='error', message='No selected file')
+        elif not title:
+            result.update(status='error', message='Title is required')
+        elif file_hash in existing:
+            existing_document = existing[file_hash]
+            result.update(status='duplicate', message='This file already exists', existing_document={
+                'title': existing_document['title'],
+                'uploadDate': existing_document['uploadDateReadable'],
+                'categories': existing_document['categories']
+            })
+        elif file_hash in first_in_batch:
+            result.update(status='duplicate', message=f"Same file as {first_in_batch[file_hash]} in this upload")
+        else:
+            first_in_batch[file_hash] = file_name
+            document = create_document(user_id, author, title, file_hash, os.path.splitext(filename)[1],
+                                       categories, upload.content_type)
+            result.update(status='uploaded', document=document)
+            new_documents.append((number, upload, document))
+        results.append(result)
+
+    def commit(upload, document):
+        # Move the received file to its content-addressed key in the blob store
+        try:
+            document['filePath'] = upload.stream.commit(blobStore.key_of(document))
+        except Exception as e:
+            return e
+        stored.add(id(upload))
+        return None
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_BATCH_WORKERS) as executor:
+        errors = list(executor.map(lambda item: commit(*item[1:]), new_documents))
+    for (number, _, _), error in zip(new_documents, errors):
+        if error is not None:
+            results[number].update(status='error', message=str(error))
+            del results[number]['document']
+    new_documents = [document for _, upload, document in new_documents if id(upload) in stored]
+    if not new_documents:
+        return results
+
+    documents_table.insert_multiple(new_documents)
+
+    trie_user = trieUsersCache.get(user_id)
+    if trie_user:
+        for document in new_documents:
+            trie_user.add_document(TrieDocument(document['id'], document['title'], document['hashValue'],
+                                                document['fileExt'], document['uploadDate']))
+    update_categories(categories)
+    return results
+
+
+def create_document(user_id, author, title, file_hash, file_extension, categories, mime_type):
+    # Create a new document
+    return {
+        'id': Database.generate_id(),
+        'userId': user_id,
+        'author': author,
+        'title': title,
+        'hashValue': file_hash,
+        'fileExt': file_extension,
+        'fileType': file_extension,
+        'uploadDate': datetime.now().isoformat(),
+        'uploadDateReadable': datetime.now().strftime('%d-%b-%Y %H:%M'),
+        'categories': categories,
+        'mimeType': mime_type  # Include MIME type
+    }
+
+
+def update_categories(new_categories):
+    # update categories
+    existing_categories = db.table('categories').get(doc_id=1)['data']
+    existing_categories.extend(new_categories)
+    updated_categories = list(set(existing_categories))  # remove duplicates
+    db.table('categories').update({'data': updated_categories}, doc_ids=[1])
 
+
+@upload_file_bp.route('/documents/uploads', methods=['POST'])
+@cross_origin()
+def initiate_chunked_upload():
+    # Starts a resumable upload; the file is then sent in parts and the document created on completion
+    data = request.get_json(silent=True) or {}
+    title = (data.get('title') or '').strip()
     if not title:
         return {'message': 'Title is required'}, 400
-
-    if not categories:
+    if not data.get('categories'):
         return {'message': 'Categories are required'}, 400
-
-    # if user does not select file, browser submits an empty part without filename
-    if file.filename == '':
+    if not data.get('fileName'):
         return {'message': 'No selected file'}, 400
+
+    fields = {'userId': data.get('userId'), 'title': title, 'categories': data['categories'],
+              'fileName': data['fileName'], 'contentType': data.get('contentType') or 'application/octet-stream'}
     try:
-        if file:
-            filename = secure_filename(file.filename)
-            file_extension = os.path.splitext(filename)[1]
-            mime_type = file.content_type  # Extract MIME type
-
-            # Calculate the hash
-            file_hash = compute_file_hash(file.stream)
-
-            # Get the user from the database
-            User = Query()
-            users_table = db.table('users')
-            user = users_table.get(User.id == user_id)
-            author = user['firstName'] + ' ' + user['lastName'] if user else 'Anonymous'
-
-            # Check if a document with the same hash value already exists
-            Document = Query()
-            documents_table = db.table('documents')
-            existing_document = documents_table.get(Document.hashValue == file_hash)
-
-            if existing_document:
-                return {
-                    'message': 'This file already exists',
-                    'error': 'duplicate file',
-                    'existing_document': {
-                        'title': existing_document['title'],
-                        'uploadDate': existing_document['uploadDateReadable'],
-                        'categories': existing_document['categories']
-                    }
-                }, 400
-            else:
-                new_categories = categories.split(',')
-                # Create a new document
-                new_document = {
-                    'id': Database.generate_id(),
-                    'userId': user_id,
-                    'author': author,
-                    'title': title,
-                    'hashValue': file_hash,
-                    'fileExt': file_extension,
-                    'fileType': file_extension,
-                    'uploadDate': datetime.now().isoformat(),
-                    'uploadDateReadable': datetime.now().strftime('%d-%b-%Y %H:%M'),
-                    'categories': new_categories,
-                    'mimeType': mime_type  # Include MIME type
+        session = chunkedUploads.initiate(fields, int(data.get('partSize') or DEFAULT_PART_SIZE))
+    except ValueError as e:
+        return {'message': str(e)}, 400
+    return {'uploadId': session['id'], 'partSize': session['partSize'], 'maxParts': MAX_PARTS}, 201
+
+
+@upload_file_bp.route('/documents/uploads/<upload_id>', methods=['GET'])
+@cross_origin()
+def get_chunked_upload(upload_id):
+    # Lists the parts received so far, so an interrupted client knows which ones to send again
+    session = chunkedUploads.get(upload_id)
+    if session is None:
+        return {'message': 'Upload not found'}, 404
+    parts = [{'partNumber': int(number), 'size': part['size'], 'sha256': part['sha256']}
+             for number, part in sorted(session['parts'].items(), key=lambda item: int(item[0]))]
+    return {'uploadId': upload_id, 'partSize': session['partSize'], 'parts': parts}, 200
+
+
+@upload_file_bp.route('/documents/uploads/<upload_id>/parts/<int:part_number>', methods=['PUT'])
+@cross_origin()
+def put_chunked_upload_part(upload_id, part_number):
+    # The body is the part itself; sending a part again replaces it
+    try:
+        part = chunkedUploads.put_part(upload_id, part_number, request.stream)
+    except KeyError:
+        return {'message': 'Upload not found'}, 404
+    except ValueError as e:
+        return {'message': str(e)}, 400
+    return {'partNumber': part_number, 'size': part['size'], 'sha256': part['sha256']}, 200
+
+
+@upload_file_bp.route('/documents/uploads/<upload_id>/complete', methods=['POST'])
+@cross_origin()
+def complete_chunked_upload(upload_id):
+    try:
+        session, upload = chunkedUploads.complete(upload_id)
+    except KeyError:
+        return {'message': 'Upload not found'}, 404
+    except ValueError as e:
+        return {'message': str(e)}, 400
+    try:
+        return store_uploaded_document(upload, session['userId'], session['title'], session['categories'],
+                                       session['fileName'], session['contentType'])
+    finally:
+        chunkedUploads.close(upload_id)
+
+
+@upload_file_bp.route('/documents/uploads/<upload_id>', methods=['DELETE'])
+@cross_origin()
+def abort_chunked_upload(upload_id):
+    if not chunkedUploads.abort(upload_id):
+        return {'message': 'Upload not found'}, 404
+    return {'message': 'Upload aborted'}, 200
+
+
+def store_uploaded_document(upload, user_id, title, categories, file_name, mime_type):
+    """
+    Stores an uploaded file as a new document, unless a document with the same content exists
+
+    Parameters:
+    -----------
+    upload : UploadSpool or ChunkedUpload
+        the received file, already hashed; it is committed to the blob store or discarded
+    user_id : str
+        the id of the uploading user
+    title : str
+        the title of the document
+    categories : str
+        the comma-separated categories of the document
+    file_name : str
+        the name of the file on the client
+    mime_type : str
+        the content type of the file
+
+    Returns:
+    --------
+    response : tuple
+        the response body and status code of the upload
+    """
+    stored = False
+    try:
+        filename = secure_filename(file_name)
+        file_extension = os.path.splitext(filename)[1]
+
+        # The hash was computed while the file was received
+        file_hash = upload.hexdigest()
+
+        # Get the user from the database
+        User = Query()
+        users_table = db.table('users')
+        user = users_table.get(User.id == user_id)
+        author = user['firstName'] + ' ' + user['lastName'] if user else 'Anonymous'
+
+        # Check if a document with the same hash value already exists; the received copy is dropped
+        Document = Query()
+        documents_table = db.table('documents')
+        existing_document = documents_table.get(Document.hashValue == file_hash)
+
+        if existing_document:
+            return {
+                'message': 'This file already exists',
+                'error': 'duplicate file',
+                'existing_document': {
+                    'title': existing_document['title'],
+                    'uploadDate': existing_document['uploadDateReadable'],
+                    'categories': existing_document['categories']
                 }
+            }, 400
+
+        new_categories = categories.split(',')
+        new_document = create_document(user_id, author, title, file_hash, file_extension, new_categories, mime_type)
+
+        # Move the received file to its content-addressed key in the blob store
+        full_path = upload.commit(blobStore.key_of(new_document))
+        stored = True
+        print(f"File saved to: {full_path}")
+        new_document['filePath'] = full_path
+
+        # insert the document into the database
+        documents_table.insert(new_document)
+
+        # insert the document into the trie; one built just now already holds it
+        trie_user = trieUsersCache.get(user_id)
+        if trie_user:
+            document = TrieDocument(new_document['id'], new_document['title'], new_document['hashValue'],
+                                    new_document['fileExt'], new_document['uploadDate'])
+            trie_user.add_document(document)
 
-                # Save the file
-                if use_s3:
-                    full_path = upload_document_to_s3(file, new_document)
-                else:
-                    full_path = save_uploaded_document(file, new_document)
-                print(f"File saved to: {full_path}")
-                new_document['filePath'] = full_path
-
-                # insert the document into the database
-                documents_table.insert(new_document)
-
-                # insert the document into the trie
-                # from app import trieUsersMap
-                trie_user = trieUsersMap.get(user_id)
-                document = TrieDocument(new_document['id'], new_document['title'], new_document['hashValue'],
-                                        new_document['fileExt'])
-                trie_user.trie.insert(document)
-
-                # update categories
-                existing_categories = db.table('categories').get(doc_id=1)['data']
-                existing_categories.extend(new_categories)
-                updated_categories = list(set(existing_categories))  # remove duplicates
-                db.table('categories').update({'data': updated_categories}, doc_ids=[1])
-
-                return {'message': 'File successfully uploaded', 'document': new_document}, 200
+        update_categories(new_categories)
+
+        return {'message': 'File successfully uploaded', 'document': new_document}, 200
     except Exception as e:
         return {'message': str(e)}, 500
+    finally:
+        if not stored:
+            upload.discard()
 
 
 @download_bp.route('/download/<file_id>', methods=['GET'])
@@ -198,32 +555,90 @@ def download_file(file_id):
             return jsonify({'message': 'File not found'}), 404
 
         file_name = f"{document['hashValue']}{document['fileExt']}"
-        file_path = os.path.join(UPLOAD_FOLDER, file_name)
+        mime_type = document.get('mimeType', 'application/octet-stream')
+        # Files are stored by content hash and never change, so the hash is a strong validator
+        etag = document['hashValue']
+        redirect_to_s3 = request.args.get('redirect', '').lower() in ('1', 'true')
+
+        # A client holding the file doesn't need it, or a link to it, again
+        if request.if_none_match.contains_weak(etag) and (not use_s3 or redirect_to_s3):
+            response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            return response
 
         if use_s3:
-            s3 = boto3.client('s3')
             try:
-                # Generate a pre-signed URL for the file
-                presigned_url = s3.generate_presigned_url('get_object',
-                                                          Params={'Bucket': os.environ.get('S3_BUCKET_NAME'),
-                                                                  'Key': file_path},
-                                                          ExpiresIn=3600)  # URL expires in 1 hour
-                return jsonify({'url': presigned_url}), 200
+                # A pre-signed URL for the file, reused while it is valid, so neither the file is looked up
+                # nor the URL signed again; S3 answers Range and conditional requests on it
+                presigned_url, _ = presignedUrls.get(
+                    (document['hashValue'], document['fileExt']), mime_type,
+                    lambda expires_in: sign_download_url(document, file_name, mime_type, expires_in))
             except ClientError as e:
                 current_app.logger.error(f"Error generating pre-signed URL: {e}")
                 return jsonify({'message': 'Error generating file download link'}), 500
+            if presigned_url is None:
+                return jsonify({'message': 'File not found on server'}), 404
+            if redirect_to_s3:
+                # Clients following the redirect send their Range header on to S3
+                response = redirect(presigned_url)
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'no-cache'
+                return response
+            response = jsonify({'url': presigned_url, 'etag': etag})
+            # The link expires, so the response must not be reused
+            response.headers['Cache-Control'] = 'no-store'
+            return response, 200
         else:
-            if not os.path.exists(file_path):
+            file_path = blobStore.resolve(blobStore.key_of(document))
+            if file_path is None:
                 return jsonify({'message': 'File not found on server'}), 404
-            return send_file(file_path,
-                             as_attachment=True,
-                             download_name=file_name,
-                             mimetype=document.get('mimeType', 'application/octet-stream')
-                             ), 200
+            # Answers If-None-Match with 304 and Range with 206, through the server's file wrapper where it has one
+            response = send_file(os.path.abspath(file_path),
+                                 as_attachment=True,
+                                 download_name=file_name,
+                                 mimetype=mime_type,
+                                 conditional=True,
+                                 etag=etag)
+            response.headers['Accept-Ranges'] = 'bytes'
+            return response
+    except HTTPException as e:
+        # e.g. 416 for a Range beyond the end of the file
+        return e
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
 
+def sign_download_url(document, file_name, mime_type, expires_in):
+    """
+    Signs a URL downloading the file of a document from S3
+
+    Parameters:
+    -----------
+    document : dict
+        the document
+    file_name : str
+        the name the file is saved as
+    mime_type : str
+        the content type S3 answers with
+    expires_in : int
+        the seconds the URL is valid for
+
+    Returns:
+    --------
+    url : str
+        the pre-signed URL, or None if the file isn't stored
+    """
+    file_path = blobStore.resolve(blobStore.key_of(document))
+    if file_path is None:
+        return None
+    return blobStore.s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': blobStore.bucket, 'Key': file_path,
+                'ResponseContentType': mime_type,
+                'ResponseContentDisposition': f'attachment; filename="{file_name}"'},
+        ExpiresIn=expires_in)
+
+
 @delete_bp.route('/delete/<file_id>', methods=['DELETE'])
 def delete_file(file_id):
     Document = Query()
@@ -233,35 +648,21 @@ def delete_file(file_id):
     if not document:
         return jsonify({'message': 'File not found'}), 404
 
-    file_name = f"{document['hashValue']}{document['fileExt']}"
-    file_path = os.path.join(UPLOAD_FOLDER, file_name)
-
-    if use_s3:
-        s3 = boto3.client('s3')
-        try:
-            s3.delete_object(
-                Bucket=os.environ.get('S3_BUCKET_NAME'),
-                Key=file_path
-            )
-        except ClientError as e:
-            current_app.logger.error(f"Error deleting file from S3: {e}")
-            return jsonify({'message': 'Error deleting file from storage'}), 500
-    else:
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except OSError as e:
-                current_app.logger.error(f"Error deleting local file: {e}")
-                return jsonify({'message': 'Error deleting file from local storage'}), 500
-
     # Remove the document from the database
     documents_table.remove(Document.id == file_id)
 
+    # Delete its file unless another document has the same content, or it was just stored again
+    presignedUrls.discard((document['hashValue'], document['fileExt']))
+    try:
+        blobStore.release(document)
+    except (ClientError, OSError) as e:
+        # The document is gone either way; the orphaned file is left to the blob garbage collection
+        current_app.logger.error(f"Error deleting file from storage: {e}")
+
     # Remove the document from the trie
-    # from app import trieUsersMap
-    trie_user = trieUsersMap.get(document['userId'])
+    trie_user = trieUsersCache.get(document['userId'])
     if trie_user:
-        trie_user.trie.remove(
+        trie_user.remove_document(
             TrieDocument(document['id'], document['title'], document['hashValue'], document['fileExt']))
     else:
         current_app.logger.warning(f"Trie not found for user {document['userId']}")
@@ -269,12 +670,67 @@ def delete_file(file_id):
     return jsonify({'message': 'File successfully deleted'}), 200
 
 
-def generate_random_content(size=1024):
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=size)).encode()
+@delete_bp.route('/delete/batch', methods=['POST'])
+def delete_files():
+    # Deletes the documents listed in 'ids', or matching 'userId', 'category' and an uploadDate range
+    # 'from' (inclusive) - 'to' (exclusive); given both, the listed documents that match
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if ids is not None and not (isinstance(ids, list) and all(isinstance(doc_id, str) for doc_id in ids)):
+        return jsonify({'message': "'ids' must be a list of document ids"}), 400
+    Document = Query()
+    conditions = []
+    if data.get('userId'):
+        conditions.append(Document.userId == data['userId'])
+    if data.get('category'):
+        conditions.append(Document.categories.any([data['category']]))
+    if data.get('from'):
+        conditions.append(Document.uploadDate >= data['from'])
+    if data.get('to'):
+        conditions.append(Document.uploadDate < data['to'])
+    if not ids and not conditions:
+        return jsonify({'message': 'Give the ids of the documents to delete, or a filter'}), 400
+
+    documents_table = db.table('documents')
+    cond = reduce(operator.and_, conditions) if conditions else None
+    if ids:
+        documents = [document for document in documents_table.search_any('id', ids) if cond is None or cond(document)]
+    else:
+        documents = documents_table.search(cond)
+    if not documents:
+        return jsonify({'message': 'No documents matched', 'deleted': [], 'filesDeleted': 0}), 200
+
+    # Remove the documents from the database in one write
+    documents_table.remove(doc_ids=[document.doc_id for document in documents])
+
+    # Delete the files no other document shares, in batches; files stored within the grace period are left to
+    # the garbage collection, as an upload of the same content may be about to reference them
+    for document in documents:
+        presignedUrls.discard((document['hashValue'], document['fileExt']))
+    files_deleted = 0
+    try:
+        files_deleted = len(blobStore.release_many(documents))
+    except (ClientError, OSError) as e:
+        # The documents are gone either way; the orphaned files are left to the blob garbage collection
+        current_app.logger.error(f"Error deleting files from storage: {e}")
+
+    # Remove the documents from the tries of the users that are cached; the others are built without them
+    for document in documents:
+        trie_user = trieUsersCache.peek(document['userId'])
+        if trie_user:
+            trie_user.remove_document(
+                TrieDocument(document['id'], document['title'], document['hashValue'], document['fileExt']))
+        else:
+            # A trie being built may have read the documents before they were removed
+            trieUsersCache.discard(document['userId'])
+
+    return jsonify({'message': f'{len(documents)} documents deleted',
+                    'deleted': [document['id'] for document in documents], 'filesDeleted': files_deleted}), 200
 
 
 @add_dummy_documents_bp.route('/add_dummy_documents', methods=['POST'])
 def add_dummy_documents():
+    # Seeds a user's documents with synthetic ones, generated offline; a seed makes the corpus reproducible
     data = request.get_json()
     document_set_size = data.get('document_set_size')
     user_id = data.get('user_id')
@@ -282,139 +738,23 @@ def add_dummy_documents():
     if not document_set_size or not user_id:
         return jsonify({'error': 'document_set_size and user_id are required'}), 400
 
-    documents = db.table('documents')
-    users = db.table('users')
-    if not users.contains(Query().id == user_id):
+    user = db.table('users').get(Query().id == user_id)
+    if not user:
         return jsonify({'error': 'User ID does not exist'}), 400
 
-    s3 = boto3.client('s3') if use_s3 else None
-
-    for _ in range(document_set_size):
-        document = generate_random_document(user_id)
-        file_name = f"{document['hashValue']}{document['fileExt']}"
-        file_path = os.path.join(UPLOAD_FOLDER, file_name)
-
-        # Generate random content for the dummy file
-        file_content = generate_random_content()
-
-        document['filePath'] = file_path
+    categories = db.table('categories').get(doc_id=1)['data']
+    generator = CorpusGenerator(seed=data.get('seed'), content_size=int(data.get('content_size', 1024)))
+    try:
+        seed_documents(generator, blobStore, db.table('documents'), [user], int(document_set_size), categories)
+    except ClientError as e:
+        current_app.logger.error(f"Error uploading dummy file to S3: {e}")
+        return jsonify({'error': 'Failed to create dummy files in S3'}), 500
+    except OSError as e:
+        current_app.logger.error(f"Error creating local dummy file: {e}")
+        return jsonify({'error': 'Failed to create local dummy files'}), 500
 
-        if use_s3:
-            try:
-                s3.put_object(
-                    Bucket=os.environ.get('S3_BUCKET_NAME'),
-                    Key=file_path,
-                    Body=file_content
-                )
-            except ClientError as e:
-                current_app.logger.error(f"Error uploading dummy file to S3: {e}")
-                return jsonify({'error': 'Failed to create dummy files in S3'}), 500
-        else:
-            try:
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                with open(file_path, 'wb') as f:
-                    f.write(file_content)
-            except OSError as e:
-                current_app.logger.error(f"Error creating local dummy file: {e}")
-                return jsonify({'error': 'Failed to create local dummy files'}), 500
-
-        documents.insert(document)
-
-        # Trie update logic
-        # from app import trieUsersMap
-        trie_user = trieUsersMap.get(user_id)
-        if trie_user:
-            trie_document = TrieDocument(document['id'], document['title'], document['hashValue'], document['fileExt'])
-            trie_user.trie.insert(trie_document)
-        else:
-            current_app.logger.warning(f"Trie not found for user {user_id}")
+    # Built again in bulk on the user's next search rather than document by document
+    trieUsersCache.discard(user_id)
 
     return jsonify({'message': f'{document_set_size} documents added for user {user_id}'}), 201
 
-
-# Helper function to generate a unique and meaningful document title
-def generate_unique_title():
-    title_length = random.randint(10, 50)
-    words = []
-    random_word_api = os.environ.get('RANDOM_WORD_API', 'https://random-word.ryanrk.com/api/en/word/random/4')
-
-    while len(' '.join(words)) < title_length:
-        response = requests.get(random_word_api)
-        if response.status_code == 200:
-            words.extend(response.json())
-        else:
-            break  # Break the loop if the API call fails
-
-    title = ' '.join(words)
-    return title[:title_length]  # Ensure the title is exactly the desired length
-
-
-# Helper function to generate a random document
-# noinspection PyDeprecation
-def generate_random_document(user_id):
-    categories = db.table('categories').all()[0]['data']
-    random_category = random.choice(categories)
-
-    # Create a random document with a unique title
-    document = {
-        'id': Database.generate_id(),
-        'userId': user_id,
-        'author': db.table('users').get(Query().id == user_id)['name'],
-        'title': generate_unique_title(),
-        'hashValue': hashlib.sha256(str(random.random()).encode('utf-8')).hexdigest(),
-        'fileExt': '.txt',
-        'fileType': '.txt',
-        'uploadDate': datetime.utcnow().isoformat(),
-        'uploadDateReadable': datetime.utcnow().strftime('%d-%b-%Y %H:%M'),
-        'categories': [random_category],
-        'mimeType': 'text/plain'
-    }
-
-    return document
-
-
-def save_uploaded_document(file, new_document):
-    file_name = f"{new_document['hashValue']}{new_document['fileExt']}"
-    full_path = os.path.join(UPLOAD_FOLDER, file_name)
-
-    if os.environ.get('USE_S3', 'false').lower() == 'true':
-        s3 = boto3.client('s3')
-        file.stream.seek(0)  # Reset the stream position to the beginning
-        try:
-            s3.upload_fileobj(
-                file,
-                os.environ.get('S3_BUCKET_NAME'),
-                full_path,
-                ExtraArgs={'ContentType': file.content_type}
-            )
-        except ClientError as e:
-            print(f"Error uploading file to S3: {e}")
-            raise
-    else:
-        # Ensure the upload directory exists
-        os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        file.stream.seek(0)  # Reset the stream position to the beginning
-        file.save(full_path)
-
-    return full_path  # Return the path where the file was saved
-
-
-def upload_document_to_s3(file, new_document):
-    s3_bucket_name = os.environ.get('S3_BUCKET_NAME', 'dms-backend')
-    file_name = f"{new_document['hashValue']}{new_document['fileExt']}"
-    full_path = os.path.join(UPLOAD_FOLDER, file_name)
-
-    s3 = boto3.client('s3')
-    file.stream.seek(0)  # Reset the stream position to the beginning
-    try:
-        s3.upload_fileobj(
-            file,
-            s3_bucket_name,
-            full_path,
-            ExtraArgs={'ContentType': file.content_type}
-        )
-    except ClientError as e:
-        print(f"Error uploading file to S3: {e}")
-        raise
-
-    return full_path  # Return the path where the file was saved
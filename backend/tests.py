@@ -1,10 +1,49 @@
 import io
-from unittest.mock import MagicMock, patch
+import json
+import os
+import runpy
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, Mock, patch
 
-from helpers import initialize_trie_users, compute_file_hash
+import boto3
+import pytest
+from flask import Flask
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from tinydb import TinyDB, Query
+from tinydb.storages import MemoryStorage
+
+from helpers import build_trie_user, initialize_trie_users, compute_file_hash, load_trie_user, sync_trie_users
+from library.python.BlobStore import GC_GRACE_PERIOD, RELEASE_GRACE_PERIOD, LocalBlobStore, S3BlobStore, blob_key
+from library.python.ChangeLog import ChangeLog
+from library.python.ChunkedUpload import ChunkedUploads
+from library.python.ConcurrentModificationError import ConcurrentModificationError
+from library.python.CorpusGenerator import CorpusGenerator, seed_documents
+from library.python.Database import Database
 from library.python.Document import Document
+from library.python.DynamoDbCachedStorage import DynamoDbCachedStorage
+from library.python.DynamoDbItemStorage import DynamoDbItemStorage
+from library.python.InMemoryDynamoDb import InMemoryDynamoDb
+from library.python.IndexedTable import IndexedTable
+from library.python.InstrumentedMiddleware import InstrumentedMiddleware
+from library.python.Singleton import Singleton
+from library.python.JournaledJSONStorage import JournaledJSONStorage, encode_document
+from library.python.Metrics import METRICS, Metrics, init_app as init_metrics
+from library.python.PresignedUrlCache import PresignedUrlCache
+from library.python.RadixTrieNode import RadixTrieNode
+from library.python import S3Client
+from library.python.UTF8JSONStorage import UTF8JSONStorage
+from library.python.WriteBehindCachingMiddleware import LostWritesError, WriteBehindCachingMiddleware
+from library.python.TitleSearchIndex import TitleSearchIndex
 from library.python.TrieNode import TrieNode
+from library.python.TrieSnapshot import TrieSnapshot
 from library.python.TrieUser import TrieUser
+from library.python.TrieUserCache import TrieUserCache
+from library.python.UploadSpool import LocalUploadSpool, S3UploadSpool, parse_multipart_upload
 
 
 def test_initialize_trie_users():
@@ -44,10 +83,7 @@ def test_initialize_trie_users():
 
     # Set up the mock to return our test data
     mock_users_table.all.return_value = mock_users
-    mock_documents_table.search.side_effect = [
-        [doc for doc in mock_documents if doc['userId'] == user1_id],
-        [doc for doc in mock_documents if doc['userId'] == user2_id]
-    ]
+    mock_documents_table.all.return_value = mock_documents
 
     # Patch the Database in the helpers module
     with patch('helpers.db', new=mock_db):
@@ -62,7 +98,7 @@ def test_initialize_trie_users():
         for user_id, trie_user in result.items():
             assert isinstance(trie_user, TrieUser)
             assert user_id in [user1_id, user2_id]
-            assert isinstance(trie_user.trie, TrieNode)
+            assert isinstance(trie_user.trie, RadixTrieNode)
 
         # Assert the documents are correctly inserted into the TrieNodes
         for user_id, trie_user in result.items():
@@ -102,3 +138,1204 @@ def test_compute_file_hash():
     empty_result = compute_file_hash(empty_file)
     assert len(empty_result) == 64
     assert empty_result == "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"  # SHA-256 of empty string
+
+
+def test_upload_spools_hash_while_storing(tmp_path):
+    content = b"This is a test file content." * 1000
+    body = (b'--XyZ\r\nContent-Disposition: form-data; name="title"\r\n\r\nReport\r\n'
+            b'--XyZ\r\nContent-Disposition: form-data; name="file"; filename="report.txt"\r\n'
+            b'Content-Type: text/plain\r\n\r\n' + content + b'\r\n--XyZ--\r\n')
+    form, files = parse_multipart_upload(io.BytesIO(body), 'multipart/form-data; boundary=XyZ', len(body),
+                                         lambda content_type: LocalUploadSpool(str(tmp_path), content_type),
+                                         chunk_size=1024)
+    spool = files['file'].stream
+    assert form['title'] == 'Report' and files['file'].filename == 'report.txt'
+    assert spool.hexdigest() == compute_file_hash(io.BytesIO(content)) and spool.size == len(content)
+    path = spool.commit(f'{spool.hexdigest()}.txt')
+    assert [entry.name for entry in tmp_path.iterdir()] == [f'{spool.hexdigest()}.txt']
+    with open(path, 'rb') as handle:
+        assert handle.read() == content
+
+    # A duplicate is dropped without leaving anything behind
+    spool = LocalUploadSpool(str(tmp_path))
+    spool.write(content)
+    spool.discard()
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # Small files are put directly, larger ones go through a multipart upload to a staging key
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+    spool = S3UploadSpool(s3, 'bucket', 'uploads', 'text/plain', part_size=10)
+    spool.write(b'small')
+    assert spool.commit('small.txt') == 'uploads/small.txt'
+    s3.put_object.assert_called_once_with(Bucket='bucket', Key='uploads/small.txt', Body=b'small',
+                                          ContentType='text/plain')
+
+    spool = S3UploadSpool(s3, 'bucket', 'uploads', part_size=10)
+    for _ in range(3):
+        spool.write(b'0123456789ab')
+    assert s3.upload_part.call_count == 3 and not s3.complete_multipart_upload.called
+    assert spool.hexdigest() == compute_file_hash(io.BytesIO(b'0123456789ab' * 3))
+    assert spool.commit('large.txt') == 'uploads/large.txt'
+    s3.complete_multipart_upload.assert_called_once_with(
+        Bucket='bucket', Key=spool.staging_key, UploadId='upload-1',
+        MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': f'etag-{n}'} for n in (1, 2, 3)]})
+    s3.copy.assert_called_once_with({'Bucket': 'bucket', 'Key': spool.staging_key}, 'bucket', 'uploads/large.txt',
+                                   Config=S3Client.TRANSFER_CONFIG)
+
+    spool = S3UploadSpool(s3, 'bucket', 'uploads', part_size=10)
+    spool.write(b'0123456789ab')
+    spool.discard()
+    s3.abort_multipart_upload.assert_called_once_with(Bucket='bucket', Key=spool.staging_key, UploadId='upload-1')
+
+
+def test_blob_store_counts_references_and_collects_garbage(tmp_path):
+    db = TinyDB(storage=MemoryStorage)
+    db.table_class = IndexedTable
+    documents = db.table('documents')
+    store = LocalBlobStore(documents, str(tmp_path))
+    shared, legacy, orphan = 'a1' * 32, 'b2' * 32, 'c3' * 32
+    assert blob_key(shared, '.pdf') == f'a1/a1/{shared}.pdf'
+
+    for hash_value in (shared, orphan):
+        spool = store.create_spool()
+        spool.write(b'content')
+        spool.commit(blob_key(hash_value, '.pdf'))
+    (tmp_path / f'{legacy}.pdf').write_bytes(b'stored before sharding')
+    (tmp_path / '.upload-abandoned').write_bytes(b'partial')
+    (tmp_path / 'notes.txt').write_bytes(b'not a blob')
+    documents.insert_multiple([{'id': f'doc_{i}', 'hashValue': hash_value, 'fileExt': '.pdf'}
+                               for i, hash_value in enumerate([shared, shared, legacy])])
+
+    assert store.resolve(blob_key(legacy, '.pdf')) == str(tmp_path / f'{legacy}.pdf')
+    assert store.resolve(blob_key(orphan, '.txt')) is None
+
+    # Young files are kept, old unreferenced blobs and upload leftovers are swept
+    assert store.collect_garbage() == []
+    assert sorted(store.collect_garbage(now=time.time() + GC_GRACE_PERIOD, dry_run=True)) == \
+           ['.upload-abandoned', blob_key(orphan, '.pdf')]
+    assert sorted(store.collect_garbage(now=time.time() + GC_GRACE_PERIOD)) == \
+           ['.upload-abandoned', blob_key(orphan, '.pdf')]
+    assert store.resolve(blob_key(orphan, '.pdf')) is None and (tmp_path / 'notes.txt').exists()
+
+    assert store.migrate() == 1
+    assert store.resolve(blob_key(legacy, '.pdf')) == str(tmp_path / blob_key(legacy, '.pdf'))
+
+    # The shared blob stays until its last document is removed
+    for document_id, deleted in (('doc_0', False), ('doc_1', True)):
+        document = documents.get(Query().id == document_id)
+        documents.remove(Query().id == document_id)
+        assert store.release(document, now=time.time() + RELEASE_GRACE_PERIOD) is deleted
+    assert store.resolve(blob_key(shared, '.pdf')) is None
+
+
+def test_blob_store_keeps_released_blobs_an_upload_may_reference(tmp_path):
+    db = TinyDB(storage=MemoryStorage)
+    db.table_class = IndexedTable
+    documents = db.table('documents')
+    store = LocalBlobStore(documents, str(tmp_path))
+    hash_value = f'{1:064x}'
+    documents.insert({'id': 'doc_1', 'hashValue': hash_value, 'fileExt': '.pdf'})
+    removed = documents.get(Query().id == 'doc_1')
+    documents.remove(Query().id == 'doc_1')
+
+    # An upload of the same content stores the blob after the references were looked up, before its insert
+    spool = store.create_spool()
+    spool.write(b'content')
+
+    def upload_meanwhile(table, field, values):
+        spool.commit(blob_key(hash_value, '.pdf'))
+        return []
+
+    with patch.object(IndexedTable, 'search_any', autospec=True, side_effect=upload_meanwhile):
+        assert store.release_many([removed]) == []
+    documents.insert({'id': 'doc_2', 'hashValue': hash_value, 'fileExt': '.pdf'})
+    assert store.resolve(blob_key(hash_value, '.pdf')) is not None
+
+    # Left unreferenced, it goes with the garbage collection
+    documents.remove(Query().id == 'doc_2')
+    assert store.collect_garbage(now=time.time() + GC_GRACE_PERIOD) == [blob_key(hash_value, '.pdf')]
+
+
+def test_blob_store_releases_in_batches():
+    db = TinyDB(storage=MemoryStorage)
+    db.table_class = IndexedTable
+    documents = db.table('documents')
+    removed = [{'id': f'doc_{i}', 'hashValue': f'{i:064x}', 'fileExt': '.pdf'} for i in range(600)]
+    documents.insert({'id': 'kept', 'hashValue': f'{0:064x}', 'fileExt': '.pdf'})
+    s3 = MagicMock()
+    s3.delete_objects.return_value = {}
+    s3.head_object.return_value = {'LastModified': datetime(2024, 1, 1, tzinfo=timezone.utc)}
+    store = S3BlobStore(documents, s3, 'bucket', 'uploads')
+
+    # The blob still referenced is kept, the others go with their pre-sharding names in batches of 1000
+    deleted = store.release_many(removed)
+    assert len(deleted) == 599 and blob_key(f'{0:064x}', '.pdf') not in deleted
+    batches = [call.kwargs['Delete']['Objects'] for call in s3.delete_objects.call_args_list]
+    assert [len(batch) for batch in batches] == [1000, 198]
+    assert {'Key': f'uploads/{blob_key(removed[1]["hashValue"], ".pdf")}'} in batches[0]
+    assert {'Key': f'uploads/{removed[1]["hashValue"]}.pdf'} in batches[0]
+
+    # A blob stored within the grace period isn't deleted
+    s3.delete_objects.reset_mock()
+    s3.head_object.return_value = {'LastModified': datetime.now(timezone.utc)}
+    assert store.release_many(removed[1:3]) == [] and not s3.delete_objects.called
+
+    s3.head_object.return_value = {'LastModified': datetime(2024, 1, 1, tzinfo=timezone.utc)}
+    s3.delete_objects.return_value = {'Errors': [{'Key': 'uploads/x', 'Code': 'AccessDenied', 'Message': 'Denied'}]}
+    with pytest.raises(ClientError):
+        store.release_many(removed[1:2])
+
+
+@pytest.mark.parametrize('script', ['generate_corpus.py', 'manage_blobs.py'])
+def test_scripts_flush_the_write_behind_cache(tmp_path, script):
+    db_path = str(tmp_path / 'db.json')
+    db = TinyDB(db_path, storage=WriteBehindCachingMiddleware(UTF8JSONStorage, flush_every=10 ** 6,
+                                                               flush_interval=3600))
+    db.table_class = IndexedTable
+    db.table('users').insert({'id': 'user_1', 'name': 'Ada Lovelace'})
+    db.table('categories').insert({'data': ['Report']})
+    blob_store = LocalBlobStore(db.table('documents'), str(tmp_path / 'uploads'))
+    ChunkedUploads(db, blob_store).initiate({'userId': 'user_1'})
+    db.storage.flush()
+    database = object.__new__(Database)
+    database.db = db
+
+    arguments = {'generate_corpus.py': ['--documents', '20', '--seed', '3', '--content-size', '32'],
+                 'manage_blobs.py': ['gc', '--grace-hours', '0']}[script]
+    with patch.dict(Singleton._instances, {Database: database}), patch('helpers.db', new=db), \
+            patch.dict(os.environ, {'UPLOAD_FOLDER': str(tmp_path / 'uploads'), 'USE_S3': 'false'}), \
+            patch.object(sys, 'argv', [script, *arguments]):
+        runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), script), run_name='__main__')
+
+    # What the script changed reached the file, not just the cache
+    stored = TinyDB(db_path, storage=UTF8JSONStorage)
+    if script == 'generate_corpus.py':
+        assert len(stored.table('documents')) == 20
+        assert len([key for key, _ in blob_store._list()]) == 20
+    else:
+        assert len(stored.table('uploads')) == 0
+
+
+def test_corpus_generator_seeds_reproducible_documents_in_batches(tmp_path):
+    db = TinyDB(storage=MemoryStorage)
+    db.table_class = IndexedTable
+    documents = db.table('documents')
+    store = LocalBlobStore(documents, str(tmp_path))
+    users = [{'id': 'u1', 'name': 'Ada'}, {'id': 'u2', 'name': 'Bob'}]
+    now = datetime(2024, 6, 1)
+
+    with patch.object(documents, 'insert_multiple', wraps=documents.insert_multiple) as insert_multiple:
+        generator = CorpusGenerator(seed=3, content_size=100, now=now)
+        assert seed_documents(generator, store, documents, users, 25, ['Draft'], batch_size=10) == 25
+    assert insert_multiple.call_count == 3
+    assert [len(documents.search(Query().userId == user['id'])) for user in users] == [13, 12]
+
+    # Every file is stored under the hash of its content, and the same seed gives the same corpus
+    for document in documents.all():
+        with open(store.resolve(store.key_of(document)), 'rb') as handle:
+            assert compute_file_hash(handle) == document['hashValue']
+        assert 10 <= len(document['title']) and document['categories'] == ['Draft']
+    again = CorpusGenerator(seed=3, content_size=100, now=now).documents(users, 25, ['Draft'])
+    assert [{key: value for key, value in document.items() if key != 'id'} for document, _ in again] == \
+           [{key: value for key, value in document.items() if key not in ('id', 'filePath')}
+            for document in documents.all()]
+
+    # The ids differ though, so a corpus seeded alike for another user shares no id with this one
+    assert not {document['id'] for document, _ in again} & {document['id'] for document in documents.all()}
+
+
+def test_s3_blob_store_counts_calls_per_operation():
+    db = TinyDB(storage=MemoryStorage)
+    db.table_class = IndexedTable
+    s3 = boto3.client('s3', region_name='us-east-1', aws_access_key_id='key', aws_secret_access_key='secret')
+    store = S3BlobStore(db.table('documents'), s3, 'bucket', 'uploads')
+    key = blob_key(f'{1:064x}', '.pdf')
+
+    with Stubber(s3) as stubber:
+        stubber.add_response('head_object', {}, {'Bucket': 'bucket', 'Key': f'uploads/{key}'})
+        assert store.resolve(key) == f'uploads/{key}'
+        # Missing from both the sharded and the pre-sharding location
+        for _ in range(2):
+            stubber.add_client_error('head_object', '404', http_status_code=404)
+        assert store.resolve(key) is None
+
+    stats = store.stats()
+    assert list(stats) == ['HeadObject']
+    assert stats['HeadObject']['calls'] == 3 and stats['HeadObject']['errors'] == 2
+
+
+def test_shared_s3_client_is_created_once(monkeypatch):
+    monkeypatch.setattr(S3Client, '_client', None)
+    with patch('library.python.S3Client.boto3.client') as create_client:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = set(executor.map(lambda _: S3Client.shared_s3_client(), range(32)))
+    assert clients == {create_client.return_value} and create_client.call_count == 1
+    assert create_client.call_args.kwargs['config'].max_pool_connections == S3Client.S3_MAX_POOL_CONNECTIONS
+
+
+@patch('library.python.ChunkedUpload.MIN_PART_SIZE', 4)
+def test_chunked_uploads_hash_parts_as_they_arrive(tmp_path):
+    db = TinyDB(storage=MemoryStorage)
+    db.table_class = IndexedTable
+    store = LocalBlobStore(db.table('documents'), str(tmp_path))
+    uploads = ChunkedUploads(db, store)
+    content = b'0123456789abcdefghij'
+    expected = compute_file_hash(io.BytesIO(content))
+
+    def send(upload_id, numbers, parts=None, manager=uploads):
+        for number in numbers:
+            part = (parts or {}).get(number, content[(number - 1) * 8:number * 8])
+            manager.put_part(upload_id, number, io.BytesIO(part))
+
+    # In order, the running hash covers everything and nothing is read back
+    session = uploads.initiate({'title': 'Scan'}, part_size=8)
+    send(session['id'], [1, 2, 3])
+    session, upload = uploads.complete(session['id'])
+    assert session['title'] == 'Scan' and upload.hexdigest() == expected and upload.rehashed_bytes == 0
+    with open(upload.commit(blob_key(expected, '.bin')), 'rb') as handle:
+        assert handle.read() == content
+    uploads.close(session['id'])
+    assert db.table('uploads').all() == []
+
+    # Out of order, only the parts after the hashed ones are read back
+    session = uploads.initiate({}, part_size=8)
+    send(session['id'], [1, 3, 2])
+    _, upload = uploads.complete(session['id'])
+    assert upload.hexdigest() == expected and upload.rehashed_bytes == 4
+
+    # A part sent again with other content, or parts received by another process, are hashed from the file
+    session = uploads.initiate({}, part_size=8)
+    send(session['id'], [1, 2], parts={2: b'XXXXXXXX'})
+    send(session['id'], [3, 2])
+    _, upload = uploads.complete(session['id'])
+    assert upload.hexdigest() == expected and upload.rehashed_bytes == len(content)
+
+    session = uploads.initiate({}, part_size=8)
+    send(session['id'], [1, 2, 3], manager=ChunkedUploads(db, store))
+    _, upload = uploads.complete(session['id'])
+    assert upload.hexdigest() == expected and upload.rehashed_bytes == len(content)
+
+    # Parts must be complete and whole, and may be too large
+    session = uploads.initiate({}, part_size=8)
+    send(session['id'], [1, 3])
+    with pytest.raises(ValueError):
+        uploads.complete(session['id'])
+    with pytest.raises(ValueError):
+        uploads.put_part(session['id'], 2, io.BytesIO(b'too large a part'))
+    assert uploads.abort(session['id']) and not (tmp_path / f".chunked-{session['id']}").exists()
+    with pytest.raises(KeyError):
+        uploads.put_part(session['id'], 2, io.BytesIO(b'late'))
+
+    # On S3 the parts are those of a multipart upload
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+    uploads = ChunkedUploads(db, S3BlobStore(db.table('documents'), s3, 'bucket', 'uploads'))
+    session = uploads.initiate({'contentType': 'application/pdf'}, part_size=8)
+    assert session['s3UploadId'] == 'upload-1'
+    send(session['id'], [2, 1, 3], manager=uploads)
+    _, upload = uploads.complete(session['id'])
+    s3.complete_multipart_upload.assert_called_once_with(
+        Bucket='bucket', Key=f"uploads/.staging/{session['id']}", UploadId='upload-1',
+        MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': f'etag-{n}'} for n in (1, 2, 3)]})
+    assert upload.commit('a/b/c.pdf') == 'uploads/a/b/c.pdf'
+
+
+def test_indexed_table_lookups():
+    db = TinyDB(storage=MemoryStorage)
+    db.table_class = IndexedTable
+    documents_table = db.table('documents')
+    documents_table.insert_multiple([
+        {'id': 'doc_1', 'userId': 'user_1', 'title': 'Document 1', 'hashValue': 'hash1'},
+        {'id': 'doc_2', 'userId': 'user_1', 'title': 'Document 2', 'hashValue': 'hash2'},
+        {'id': 'doc_3', 'userId': 'user_2', 'title': 'Document 3', 'hashValue': 'hash3'},
+    ])
+    Doc = Query()
+
+    # Equality and conjunctions are answered from the indexes
+    assert [doc['id'] for doc in documents_table.search(Doc.userId == 'user_1')] == ['doc_1', 'doc_2']
+    assert documents_table.get((Doc.id == 'doc_2') & (Doc.userId == 'user_1'))['title'] == 'Document 2'
+    assert documents_table.get((Doc.id == 'doc_2') & (Doc.userId == 'user_2')) is None
+    assert documents_table.get((Doc.userId == 'user_1') & (Doc.title == 'Document 1'))['id'] == 'doc_1'
+    assert documents_table.contains(Doc.hashValue == 'hash3')
+    assert [doc['id'] for doc in documents_table.search_any('hashValue', ['hash3', 'hash1', 'hash9'])] == \
+           ['doc_1', 'doc_3']
+    assert [doc['id'] for doc in documents_table.search_any('title', ['Document 2'])] == ['doc_2']
+
+    # Indexes follow updates and removals
+    documents_table.update({'userId': 'user_2'}, Doc.id == 'doc_1')
+    assert [doc['id'] for doc in documents_table.search(Doc.userId == 'user_2')] == ['doc_1', 'doc_3']
+    documents_table.remove(Doc.id == 'doc_3')
+    assert documents_table.get(Doc.hashValue == 'hash3') is None
+    assert documents_table.update({'title': 'Missing'}, Doc.id == 'doc_3') == []
+
+    # Non-indexable conditions fall back to a scan
+    assert len(documents_table.search(Doc.title.test(lambda title: title.startswith('Document')))) == 2
+    for document in documents_table.all():
+        assert documents_table.search(Doc.id == document['id']) == [document]
+
+
+def test_journaled_storage_appends_and_replays(tmp_path):
+    db_path = str(tmp_path / 'db.json')
+    db = TinyDB(db_path, storage=JournaledJSONStorage, compact_threshold=10 ** 9)
+    documents_table = db.table('documents')
+    documents_table.insert_multiple([{'id': f'doc_{i}', 'title': f'Document {i}'} for i in range(50)])
+    documents_table.update({'title': 'Renamed'}, Query().id == 'doc_7')
+    documents_table.remove(Query().id == 'doc_8')
+
+    # The snapshot is untouched and each write only journals what changed
+    assert (tmp_path / 'db.json').read_text() == ''
+    journal_lines = (tmp_path / 'db.json.journal').read_bytes().splitlines()
+    assert len(journal_lines) == 3
+    assert b'Document 9' not in journal_lines[1] and b'Renamed' in journal_lines[1]
+
+    # A torn trailing write is dropped on replay
+    with open(tmp_path / 'db.json.journal', 'ab') as handle:
+        handle.write(b'{"ops":[{"op":"put","table":"documents","id":"99"')
+    reopened = TinyDB(db_path, storage=JournaledJSONStorage, compact_threshold=10 ** 9)
+    assert len(reopened.table('documents')) == 49
+    assert reopened.table('documents').get(Query().id == 'doc_7')['title'] == 'Renamed'
+
+    # Compaction folds the journal into the snapshot
+    reopened.storage.compact()
+    assert (tmp_path / 'db.json.journal').read_bytes() == b''
+    assert not (tmp_path / 'db.json.journal.1').exists()
+    reopened.table('documents').insert({'id': 'doc_50', 'title': 'Document 50'})
+    reopened.close()
+    assert len(TinyDB(db_path, storage=JournaledJSONStorage).table('documents')) == 50
+
+
+def test_journaled_storage_only_serializes_changed_documents(tmp_path):
+    db = TinyDB(str(tmp_path / 'db.json'), storage=JournaledJSONStorage, compact_threshold=10 ** 9)
+    items = db.table('items')
+    items.insert_multiple([{'id': f'item_{i}', 'tags': ['a']} for i in range(50)])
+
+    with patch('library.python.JournaledJSONStorage.encode_document',
+               side_effect=encode_document) as encode:
+        items.update({'tags': ['a', 'b']}, Query().id == 'item_7')
+        items.remove(Query().id == 'item_8')
+        items.update({'tags': ['a']}, Query().id == 'item_9')
+    assert [call.args[0]['id'] for call in encode.call_args_list] == ['item_7']
+    assert len((tmp_path / 'db.json.journal').read_bytes().splitlines()) == 3
+
+    # What a read hands out, and what was written, can be changed without changing the stored state
+    db.storage.read()['items']['2']['tags'].append('changed')
+    assert db.storage.read()['items']['2'] == {'id': 'item_1', 'tags': ['a']}
+    data = db.storage.read()
+    data['items']['1'] = {'id': 'item_0', 'tags': ['x']}
+    db.storage.write(data)
+    data['items']['1']['tags'].append('changed')
+    assert db.storage.read()['items']['1'] == {'id': 'item_0', 'tags': ['x']}
+
+
+@pytest.mark.parametrize('storage', [UTF8JSONStorage, JournaledJSONStorage])
+def test_indexes_follow_changes_written_by_another_process(tmp_path, storage):
+    db_path = str(tmp_path / 'db.json')
+    ours = TinyDB(db_path, storage=storage)
+    theirs = TinyDB(db_path, storage=storage)
+    ours.table_class = theirs.table_class = IndexedTable
+    ours.table('documents').insert_multiple([{'id': 'doc_1', 'userId': 'user_1'}, {'id': 'doc_2', 'userId': 'user_1'}])
+    assert ours.table('documents').get(Query().id == 'doc_1') is not None  # builds the indexes
+
+    # A remove and an insert leave the table size unchanged
+    theirs.table('documents').remove(Query().id == 'doc_1')
+    theirs.table('documents').insert({'id': 'doc_3', 'userId': 'user_1'})
+
+    documents = ours.table('documents')
+    assert documents.get(Query().id == 'doc_1') is None
+    assert documents.get(Query().id == 'doc_3')['userId'] == 'user_1'
+    assert sorted(doc['id'] for doc in documents.search(Query().userId == 'user_1')) == ['doc_2', 'doc_3']
+
+    # Our own writes don't drop the indexes
+    generation = ours.storage.generation
+    documents.insert({'id': 'doc_4', 'userId': 'user_2'})
+    assert documents.get(Query().id == 'doc_4') is not None
+    assert ours.storage.generation == generation
+
+    if storage is JournaledJSONStorage:
+        # A compaction elsewhere replaces the journal: everything is loaded again
+        theirs.table('documents').update({'userId': 'user_3'}, Query().id == 'doc_2')
+        theirs.storage.compact()
+        assert documents.get(Query().id == 'doc_2')['userId'] == 'user_3'
+        assert ours.storage.generation > generation
+
+
+def test_write_behind_cache_coalesces_writes():
+    inner_storage = MagicMock()
+    inner_storage.read.return_value = {'documents': {'1': {'id': 'doc_1', 'title': 'Document 1'}}}
+    inner_storage.last_write_bytes = 42
+    db = TinyDB(storage=WriteBehindCachingMiddleware(lambda: inner_storage, flush_every=3, flush_interval=3600))
+    documents_table = db.table('documents')
+
+    for i in range(5):
+        assert documents_table.get(doc_id=1)['id'] == 'doc_1'
+        documents_table.update({'title': f'Title {i}'}, doc_ids=[1])
+
+    # Reads come from the in-process copy, five writes produced one flush so far
+    assert inner_storage.read.call_count == 1
+    assert inner_storage.write.call_count == 1
+
+    db.storage.flush()
+    assert inner_storage.write.call_count == 2
+    assert inner_storage.write.call_args[0][0]['documents']['1']['title'] == 'Title 4'
+    stats = db.storage.stats()
+    assert stats['flushes'] == 2 and stats['bytes_written'] == 84 and stats['pending_writes'] == 0
+    assert stats['misses'] == 1 and stats['hits'] > 0
+
+
+def test_dynamodb_item_storage_writes_only_changed_documents():
+    dynamodb = InMemoryDynamoDb()
+    dynamodb.create_table(TableName='dms-items', page_size=10, KeySchema=[
+        {'AttributeName': 'table_name', 'KeyType': 'HASH'},
+        {'AttributeName': 'doc_id', 'KeyType': 'RANGE'},
+    ])
+    db = TinyDB(storage=DynamoDbItemStorage, table_name='dms-items', dynamodb=dynamodb)
+    documents_table = db.table('documents')
+    documents_table.insert_multiple([{'id': f'doc_{i}', 'title': f'Document {i}'} for i in range(30)])
+
+    # One item per document, plus one registering the table
+    items = dynamodb.Table('dms-items').items
+    assert len(items) == 31
+    assert json.loads(items[('documents', '1')]['doc']) == {'id': 'doc_0', 'title': 'Document 0'}
+    db.table('users').insert({'id': 'user_1'})
+
+    dynamodb.requests.clear()
+    documents_table.update({'title': 'Renamed'}, Query().id == 'doc_5')
+    documents_table.remove(Query().id == 'doc_6')
+    # One conditional write per changed document, and the table's new version; only the versions are read
+    assert dynamodb.requests == {'Query': 2, 'PutItem': 3, 'DeleteItem': 1}
+
+    # A second storage instance sees the same data, loaded page by page
+    other = TinyDB(storage=DynamoDbItemStorage, table_name='dms-items', dynamodb=dynamodb)
+    assert len(other.table('documents')) == 29
+    assert other.table('documents').get(Query().id == 'doc_5')['title'] == 'Renamed'
+
+    # Only the table another instance changed is queried again
+    other.table('documents').update({'title': 'Renamed again'}, Query().id == 'doc_5')
+    dynamodb.requests.clear()
+    with patch.object(db.storage, 'read', wraps=db.storage.read) as read:
+        assert documents_table.get(Query().id == 'doc_5')['title'] == 'Renamed again'
+        assert db.table('users').get(Query().id == 'user_1') is not None
+    # The versions on every read, and the 29 documents once, in pages of 10
+    assert dynamodb.requests == {'Query': read.call_count + 3} and db.storage.last_read_bytes == 0
+
+
+def test_dynamodb_item_storage_writes_bulk_inserts_in_transactions():
+    dynamodb = InMemoryDynamoDb()
+    dynamodb.create_table(TableName='dms-items', KeySchema=[
+        {'AttributeName': 'table_name', 'KeyType': 'HASH'},
+        {'AttributeName': 'doc_id', 'KeyType': 'RANGE'},
+    ])
+    first = TinyDB(storage=DynamoDbItemStorage, table_name='dms-items', dynamodb=dynamodb)
+    second = TinyDB(storage=DynamoDbItemStorage, table_name='dms-items', dynamodb=dynamodb)
+    first.table_class = second.table_class = IndexedTable
+    second.table('documents').all()
+
+    dynamodb.requests.clear()
+    first.table('documents').insert_multiple([{'id': f'doc_{i}', 'title': f'Document {i}'} for i in range(1000)])
+    # The documents in transactions of 100, the change log entry left over on its own, and both tables' versions
+    assert dynamodb.requests['TransactWriteItems'] == 10 and dynamodb.requests['PutItem'] == 3
+    assert len(dynamodb.Table('dms-items').items) == 1003
+
+    # A transaction whose new documents another writer took the ids of is not applied, and retried
+    with patch('library.python.IndexedTable.time.sleep'):
+        second.table('documents').insert_multiple([{'id': f'new_{i}', 'title': 'New'} for i in range(150)])
+    reader = TinyDB(storage=DynamoDbItemStorage, table_name='dms-items', dynamodb=dynamodb)
+    documents = reader.table('documents').all()
+    assert len(documents) == 1150 and len({doc['id'] for doc in documents}) == 1150
+    assert reader.table('documents').get(doc_id=1)['id'] == 'doc_0'
+
+
+def test_dynamodb_item_storage_retries_writes_that_lost_a_race():
+    dynamodb = InMemoryDynamoDb()
+    dynamodb.create_table(TableName='dms-items', KeySchema=[
+        {'AttributeName': 'table_name', 'KeyType': 'HASH'},
+        {'AttributeName': 'doc_id', 'KeyType': 'RANGE'},
+    ])
+    first = TinyDB(storage=DynamoDbItemStorage, table_name='dms-items', dynamodb=dynamodb)
+    second = TinyDB(storage=DynamoDbItemStorage, table_name='dms-items', dynamodb=dynamodb)
+    first.table_class = second.table_class = IndexedTable
+    first.table('documents').insert({'id': 'doc_1', 'title': 'Document 1'})
+    second.table('documents').insert({'id': 'doc_2', 'title': 'Document 2'})
+
+    # Both picked their next document id before the other's insert
+    with patch('library.python.IndexedTable.time.sleep'):
+        first.table('documents').insert({'id': 'doc_3', 'title': 'Document 3'})
+        second.table('documents').insert_multiple([{'id': 'doc_4', 'title': 'Document 4'}])
+        first.table('documents').insert({'id': 'doc_5', 'title': 'Document 5'})
+
+        # An update based on content another writer has changed since is retried on the new content
+        second.table('documents').all()
+        first.table('documents').update({'title': 'Renamed'}, Query().id == 'doc_1')
+        second.table('documents').update({'author': 'Ann'}, doc_ids=[1])
+
+    reader = TinyDB(storage=DynamoDbItemStorage, table_name='dms-items', dynamodb=dynamodb)
+    assert sorted(doc['id'] for doc in reader.table('documents').all()) == ['doc_1', 'doc_2', 'doc_3', 'doc_4',
+                                                                           'doc_5']
+    assert reader.table('documents').get(doc_id=1) == {'id': 'doc_1', 'title': 'Renamed', 'author': 'Ann'}
+    # The writers' cached documents caught up with each other's
+    assert first.table('documents').all() == second.table('documents').all() == reader.table('documents').all()
+
+    # A writer replacing the version of a table another writer changed since its read loads the table again
+    data = first.storage.read()
+    second.table('documents').update({'title': 'Second'}, doc_ids=[2])
+    data['documents']['3']['title'] = 'First'
+    first.storage.write(data)
+    assert [doc['title'] for doc in first.table('documents').get(doc_ids=[2, 3])] == ['Second', 'First']
+
+
+def test_dynamodb_cached_storage_versioning():
+    dynamodb = InMemoryDynamoDb()
+    first = TinyDB(storage=DynamoDbCachedStorage, table_name='dms', dynamodb=dynamodb)
+    second = TinyDB(storage=DynamoDbCachedStorage, table_name='dms', dynamodb=dynamodb)
+    first.table_class = second.table_class = IndexedTable
+    first.table('documents').insert({'id': 'doc_1', 'title': 'Document 1'})
+    assert dynamodb.Table('dms').items[('db',)]['version'] == 1
+
+    # A warm read with an unchanged version reuses the parsed copy, checking only the small version item
+    data = first.storage.read()
+    generation = first.storage.generation
+    dynamodb.requests.clear()
+    assert first.storage.read() is data
+    assert first.storage.generation == generation
+    assert dynamodb.requests == {'GetItem': 1}
+    assert dynamodb.Table('dms').items[('db#version',)] == {'id': 'db#version', 'version': 1}
+
+    # The second writer commits between the first writer's read and write:
+    # the first write is rejected and retried against fresh data
+    write = first.storage.write
+
+    def racing_write(tables):
+        first.storage.write = write
+        second.table('documents').insert({'id': 'doc_2', 'title': 'Document 2'})
+        write(tables)
+
+    first.storage.write = racing_write
+    with patch('library.python.IndexedTable.time.sleep') as sleep:
+        first.table('documents').insert({'id': 'doc_3', 'title': 'Document 3'})
+        assert sleep.call_count == 1
+
+    assert dynamodb.Table('dms').items[('db',)]['version'] == 3
+    assert sorted(doc['id'] for doc in first.table('documents').all()) == ['doc_1', 'doc_2', 'doc_3']
+
+    # A version raised by a write that failed before its dump makes readers download the dump, until the next write
+    dynamodb.Table('dms').put_item(Item={'id': 'db#version', 'version': 4})
+    data = second.storage.read()
+    dynamodb.requests.clear()
+    assert second.storage.read() is data and dynamodb.requests == {'GetItem': 2}
+    second.table('documents').insert({'id': 'doc_4', 'title': 'Document 4'})
+    dynamodb.requests.clear()
+    assert len(second.storage.read()['documents']) == 4 and dynamodb.requests == {'GetItem': 1}
+    assert second.table('documents').get(Query().id == 'doc_3')['title'] == 'Document 3'
+
+
+def test_write_behind_cache_recovers_from_a_rejected_flush():
+    dynamodb = InMemoryDynamoDb()
+    cached = TinyDB(storage=WriteBehindCachingMiddleware(DynamoDbCachedStorage, flush_every=100, flush_interval=3600),
+                    table_name='dms', dynamodb=dynamodb)
+    other = TinyDB(storage=DynamoDbCachedStorage, table_name='dms', dynamodb=dynamodb)
+    cached.table_class = other.table_class = IndexedTable
+    cached.table('documents').insert({'id': 'doc_1'})
+    cached.storage.flush()
+
+    # Two cached writes lose the race to another writer: they are dropped and the flush fails
+    cached.table('documents').insert({'id': 'doc_2'})
+    cached.table('documents').insert({'id': 'doc_3'})
+    other.table('documents').insert({'id': 'doc_4'})
+    with pytest.raises(LostWritesError):
+        cached.storage.flush()
+
+    # Later writes start from the stored data instead of repeating the rejected write
+    cached.table('documents').insert({'id': 'doc_5'})
+    cached.storage.flush()
+
+    # A single cached write that loses is retried by the table against fresh data
+    cached.storage.flush_every = 1
+    write = cached.storage.storage.write
+
+    def racing_write(tables):
+        cached.storage.storage.write = write
+        other.table('documents').insert({'id': 'doc_6'})
+        write(tables)
+
+    cached.storage.storage.write = racing_write
+    with patch('library.python.IndexedTable.time.sleep'):
+        cached.table('documents').insert({'id': 'doc_7'})
+
+    reader = TinyDB(storage=DynamoDbCachedStorage, table_name='dms', dynamodb=dynamodb)
+    assert sorted(doc['id'] for doc in reader.table('documents').all()) == ['doc_1', 'doc_4', 'doc_5', 'doc_6',
+                                                                           'doc_7']
+    assert cached.storage.stats()['conflicts'] == 2
+
+
+def test_snapshot_codecs_compress_and_chunk(tmp_path):
+    db_path = str(tmp_path / 'db.json')
+    documents = [{'id': f'doc_{i}', 'title': f'Document {i}', 'hashValue': f'hash{i}'} for i in range(200)]
+    TinyDB(db_path, storage=UTF8JSONStorage).table('documents').insert_multiple(documents)
+    pretty_size = (tmp_path / 'db.json').stat().st_size
+
+    # Any codec reads what another one wrote, large snapshots go to chunk files
+    db = TinyDB(db_path, storage=UTF8JSONStorage, codec='lzma', chunk_size=256)
+    db.table('documents').update({'title': 'Renamed'}, Query().id == 'doc_7')
+    chunk_files = sorted(tmp_path.glob('db.json.chunk-*'))
+    assert len(chunk_files) > 1
+    assert sum(chunk.stat().st_size for chunk in chunk_files) < pretty_size / 4
+    reopened = TinyDB(db_path, storage=UTF8JSONStorage, codec='json')
+    assert reopened.table('documents').get(Query().id == 'doc_7')['title'] == 'Renamed'
+    reopened.table('documents').remove(Query().id == 'doc_8')
+    assert not list(tmp_path.glob('db.json.chunk-*'))
+    assert len(TinyDB(db_path, storage=UTF8JSONStorage).table('documents')) == 199
+
+    # The DynamoDB dump is split over chunk items that are replaced per version
+    dynamodb = InMemoryDynamoDb()
+    dump_db = TinyDB(storage=DynamoDbCachedStorage, table_name='dms', dynamodb=dynamodb, codec='json',
+                     chunk_size=2048)
+    dump_db.table('documents').insert_multiple(documents)
+    dump_db.table('documents').update({'title': 'Renamed'}, Query().id == 'doc_7')
+    items = dynamodb.Table('dms').items
+    head = items[('db',)]
+    assert head['version'] == 2 and head['codec'] == 'json' and 'db_dump' not in head
+    assert len(items) == head['chunks'] + 2
+    other = TinyDB(storage=DynamoDbCachedStorage, table_name='dms', dynamodb=dynamodb, codec='zlib')
+    assert other.table('documents').get(Query().id == 'doc_7')['title'] == 'Renamed'
+    other.table('documents').remove(Query().id == 'doc_8')
+    assert isinstance(items[('db',)]['db_blob'], bytes) and len(items) == 2
+    assert len(dump_db.table('documents')) == 199
+
+
+def test_trie_search_ranks_and_pages():
+    trie = TrieNode(True)
+    titles = ['Report', 'Reports 2024', 'Rent', 'Receipt', 'Recipe book', 'Other']
+    for i, title in enumerate(titles):
+        trie.insert(Document(f'doc_{i}', title, f'hash{i}', '.txt', f'2024-08-{10 + i:02d}T10:00:00'))
+    trie.insert(Document('doc_6', 'Rest', 'hash6', '.txt', '2024-08-01T10:00:00'))
+
+    # Shortest titles first, newer uploads first among titles of the same length
+    documents, total, cursor = trie.search_page('re', limit=3)
+    assert [document.id for document in documents] == ['doc_2', 'doc_6', 'doc_0']
+    assert total == 6 and trie.count_prefix('rep') == 2
+
+    documents, total, cursor = trie.search_page('RE', limit=3, cursor=cursor)
+    assert [document.id for document in documents] == ['doc_3', 'doc_4', 'doc_1']
+    assert cursor is None
+
+    # Counts follow removals and empty branches are pruned
+    trie.remove(Document('doc_1', 'Reports 2024', 'hash1', '.txt'))
+    assert trie.count_prefix('re') == 5 and trie.search('reports') == []
+    assert 's' not in trie.children['r'].children['e'].children['p'].children['o'].children['r'].children['t'].children
+    assert len(trie.search('')) == trie.count == 6
+
+
+def test_radix_trie_compresses_and_merges_paths():
+    trie = RadixTrieNode(True)
+    for i, title in enumerate(['Report', 'Reports 2024', 'Rent', 'Receipt']):
+        trie.insert(Document(f'doc_{i}', title, f'hash{i}', '.txt', f'2024-08-{10 + i:02d}T10:00:00'))
+
+    # One node per branching point, with the characters in between as edge labels
+    assert list(trie.children) == ['r'] and trie.children['r'].label == 're'
+    assert sorted(child.label for child in trie.children['r'].children.values()) == ['ceipt', 'nt', 'port']
+    assert [document.id for document in trie.search('rep')] == ['doc_0', 'doc_1']
+    assert [document.id for document in trie.search('RECE', limit=1)] == ['doc_3']
+    assert trie.search('reportx') == [] and trie.count_prefix('re') == 4
+
+    # Removing documents deletes leaves and merges single-child chains again
+    trie.remove(Document('doc_0', 'Report', 'hash0', '.txt'))
+    assert trie.children['r'].children['p'].label == 'ports 2024'
+    trie.remove(Document('doc_2', 'Rent', 'hash2', '.txt'))
+    trie.remove(Document('doc_3', 'Receipt', 'hash3', '.txt'))
+    assert trie.children['r'].label == 'reports 2024' and not trie.children['r'].children
+    assert [document.id for document in trie.search('')] == ['doc_1'] and trie.count == 1
+
+
+def test_bulk_built_tries_match_inserted_ones():
+    titles = ['Report', 'Reports 2024', 'Rent', 'Receipt', 'report', 'Re', 'Invoice', '', 'Reports']
+    documents = [Document(f'doc_{i}', title, f'hash{i}', '.txt', f'2024-08-{10 + i:02d}T10:00:00')
+                 for i, title in enumerate(titles)]
+
+    def shape(node):
+        label = getattr(node, 'label', '')
+        return (label, node.count, node.document.id if node.is_end_of_word else None,
+                {key: shape(child) for key, child in node.children.items()})
+
+    for trie_class in (TrieNode, RadixTrieNode):
+        inserted = trie_class(True)
+        for document in documents:
+            inserted.insert(document)
+        built = trie_class.build(iter(documents))
+        assert shape(built) == shape(inserted)
+        # Of the two documents titled "report", the last one is kept
+        assert [document.id for document in built.search('rep')] == ['doc_4', 'doc_8', 'doc_1']
+
+    index = TitleSearchIndex.from_documents(documents)
+    inserted = TitleSearchIndex()
+    for document in documents:
+        inserted.insert(document)
+    assert [document.id for document in index.search('rep 2024')] == ['doc_1']
+    for query in ('re', 'reports', 'i', ''):
+        assert index.search(query) == inserted.search(query)
+
+
+def test_title_search_index_matches_words():
+    index = TitleSearchIndex()
+    index.insert(Document('doc_1', 'Weekly Report', 'hash1', '.txt', '2024-08-10T10:00:00'))
+    index.insert(Document('doc_2', 'Report', 'hash2', '.txt', '2024-08-11T10:00:00'))
+    index.insert(Document('doc_3', 'report', 'hash3', '.pdf', '2024-08-12T10:00:00'))
+    index.insert(Document('doc_4', 'Monthly report (draft)', 'hash4', '.txt', '2024-08-13T10:00:00'))
+
+    # Any word of the title matches and documents with the same title are kept apart
+    assert [document.id for document in index.search('report')] == ['doc_3', 'doc_2', 'doc_1', 'doc_4']
+    assert [document.id for document in index.search('rep wee')] == ['doc_1']
+    assert [document.id for document in index.search('DRAFT, month')] == ['doc_4']
+    assert index.search('report yearly') == []
+
+    documents, total, cursor = index.search_page('rep', limit=2)
+    assert [document.id for document in documents] == ['doc_3', 'doc_2'] and total == 4
+    assert [document.id for document in index.search('rep', limit=2, cursor=cursor)] == ['doc_1', 'doc_4']
+
+    # Re-inserting replaces the older version, removing drops words without postings
+    index.insert(Document('doc_1', 'Weekly summary', 'hash1', '.txt', '2024-08-10T10:00:00'))
+    index.remove(Document('doc_4', 'Monthly report (draft)', 'hash4', '.txt'))
+    assert [document.id for document in index.search('report')] == ['doc_3', 'doc_2']
+    assert index.search('month') == [] and len(index) == 3
+
+
+def test_trie_fuzzy_search_tolerates_typos():
+    for trie in (TrieNode(True), RadixTrieNode(True)):
+        for i, title in enumerate(['Report', 'Reports 2024', 'Receipt', 'Repair', 'Other']):
+            trie.insert(Document(f'doc_{i}', title, f'hash{i}', '.txt', f'2024-08-{10 + i:02d}T10:00:00'))
+
+        assert trie.search('rpeo') == []
+        matches, total = trie.fuzzy_search_page('Rpeort', max_edits=2)
+        assert [(document.id, distance) for document, distance in matches] == [('doc_0', 2), ('doc_1', 2)]
+        matches, total = trie.fuzzy_search_page('repo', max_edits=1, limit=2)
+        assert [(document.id, distance) for document, distance in matches] == [('doc_0', 0), ('doc_1', 0)]
+        assert total == 3  # Repair matches "repa", one substitution away
+        assert trie.fuzzy_search_page('xyz', max_edits=1) == ([], 0)
+
+
+def test_trie_snapshot_restores_unchanged_users(tmp_path):
+    def stored(i, user_id, title):
+        return {'id': f'doc_{i}', 'userId': user_id, 'title': title, 'hashValue': f'hash{i}', 'fileExt': '.txt',
+                'uploadDate': f'2024-08-{10 + i:02d}T10:00:00'}
+
+    documents = {'user_1': [stored(1, 'user_1', 'Weekly Report'), stored(2, 'user_1', 'Report'),
+                            stored(3, 'user_1', 'Receipt')],
+                 'user_2': [stored(4, 'user_2', 'Other')]}
+    snapshot = TrieSnapshot(str(tmp_path / 'trie-snapshot.json.z'))
+    for user_id, user_documents in documents.items():
+        snapshot.update(build_trie_user(user_id, user_documents), user_documents)
+    snapshot.save()
+
+    loaded = TrieSnapshot(str(tmp_path / 'trie-snapshot.json.z'))
+    loaded.load()
+    trie_user = loaded.restore('user_1', documents['user_1'])
+    assert [document.id for document in trie_user.trie.search('re')] == ['doc_2', 'doc_3']
+    assert [document.id for document in trie_user.index.search('report')] == ['doc_2', 'doc_1']
+    assert trie_user.trie.count_prefix('re') == 2 and trie_user.trie.children['r'].label == 're'
+    trie_user.add_document(Document('doc_5', 'Repair', 'hash5', '.txt'))
+    assert trie_user.trie.count_prefix('rep') == 2
+
+    # A changed document list makes the entry stale
+    assert loaded.restore('user_2', documents['user_2'] + [stored(6, 'user_2', 'New')]) is None
+    assert loaded.restore('user_3', []) is None
+
+
+def test_presigned_url_cache_reuses_urls_until_close_to_expiry():
+    now = [1000.0]
+    signed = []
+
+    def sign(expires_in):
+        signed.append(expires_in)
+        return f'url-{len(signed)}'
+
+    cache = PresignedUrlCache(expires_in=3600, min_remaining=900, max_entries=2, clock=lambda: now[0])
+    metrics = Metrics(enabled=True)
+    with patch('library.python.PresignedUrlCache.METRICS', metrics):
+        assert cache.get(('a', '.pdf'), 'application/pdf', sign) == ('url-1', 4600.0)
+        now[0] += 2700
+        assert cache.get(('a', '.pdf'), 'application/pdf', sign) == ('url-1', 4600.0)
+        # Less than min_remaining left, or signed for another content type: signed again
+        now[0] += 1
+        assert cache.get(('a', '.pdf'), 'application/pdf', sign)[0] == 'url-2'
+        assert cache.get(('a', '.pdf'), 'text/plain', sign)[0] == 'url-3'
+        assert signed == [3600] * 3
+
+        # A missing file isn't cached; the least recently used URL is evicted
+        assert cache.get(('b', '.pdf'), None, lambda expires_in: None) == (None, None)
+        cache.get(('b', '.pdf'), None, sign)
+        cache.get(('c', '.pdf'), None, sign)
+        assert len(cache) == 2 and cache.get(('a', '.pdf'), 'text/plain', sign)[0] == 'url-6'
+
+        cache.discard(('c', '.pdf'))
+        assert cache.get(('c', '.pdf'), None, sign)[0] == 'url-7'
+        assert cache.stats() == {'hits': 1, 'misses': 8, 'expirations': 1, 'evictions': 2, 'invalidations': 1,
+                                 'hit_rate': 0.111, 'urls': 2}
+    # The same counters in the process metrics
+    for event, count in [('hits', 1), ('misses', 8), ('expirations', 1), ('evictions', 2), ('invalidations', 1)]:
+        assert f'dms_presigned_url_cache_events_total{{event="{event}"}} {count}\n' in metrics.render()
+
+
+def test_trie_user_cache_builds_lazily_and_evicts():
+    documents = {'user_1': [{'id': 'doc_1', 'title': 'Report', 'hashValue': 'hash1', 'fileExt': '.txt'},
+                            {'id': 'doc_2', 'title': 'Receipt', 'hashValue': 'hash2', 'fileExt': '.txt'}],
+                 'user_2': [{'id': 'doc_3', 'title': 'Invoice', 'hashValue': 'hash3', 'fileExt': '.txt'}],
+                 'user_3': []}
+    built = []
+
+    def load(user_id):
+        built.append(user_id)
+        return build_trie_user(user_id, documents[user_id]) if user_id in documents else None
+
+    cache = TrieUserCache(load, max_users=2, max_documents=3)
+    assert cache.get('user_1').trie.count_prefix('re') == 2 and cache.get('user_1') is cache.get('user_1')
+    assert cache.get('user_unknown') is None and 'user_unknown' not in cache
+    cache.get('user_2')
+    cache.get('user_1')
+    # Over 2 users: the least recently used one, user_2, goes
+    cache.get('user_3')
+    assert 'user_2' not in cache and 'user_1' in cache and 'user_3' in cache
+    # user_2 is built again, pushing out user_1
+    cache.get('user_2').add_document(Document('doc_4', 'Invoice 2', 'hash4', '.txt'))
+    cache.get('user_2')
+    assert built == ['user_1', 'user_unknown', 'user_2', 'user_3', 'user_2']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['builds'], stats['evictions']) == (4, 5, 4, 2)
+    assert (stats['users'], stats['documents']) == (2, 2)
+
+    # 4 documents are over budget too, so user_3 and user_2 both go
+    cache.get('user_1')
+    assert 'user_1' in cache and len(cache) == 1
+
+
+def test_trie_user_cache_builds_outside_its_lock():
+    documents = {'user_1': [{'id': 'doc_1', 'title': 'Report', 'hashValue': 'hash1', 'fileExt': '.txt'}],
+                 'user_2': [{'id': 'doc_2', 'title': 'Invoice', 'hashValue': 'hash2', 'fileExt': '.txt'}]}
+    started, release = threading.Event(), threading.Event()
+    built = []
+
+    def load(user_id):
+        built.append(user_id)
+        if user_id == 'user_1':
+            started.set()
+            assert release.wait(5)
+        return build_trie_user(user_id, documents[user_id])
+
+    cache = TrieUserCache(load)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(cache.get, 'user_1')
+        assert started.wait(5)
+        second = executor.submit(cache.get, 'user_1')
+        # Other users are served while user_1 is being built
+        assert cache.get('user_2').trie.count_prefix('inv') == 1 and 'user_1' not in cache
+        release.set()
+        assert first.result(5) is second.result(5) is cache.peek('user_1')
+    # Concurrent misses for a user build it once
+    assert built == ['user_1', 'user_2'] and cache.stats()['builds'] == 2
+
+    # A user discarded while being built, e.g. because their documents changed, is built again next time
+    started.clear()
+    release.clear()
+    cache.discard('user_1')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        build = executor.submit(cache.get, 'user_1')
+        assert started.wait(5)
+        cache.discard('user_1')
+        release.set()
+        assert build.result(5).user_id == 'user_1'
+    assert 'user_1' not in cache and cache.get('user_1') is not build.result()
+    assert built == ['user_1', 'user_2', 'user_1', 'user_1']
+
+
+def test_load_trie_user_builds_new_users():
+    mock_db = MagicMock()
+    mock_db.table.return_value.search.return_value = []
+    mock_db.table.return_value.contains.return_value = True
+    with patch('helpers.db', new=mock_db):
+        trie_user = load_trie_user('new_user')
+        assert trie_user.user_id == 'new_user' and trie_user.trie.search('') == []
+        mock_db.table.return_value.contains.return_value = False
+        assert load_trie_user('no_user') is None
+
+
+def test_change_log_syncs_tries_across_processes():
+    # Two processes sharing one DynamoDB-backed database
+    dynamodb = InMemoryDynamoDb()
+    writer = TinyDB(storage=DynamoDbCachedStorage, table_name='dms', dynamodb=dynamodb)
+    reader = TinyDB(storage=DynamoDbCachedStorage, table_name='dms', dynamodb=dynamodb)
+    writer.table_class = reader.table_class = IndexedTable
+
+    def stored(i, user_id, title):
+        return {'id': f'doc_{i}', 'userId': user_id, 'title': title, 'hashValue': f'hash{i}', 'fileExt': '.txt'}
+
+    writer.table('documents').insert_multiple([stored(1, 'user_1', 'Report'), stored(2, 'user_1', 'Receipt'),
+                                               stored(3, 'user_2', 'Invoice')])
+    with patch('helpers.db', new=reader):
+        cache = TrieUserCache(load_trie_user)
+        change_log = ChangeLog(reader, poll_interval=0)
+        assert change_log.sequence == 1
+        assert cache.get('user_1').trie.count_prefix('re') == 2
+
+        documents = writer.table('documents')
+        documents.insert(stored(4, 'user_1', 'Receipt 2'))
+        documents.update({'title': 'Annual Report'}, Query().id == 'doc_1')
+        documents.update({'userId': 'user_2'}, Query().title == 'Receipt')
+        documents.remove(Query().id == 'doc_3')
+        sync_trie_users(cache, change_log)
+
+        # Only the cached user is updated, in place
+        trie_user = cache.peek('user_1')
+        assert [document.id for document in trie_user.trie.search('')] == ['doc_4', 'doc_1']
+        assert [document.id for document in trie_user.index.search('report')] == ['doc_1']
+        assert 'user_2' not in cache and change_log.sequence == 5
+        assert [document.id for document in cache.get('user_2').trie.search('')] == ['doc_2']
+
+        # Entries dropped from the log before they were seen make every cached trie stale
+        with patch('library.python.ChangeLog.CHANGE_LOG_SIZE', 2):
+            for i in range(5, 8):
+                documents.insert(stored(i, 'user_3', f'Document {i}'))
+        assert sorted(int(key) for key in writer.storage.read()['changes']) == [7, 8]
+        sync_trie_users(cache, change_log)
+        assert len(cache) == 0
+        documents.truncate()
+        assert change_log.poll() is None
+
+
+def test_metrics_time_requests_and_storage_and_export_prometheus_text(tmp_path, caplog, routes_app):
+    metrics = Metrics(enabled=True, buckets=(0.1, 1.0))
+    db = TinyDB(str(tmp_path / 'db.json'), storage=InstrumentedMiddleware(UTF8JSONStorage, metrics))
+    app = Flask(__name__)
+
+    @app.route('/items/<item_id>')
+    def get_item(item_id):
+        db.table('items').insert({'id': item_id})
+        return {'id': item_id}
+
+    init_metrics(app, metrics)
+    client = app.test_client()
+    with caplog.at_level('INFO'):
+        assert client.get('/items/1').status_code == 200
+    assert client.get('/missing').status_code == 404
+
+    # One line per request, with the storage calls it made
+    line = json.loads(next(record.message for record in caplog.records if '"event": "request"' in record.message))
+    assert line['route'] == '/items/<item_id>' and line['path'] == '/items/1' and line['status'] == 200
+    assert line['metrics']['storage_operation_duration_seconds.write.UTF8JSONStorage']['calls'] == 1
+    assert line['metrics']['storage_bytes_total.write.UTF8JSONStorage'] == db.storage.last_write_bytes > 0
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE dms_http_request_duration_seconds histogram' in text
+    assert 'dms_http_request_duration_seconds_count{method="GET",route="/items/<item_id>",status="200"} 1' in text
+    assert 'dms_http_request_duration_seconds_bucket{method="GET",route="unmatched",status="404",le="+Inf"} 1' in text
+    assert f'dms_storage_bytes_total{{operation="write",storage="UTF8JSONStorage"}} {db.storage.last_write_bytes}' \
+        in text
+    assert 'dms_snapshot_encode_duration_seconds' not in text  # recorded to the process-wide registry only
+
+    # The caches' own counters and sizes, read when scraped; a failing collector doesn't take the others down
+    _, routes = routes_app
+    routes.presignedUrls.get(('hash1', '.txt'), None, lambda expires_in: 'url')
+    write_behind_stats = {'hits': 3, 'misses': 1, 'writes': 2, 'flushes': 1, 'bytes_written': 120, 'conflicts': 0,
+                          'pending_writes': 1}
+    metrics.register_collector(Mock(side_effect=RuntimeError("Cache gone")))
+    metrics.register_collector(routes.collect_cache_metrics)
+    with patch.object(routes, 'Database') as database, caplog.at_level('ERROR'):
+        database.return_value.cache_stats.return_value = write_behind_stats
+        text = client.get('/metrics').get_data(as_text=True)
+    assert 'Metrics collector' in caplog.text
+    for sample in ['dms_trie_user_cache_events_total{event="misses"} 0', 'dms_trie_user_cache_users 0',
+                   'dms_trie_user_cache_build_seconds_total 0.0', 'dms_presigned_url_cache_urls 1',
+                   'dms_write_behind_cache_events_total{event="hits"} 3', 'dms_write_behind_cache_pending_writes 1',
+                   'dms_write_behind_cache_bytes_written_total 120']:
+        assert f'{sample}\n' in text
+    assert '# TYPE dms_trie_user_cache_users gauge' in text
+    assert '# TYPE dms_write_behind_cache_events_total counter' in text
+    # The routes register it with the process-wide registry
+    with patch.object(routes, 'Database'):
+        assert 'dms_trie_user_cache_users 0\n' in METRICS.render()
+
+    # Disabled, nothing is recorded and there is nothing to scrape
+    metrics.enabled = False
+    metrics.observe('trie_operation_duration_seconds', 0.5, operation='insert')
+    assert 'trie_operation' not in metrics.render()
+    assert client.get('/metrics').status_code == 404
+
+
+def test_lambda_handler_answers_500_when_the_flush_fails():
+    with patch.dict(os.environ, {'FRONTEND_URL': 'http://localhost:3000'}):
+        import lambda_function
+
+    with patch.object(lambda_function, 'Database') as database:
+        database.return_value.flush.side_effect = ConcurrentModificationError("Database changed since version 3")
+        database.return_value.cache_stats.return_value = None
+        result = lambda_function.lambda_handler({'httpMethod': 'GET', 'path': '/', 'headers': {},
+                                                 'queryStringParameters': {}}, None)
+    assert result['statusCode'] == 500
+
+
+@pytest.fixture
+def routes_app(tmp_path):
+    # The routes on a database and upload folder of their own, instead of the ones the module opened
+    import routes
+    db = TinyDB(str(tmp_path / 'db.json'), storage=UTF8JSONStorage)
+    db.table_class = IndexedTable
+    db.table('users').insert_multiple([{'id': 'user_1', 'firstName': 'Ada', 'lastName': 'Lovelace'},
+                                       {'id': 'user_2', 'firstName': 'Alan', 'lastName': 'Turing'}])
+    db.table('categories').insert({'data': ['Report']})
+    blob_store = LocalBlobStore(db.table('documents'), str(tmp_path / 'uploads'))
+    app = Flask(__name__)
+    for blueprint in (routes.upload_file_bp, routes.download_bp, routes.delete_bp):
+        app.register_blueprint(blueprint)
+    with patch('helpers.db', new=db), patch.multiple(routes, db=db, blobStore=blob_store, use_s3=False,
+                                                      trieUsersCache=TrieUserCache(load_trie_user),
+                                                      presignedUrls=PresignedUrlCache(3600, 900, 100),
+                                                      documentChanges=ChangeLog(db, poll_interval=0)):
+        yield app.test_client(), routes
+
+
+def store_blob(blob_store, content, file_ext='.txt'):
+    hash_value = compute_file_hash(io.BytesIO(content))
+    path = blob_store.locate(blob_key(hash_value, file_ext))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    # Stored long enough ago to be deleted with its last document
+    stored_at = time.time() - RELEASE_GRACE_PERIOD
+    os.utime(path, (stored_at, stored_at))
+    return hash_value
+
+
+def test_download_answers_conditional_and_range_requests(routes_app):
+    client, routes = routes_app
+    hash_value = store_blob(routes.blobStore, b'0123456789')
+    routes.db.table('documents').insert({'id': 'doc_1', 'userId': 'user_1', 'title': 'Digits',
+                                         'hashValue': hash_value, 'fileExt': '.txt', 'mimeType': 'text/plain'})
+
+    response = client.get('/download/doc_1')
+    assert response.status_code == 200 and response.data == b'0123456789'
+    assert response.headers['ETag'] == f'"{hash_value}"' and response.headers['Accept-Ranges'] == 'bytes'
+
+    # The hash is the validator, so a client holding the file gets no body
+    response = client.get('/download/doc_1', headers={'If-None-Match': f'"{hash_value}"'})
+    assert response.status_code == 304 and response.data == b'' and response.headers['ETag'] == f'"{hash_value}"'
+    assert client.get('/download/doc_1', headers={'If-None-Match': '"other"'}).status_code == 200
+
+    response = client.get('/download/doc_1', headers={'Range': 'bytes=2-5'})
+    assert response.status_code == 206 and response.data == b'2345'
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    response = client.get('/download/doc_1', headers={'Range': 'bytes=20-30'})
+    assert response.status_code == 416 and response.headers['Content-Range'] == 'bytes */10'
+
+    assert client.get('/download/doc_2').status_code == 404
+
+
+def test_download_redirects_to_a_presigned_s3_url(routes_app):
+    client, routes = routes_app
+    hash_value = f'{1:064x}'
+    routes.db.table('documents').insert({'id': 'doc_1', 'userId': 'user_1', 'title': 'Report',
+                                         'hashValue': hash_value, 'fileExt': '.pdf', 'mimeType': 'application/pdf'})
+    s3 = boto3.client('s3', region_name='us-east-1', aws_access_key_id='key', aws_secret_access_key='secret')
+    key = f'uploads/{blob_key(hash_value, ".pdf")}'
+
+    with Stubber(s3) as stubber, patch.multiple(routes, use_s3=True, blobStore=S3BlobStore(
+            routes.db.table('documents'), s3, 'bucket', 'uploads')):
+        stubber.add_response('head_object', {}, {'Bucket': 'bucket', 'Key': key})
+        response = client.get('/download/doc_1?redirect=1')
+        assert response.status_code == 302 and f'/{key}?' in response.headers['Location']
+        assert response.headers['ETag'] == f'"{hash_value}"' and response.headers['Cache-Control'] == 'no-cache'
+
+        # The cached URL is handed out again without looking the file up, as a link that mustn't be stored
+        response = client.get('/download/doc_1')
+        assert response.status_code == 200 and response.headers['Cache-Control'] == 'no-store'
+        assert response.json == {'url': response.json['url'], 'etag': hash_value} and key in response.json['url']
+
+        # A client revalidating the redirect isn't sent the link again, one holding a link is
+        response = client.get('/download/doc_1?redirect=1', headers={'If-None-Match': f'"{hash_value}"'})
+        assert response.status_code == 304 and 'Location' not in response.headers
+        assert client.get('/download/doc_1', headers={'If-None-Match': f'"{hash_value}"'}).status_code == 200
+        stubber.assert_no_pending_responses()
+
+
+def test_batch_upload_stores_new_files_with_one_write(routes_app):
+    client, routes = routes_app
+    documents = routes.db.table('documents')
+    hash_value = store_blob(routes.blobStore, b'old content')
+    documents.insert({'id': 'doc_1', 'userId': 'user_2', 'title': 'Old', 'hashValue': hash_value, 'fileExt': '.txt',
+                      'uploadDateReadable': '01-Jan-2024 10:00', 'categories': ['Report']})
+
+    def upload(*files, **form):
+        return client.post('/documents/upload/batch', content_type='multipart/form-data', data={
+            'files': [(io.BytesIO(content), name) for name, content in files], 'userId': 'user_1', **form})
+
+    files = [('a.txt', b'new content'), ('b.txt', b'old content'), ('c.txt', b'new content'),
+             ('d.txt', b'other content'), ('e.txt', b'more content')]
+    with patch.object(IndexedTable, 'insert_multiple', autospec=True,
+                      side_effect=IndexedTable.insert_multiple) as insert_multiple:
+        response = upload(*files, titles=['Alpha', 'Beta', 'Gamma', ' ', 'Epsilon'], categories='Invoice,Report')
+    assert response.status_code == 200 and response.json['message'] == '2 of 5 files uploaded'
+    results = response.json['results']
+    assert [result['status'] for result in results] == ['uploaded', 'duplicate', 'duplicate', 'error', 'uploaded']
+    assert results[1]['existing_document'] == {'title': 'Old', 'uploadDate': '01-Jan-2024 10:00',
+                                               'categories': ['Report']}
+    assert results[2]['message'] == 'Same file as a.txt in this upload'
+    assert results[3]['message'] == 'Title is required'
+
+    # The new documents went in together, their files are stored, and the uploader's trie knows them
+    assert insert_multiple.call_count == 1
+    uploaded = [result['document'] for result in results if result['status'] == 'uploaded']
+    assert [document['title'] for document in documents.all()] == ['Old', 'Alpha', 'Epsilon']
+    assert all(document['author'] == 'Ada Lovelace' and document['categories'] == ['Invoice', 'Report']
+               for document in uploaded)
+    for document, content in zip(uploaded, [b'new content', b'more content']):
+        with open(routes.blobStore.resolve(routes.blobStore.key_of(document)), 'rb') as f:
+            assert f.read() == content
+    assert {document.id for document in routes.trieUsersCache.get('user_1').trie.search('')} == \
+        {document['id'] for document in uploaded}
+    assert sorted(routes.db.table('categories').get(doc_id=1)['data']) == ['Invoice', 'Report']
+
+    # Every file needs a title, or none does; nothing is kept from a rejected upload
+    stored_files = sorted(path for path, _ in routes.blobStore._list())
+    response = upload(('f.txt', b'fresh content'), ('g.txt', b'fresh content 2'), titles=['Only one'],
+                      categories='Report')
+    assert response.status_code == 400 and response.json['message'] == 'Give a title for every file, or none'
+    assert sorted(path for path, _ in routes.blobStore._list()) == stored_files and len(documents) == 3
+
+
+def test_bulk_delete_releases_unshared_files_and_forgets_links(routes_app):
+    client, routes = routes_app
+    documents = routes.db.table('documents')
+    hashes = [store_blob(routes.blobStore, content) for content in (b'first', b'shared', b'kept')]
+    documents.insert_multiple([
+        {'id': 'doc_1', 'userId': 'user_1', 'title': 'First', 'hashValue': hashes[0], 'fileExt': '.txt'},
+        {'id': 'doc_2', 'userId': 'user_1', 'title': 'Shared', 'hashValue': hashes[1], 'fileExt': '.txt'},
+        {'id': 'doc_3', 'userId': 'user_2', 'title': 'Shared copy', 'hashValue': hashes[1], 'fileExt': '.txt'},
+        {'id': 'doc_4', 'userId': 'user_1', 'title': 'Kept', 'hashValue': hashes[2], 'fileExt': '.txt'}])
+    assert routes.trieUsersCache.get('user_1').trie.count_prefix('') == 3
+    for hash_value in hashes:
+        routes.presignedUrls.get((hash_value, '.txt'), None, lambda expires_in: 'url')
+
+    # Unknown ids are skipped; the file doc_3 shares is kept
+    response = client.post('/delete/batch', json={'ids': ['doc_1', 'doc_2', 'doc_unknown']})
+    assert response.status_code == 200 and sorted(response.json['deleted']) == ['doc_1', 'doc_2']
+    assert response.json['filesDeleted'] == 1 and response.json['message'] == '2 documents deleted'
+    assert [document['id'] for document in documents.all()] == ['doc_3', 'doc_4']
+    assert routes.blobStore.resolve(blob_key(hashes[0], '.txt')) is None
+    assert routes.blobStore.resolve(blob_key(hashes[1], '.txt')) is not None
+
+    # Their download links aren't handed out again, and the cached trie no longer finds them
+    assert len(routes.presignedUrls) == 1 and routes.presignedUrls.stats()['invalidations'] == 2
+    assert [document.id for document in routes.trieUsersCache.peek('user_1').trie.search('')] == ['doc_4']
+    assert 'user_2' not in routes.trieUsersCache
+
+    # Deleting the last document sharing a file deletes the file
+    response = client.post('/delete/batch', json={'userId': 'user_2'})
+    assert response.json['deleted'] == ['doc_3'] and response.json['filesDeleted'] == 1
+    assert routes.blobStore.resolve(blob_key(hashes[1], '.txt')) is None
+
+    response = client.post('/delete/batch', json={'ids': ['doc_unknown']})
+    assert response.status_code == 200 and response.json == {'message': 'No documents matched', 'deleted': [],
+                                                             'filesDeleted': 0}
+    assert client.post('/delete/batch', json={}).status_code == 400
+    # A string or a list of anything but ids is rejected rather than matched character by character
+    for ids in ['doc_1', [{'id': 'doc_1'}], ['doc_1', 2], {'doc_1': True}]:
+        assert client.post('/delete/batch', json={'ids': ids}).status_code == 400